@@ -3,6 +3,10 @@ This script sets up the streamlit UI and calls the backend code to process user
 
 $ python3 -m streamlit run api/main.py -- --openai_api_key "<enter key here>"
 
+or, as a thin client of the search service (api/service.py):
+
+$ python3 -m streamlit run api/main.py -- --service_url "http://localhost:8000"
+
 """
 
 import streamlit as st
@@ -10,10 +14,27 @@ from utils import *
 
 st.set_page_config(page_title="ResearchHub", page_icon=":ghost:", layout="wide")
 
+# streamlit reruns this script on every interaction,
+# cache_resource makes the warm up and argument parsing
+# happen once per process
+warm_up_backend = st.cache_resource(warm_up_backend)
+parse_arguments = st.cache_resource(parse_arguments)
+
 
 def search_engine():
 
-    _OPENAI_KEY = parse_arguments()['openai_api_key']
+    _ARGUMENTS = parse_arguments()
+    _OPENAI_KEY = _ARGUMENTS['openai_api_key']
+    _SERVICE_URL = _ARGUMENTS["service_url"]
+    if _SERVICE_URL is None:
+        if _OPENAI_KEY is None:
+            st.error("Pass --openai_api_key, or --service_url to use the search service")
+            return
+        warm_up_backend(
+            _ARGUMENTS["vector_store"],
+            _ARGUMENTS["hybrid"],
+            _ARGUMENTS["rerank_model"] if "cross_encoder" in (_ARGUMENTS["rerank"] or []) else None,
+        )
 
     txt = f'<p style="font-size: 60px" align="left"> Article search engine </p>'
     st.markdown(txt, unsafe_allow_html=True)
@@ -24,6 +45,24 @@ def search_engine():
         "number of search results", min_value=1, max_value=16384, value=5
     )
 
+    # optional filters, pushed down into the vector search
+    filters = {}
+    with st.expander("Filters"):
+        if st.checkbox("Filter by publish date"):
+            published = st.date_input("published between", value=[])
+            if len(published) == 2:
+                filters["publish_time"] = {
+                    ">=": published[0].isoformat(),
+                    "<=": published[1].isoformat(),
+                }
+        for field in ["journal", "source", "license"]:
+            values = st.text_input(f"{field} (comma separated, any of)")
+            if values.strip():
+                filters[field] = [value.strip() for value in values.split(",") if value.strip()]
+
+    # list the articles right away, the answer is generated on demand
+    search_only = st.checkbox("Search only (generate the answer on demand)")
+
     if query:
         txt = f'<p style="font-style:italic;color:gray;">Showing top {no_of_results} related articles</p>'
         st.markdown(txt, unsafe_allow_html=True)
@@ -32,12 +71,47 @@ def search_engine():
             "no_of_results": no_of_results,
             "openai_api_key": _OPENAI_KEY, 
             "model_name": "text-embedding-ada-002",  # hardcoding this for now
+            "stream": True,
+            "vector_store": _ARGUMENTS["vector_store"],
+            "metadata_store": _ARGUMENTS["metadata_store"],
+            "passages": _ARGUMENTS["passages"],
+            "hybrid": _ARGUMENTS["hybrid"],
+            "context_tokens": _ARGUMENTS["context_tokens"],
+            "rerank": _ARGUMENTS["rerank"],
+            "rerank_depth": _ARGUMENTS["rerank_depth"],
+            "rerank_budget_ms": _ARGUMENTS["rerank_budget_ms"],
+            "rerank_model": _ARGUMENTS["rerank_model"],
+            "filters": filters,
         }
 
+        if search_only:
+            with st.spinner("Searching..."):
+                if _SERVICE_URL is not None:
+                    results = get_service_search_results(_SERVICE_URL, search_param=search_param)
+                else:
+                    results = get_search_results(search_param=search_param)
+            for result in results:
+                st.markdown(
+                    f"{result['rank'] + 1}. [{result['title']}]({result['url']}) "
+                    f"<span style=\"color:gray;\">{result['distance']:.4f}</span>",
+                    unsafe_allow_html=True,
+                )
+            # reuses the cached search results of the same query
+            if not st.button("Generate answer"):
+                return
+
         with st.spinner("Searching..."):
-            response = get_response(search_param=search_param)
+            if _SERVICE_URL is not None:
+                chunks = get_service_response(_SERVICE_URL, search_param=search_param)
+            else:
+                chunks = get_response(search_param=search_param)
 
-            st.write(response)
+        # render the response progressively as the model generates it
+        placeholder = st.empty()
+        response = ""
+        for chunk in chunks:
+            response += chunk
+            placeholder.markdown(response)
 
 
 page_names_to_funcs = {
@@ -0,0 +1,449 @@
+"""
+This script serves the search system over HTTP, separately from the
+streamlit UI, so that search can be scaled out on its own:
+  - POST /search  ranked articles for a query (retrieval only)
+  - POST /answer  the model's response for a query (RAG), streamed
+                  as plain text chunks if "stream" is true
+  - GET  /metrics per-stage latency histograms, request counters and
+                  query cache hit rates, in the Prometheus text format
+  - GET  /health  liveness, and whether warm up succeeded
+
+Every worker process warms up its connections and the collection at
+startup. The metrics are those of the process that serves the scrape, so
+/metrics needs a single worker: scale out with more replicas (one scrape
+target each), or pass --no_metrics to run several workers. At most
+--max_concurrency requests are processed at once per worker, up to
+--max_queue more wait for a slot (at most --queue_timeout seconds), and
+the rest are rejected with a 503 so that clients can back off or go to
+another replica.
+
+$ python api/service.py --openai_api_key "<enter key here>"
+
+"""
+
+import asyncio
+import json
+import os
+import time
+from typing import Optional
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+
+from src.filters.helpers import normalize_filters
+from src.tasks.inference import (
+    inference,
+    query_cache_metrics,
+    search,
+    stage_metrics,
+    warm_up,
+)
+
+# settings of the worker processes, passed by the parent process
+# (see the bottom of this file)
+_CONFIG = {
+    "openai_api_key": os.environ.get("OPENAI_API_KEY"),
+    "model_name": "text-embedding-ada-002",
+    "vector_store": "milvus",
+    "metadata_store": "postgres",
+    "passages": False,
+    "hybrid": False,
+    "rerank": None,
+    "rerank_depth": 50,
+    "rerank_budget_ms": 200,
+    "rerank_model": "cross-encoder/ms-marco-MiniLM-L-6-v2",
+    "max_concurrency": 16,
+    "max_queue": 64,
+    "queue_timeout": 10.0,
+    "no_metrics": False,
+    **json.loads(os.environ.get("RAG_SERVICE_CONFIG", "{}")),
+}
+
+
+class SearchRequest(BaseModel):
+    query: str
+    # milvus search limit - 16384
+    no_of_results: int = Field(10, ge=1, le=16384)
+    filters: Optional[dict] = None
+    hybrid: Optional[bool] = None
+
+
+class AnswerRequest(SearchRequest):
+    stream: bool = False
+    context_tokens: Optional[int] = Field(None, ge=1)
+
+
+class AdmissionControl:
+    """
+    Bounds the number of requests processed at once, and the number
+    waiting for a slot. Requests beyond both limits, or that wait
+    longer than queue_timeout seconds, are rejected.
+
+    Arguments
+    ----------
+    max_concurrency : int
+        requests processed at once
+    max_queue : int
+        requests waiting for a slot
+    queue_timeout : float
+        seconds a request waits for a slot
+    """
+
+    def __init__(self, max_concurrency, max_queue, queue_timeout):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        # created in the event loop of the server (see startup())
+        self._semaphore = None
+        self.waiting = self.in_flight = self.rejected = 0
+
+    def start(self):
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def acquire(self):
+        """
+        Wait for a slot, raises a 503 if the queue is full or the wait too long
+        """
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503, detail="Too many requests", headers={"Retry-After": "1"}
+            )
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503, detail="Timed out waiting for a slot", headers={"Retry-After": "1"}
+            )
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+
+app = FastAPI(title="RAG search")
+admission = AdmissionControl(
+    _CONFIG["max_concurrency"], _CONFIG["max_queue"], _CONFIG["queue_timeout"]
+)
+# request counts, by endpoint and status
+_REQUESTS = {}
+_WARMED_UP = {"ok": False}
+
+
+def _count(endpoint, status):
+    _REQUESTS[(endpoint, status)] = _REQUESTS.get((endpoint, status), 0) + 1
+
+
+def _arguments(request):
+    """
+    The inference() arguments of a request
+    """
+    try:
+        normalize_filters(request.filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    arguments = {
+        "query": request.query,
+        "no_of_results": request.no_of_results,
+        "filters": request.filters,
+        "model_name": _CONFIG["model_name"],
+        "openai_api_key": _CONFIG["openai_api_key"],
+        "vector_store": _CONFIG["vector_store"],
+        "metadata_store": _CONFIG["metadata_store"],
+        "passages": _CONFIG["passages"],
+        "hybrid": _CONFIG["hybrid"] if request.hybrid is None else request.hybrid,
+        "rerank": _CONFIG["rerank"],
+        "rerank_depth": _CONFIG["rerank_depth"],
+        "rerank_budget_ms": _CONFIG["rerank_budget_ms"],
+        "rerank_model": _CONFIG["rerank_model"],
+    }
+    if _CONFIG.get("trace_sinks") is not None:
+        arguments["trace_sinks"] = _CONFIG["trace_sinks"]
+    return arguments
+
+
+@app.on_event("startup")
+async def startup():
+    admission.start()
+    try:
+        await run_in_threadpool(
+            warm_up,
+            vector_store=_CONFIG["vector_store"],
+            hybrid=_CONFIG["hybrid"],
+            rerank_model=_CONFIG["rerank_model"]
+            if "cross_encoder" in (_CONFIG["rerank"] or [])
+            else None,
+        )
+        _WARMED_UP["ok"] = True
+    except Exception as e:
+        # connections are opened by the first request instead
+        print("Failed to warm up, continuing")
+        print(e)
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "warmed_up": _WARMED_UP["ok"]}
+
+
+@app.post("/search")
+async def search_endpoint(request: SearchRequest):
+    arguments = _arguments(request)
+    await admission.acquire()
+    start = time.perf_counter()
+    try:
+        results = await run_in_threadpool(search, arguments)
+    except Exception as e:
+        _count("/search", 500)
+        print("Failed to search")
+        print(e)
+        raise HTTPException(status_code=500, detail="Search failed")
+    finally:
+        admission.release()
+    _count("/search", 200)
+    return {
+        "query": request.query,
+        "results": [{"rank": rank, **result} for rank, result in sorted(results.items())],
+        "took_ms": round((time.perf_counter() - start) * 1000, 3),
+    }
+
+
+@app.post("/answer")
+async def answer_endpoint(request: AnswerRequest):
+    arguments = _arguments(request)
+    arguments["stream"] = request.stream
+    if request.context_tokens is not None:
+        arguments["context_tokens"] = request.context_tokens
+    await admission.acquire()
+    start = time.perf_counter()
+    try:
+        response = await run_in_threadpool(inference, arguments)
+    except Exception as e:
+        admission.release()
+        _count("/answer", 500)
+        print("Failed to answer")
+        print(e)
+        raise HTTPException(status_code=500, detail="Answer failed")
+
+    if not request.stream:
+        admission.release()
+        _count("/answer", 200)
+        return {
+            "query": request.query,
+            "response": response,
+            "took_ms": round((time.perf_counter() - start) * 1000, 3),
+        }
+
+    async def chunks():
+        # the slot is held until the whole response is sent
+        try:
+            async for chunk in iterate_in_threadpool(response):
+                yield chunk
+        finally:
+            admission.release()
+
+    _count("/answer", 200)
+    return StreamingResponse(chunks(), media_type="text/plain; charset=utf-8")
+
+
+@app.get("/metrics")
+async def metrics():
+    if _CONFIG["no_metrics"]:
+        raise HTTPException(status_code=404, detail="Metrics are disabled (--no_metrics)")
+    lines = [
+        "# HELP rag_service_requests_total Requests served, by endpoint and status",
+        "# TYPE rag_service_requests_total counter",
+    ]
+    for (endpoint, status), count in sorted(_REQUESTS.items()):
+        lines.append(
+            f'rag_service_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}'
+        )
+    lines += [
+        "# HELP rag_service_rejected_total Requests rejected by admission control",
+        "# TYPE rag_service_rejected_total counter",
+        f"rag_service_rejected_total {admission.rejected}",
+        "# HELP rag_service_in_flight Requests being processed",
+        "# TYPE rag_service_in_flight gauge",
+        f"rag_service_in_flight {admission.in_flight}",
+        "# HELP rag_service_waiting Requests waiting for a slot",
+        "# TYPE rag_service_waiting gauge",
+        f"rag_service_waiting {admission.waiting}",
+    ]
+    cache = query_cache_metrics()
+    if cache is not None:
+        lines += [
+            "# HELP rag_query_cache_hits_total Query cache hits, by tier",
+            "# TYPE rag_query_cache_hits_total counter",
+        ]
+        lines += [
+            f'rag_query_cache_hits_total{{tier="{tier}"}} {cache[tier]["hits"]}'
+            for tier in ["exact", "semantic"]
+        ]
+        lines += [
+            "# HELP rag_query_cache_lookups_total Query cache lookups, by tier",
+            "# TYPE rag_query_cache_lookups_total counter",
+        ]
+        lines += [
+            f'rag_query_cache_lookups_total{{tier="{tier}"}} {cache[tier]["lookups"]}'
+            for tier in ["exact", "semantic"]
+        ]
+    return PlainTextResponse(
+        "\n".join(lines) + "\n" + stage_metrics(exposition=True),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
+@app.exception_handler(HTTPException)
+async def http_exception_handler(request, exc):
+    if exc.status_code != 500:
+        _count(request.url.path, exc.status_code)
+    return JSONResponse(
+        {"detail": exc.detail}, status_code=exc.status_code, headers=exc.headers
+    )
+
+
+def parse_arguments():
+    """
+    Use this function to pass the OpenAI api key, the settings of
+    the search system (as at build time) and of the server
+
+    Returns
+    -------
+    args : dict
+        a dict contaning service paramters
+
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--openai_api_key",
+        type=str,
+        default=os.environ.get("OPENAI_API_KEY"),
+        help="enter your OpenAI api key (default: $OPENAI_API_KEY)",
+    )
+    parser.add_argument(
+        "--model_name",
+        type=str,
+        default="text-embedding-ada-002",
+        help="name of the embedding model (the one used at build time)",
+    )
+    parser.add_argument(
+        "--vector_store",
+        type=str,
+        default="milvus",
+        choices=["milvus", "local"],
+        help="where vectors are searched: a milvus server or in-process",
+    )
+    parser.add_argument(
+        "--metadata_store",
+        type=str,
+        default="postgres",
+        choices=["postgres", "vector_store"],
+        help="read result metadata from postgres or from the vector store (must match the build)",
+    )
+    parser.add_argument(
+        "--passages",
+        action="store_true",
+        help="the index holds passages (built with --passages)",
+    )
+    parser.add_argument(
+        "--hybrid",
+        action="store_true",
+        help="fuse BM25 and vector search results, unless a request says otherwise",
+    )
+    parser.add_argument(
+        "--rerank",
+        type=str,
+        nargs="+",
+        default=None,
+        choices=["exact", "cross_encoder"],
+        help="rescore more candidates than asked for: exactly on the stored vectors and/or with a local cross-encoder",
+    )
+    parser.add_argument(
+        "--rerank_depth",
+        type=int,
+        default=50,
+        help="number of candidates fetched for reranking",
+    )
+    parser.add_argument(
+        "--rerank_budget_ms",
+        type=float,
+        default=200,
+        help="milliseconds the cross-encoder may spend per query",
+    )
+    parser.add_argument(
+        "--rerank_model",
+        type=str,
+        default="cross-encoder/ms-marco-MiniLM-L-6-v2",
+        help="sentence-transformers cross-encoder used by --rerank cross_encoder",
+    )
+    parser.add_argument(
+        "--trace_sinks",
+        type=str,
+        nargs="+",
+        default=None,
+        help="where to send per-stage timings: logging, otel, jsonl:<path> or prometheus:<path>",
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of worker processes, more than 1 needs --no_metrics",
+    )
+    parser.add_argument(
+        "--no_metrics",
+        action="store_true",
+        help="disable /metrics, whose numbers are per worker process",
+    )
+    parser.add_argument(
+        "--max_concurrency",
+        type=int,
+        default=16,
+        help="requests processed at once, per worker",
+    )
+    parser.add_argument(
+        "--max_queue",
+        type=int,
+        default=64,
+        help="requests waiting for a slot, per worker, before new ones get a 503",
+    )
+    parser.add_argument(
+        "--queue_timeout",
+        type=float,
+        default=10.0,
+        help="seconds a request waits for a slot before it gets a 503",
+    )
+    args = parser.parse_args()
+    if args.workers > 1 and not args.no_metrics:
+        # each scrape would only see the worker that answered it
+        parser.error(
+            "/metrics reports the numbers of one worker process: run a single "
+            "worker per replica, or pass --no_metrics with --workers > 1"
+        )
+    return vars(args)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    arguments = parse_arguments()
+    server = {name: arguments.pop(name) for name in ["host", "port", "workers"]}
+    # worker processes import this module again, and read their settings from here
+    os.environ["RAG_SERVICE_CONFIG"] = json.dumps(arguments)
+    uvicorn.run(
+        "service:app",
+        app_dir=os.path.dirname(os.path.abspath(__file__)),
+        host=server["host"],
+        port=server["port"],
+        workers=server["workers"],
+    )
@@ -1,4 +1,4 @@
-from src.tasks.inference import inference
+from src.tasks.inference import inference, warm_up
 
 
 def get_response(search_param):
@@ -10,10 +10,11 @@ def get_response(search_param):
       search_param : dict
           a dict contaning search arguments
           such as query, no_of_results, openai_api_key
+          (and "stream" to get the response chunk by chunk)
 
     Returns
       -------
-      result : str
+      result : str or generator(str)
           the model's response to the query
 
     """
@@ -21,16 +22,133 @@ def get_response(search_param):
     return results
 
 
+def get_search_results(search_param):
+    """
+    This function calls the inference api without
+    generating a response
+
+    Parameters
+      ----------
+      search_param : dict
+          a dict contaning search arguments
+          such as query, no_of_results, openai_api_key
+
+    Returns
+      -------
+      results : list(dict)
+          the ranked articles: [{"rank": 0, "id": 0,
+          "distance": 0.0, "title": "", "url": ""}]
+
+    """
+    results = inference({**search_param, "retrieval_only": True})
+    return [{"rank": rank, **value} for rank, value in sorted(results.items())]
+
+
+def get_service_search_results(service_url, search_param):
+    """
+    This function calls the /search endpoint of the
+    search service (see api/service.py)
+
+    Parameters
+      ----------
+      service_url : str
+          base url of the service, eg: http://localhost:8000
+      search_param : dict
+          a dict contaning search arguments
+          such as query, no_of_results, filters
+
+    Returns
+      -------
+      results : list(dict)
+          the ranked articles, as get_search_results()
+
+    """
+    import requests
+
+    body = {
+        name: search_param[name]
+        for name in ["query", "no_of_results", "filters", "hybrid"]
+        if search_param.get(name) is not None
+    }
+    response = requests.post(
+        service_url.rstrip("/") + "/search", json=body, timeout=(5, 60)
+    )
+    response.raise_for_status()
+    return response.json()["results"]
+
+
+def get_service_response(service_url, search_param):
+    """
+    This function calls the /answer endpoint of the
+    search service (see api/service.py)
+
+    Parameters
+      ----------
+      service_url : str
+          base url of the service, eg: http://localhost:8000
+      search_param : dict
+          a dict contaning search arguments
+          such as query, no_of_results, filters
+
+    Returns
+      -------
+      result : generator(str)
+          the model's response to the query, chunk by chunk
+
+    """
+    import requests
+
+    body = {
+        name: search_param[name]
+        for name in ["query", "no_of_results", "filters", "hybrid", "context_tokens"]
+        if search_param.get(name) is not None
+    }
+    with requests.post(
+        service_url.rstrip("/") + "/answer",
+        json={**body, "stream": True},
+        stream=True,
+        timeout=(5, 300),
+    ) as response:
+        if response.status_code == 503:
+            yield "The search service is busy, please try again in a moment."
+            return
+        response.raise_for_status()
+        response.encoding = "utf-8"
+        for chunk in response.iter_content(chunk_size=None, decode_unicode=True):
+            yield chunk
+
+
+
+def warm_up_backend(vector_store="milvus", hybrid=False, rerank_model=None):
+    """
+    This function opens the milvus and postgres connections
+    and loads the collection (and the lexical index, for hybrid
+    search, and the cross-encoder, for reranking) ahead of the
+    first search
+    """
+    warm_up(vector_store=vector_store, hybrid=hybrid, rerank_model=rerank_model)
+
 
 def parse_arguments():
     """
-    Use this function to pass OpenAI api key
+    Use this function to pass OpenAI api key, or
+    the url of the search service
 
     Returns
     -------
     args : dict
         a dict contaning search paramters
-        { "openai_api_key":  "<enter key here>" }
+        { "openai_api_key":  "<enter key here>",
+          "vector_store":  "milvus",
+          "metadata_store":  "postgres",
+          "passages":  False,
+          "hybrid":  False,
+          "context_tokens":  3000,
+          "rerank":  None,
+          "rerank_depth":  50,
+          "rerank_budget_ms":  200,
+          "rerank_model":  "cross-encoder/ms-marco-MiniLM-L-6-v2",
+          "service_url":  None }
 
     """
     import argparse
@@ -39,8 +157,70 @@ def parse_arguments():
     parser.add_argument(
         "--openai_api_key",
         type=str,
-        required=True,
-        help="enter your OpenAI api key"
+        default=None,
+        help="enter your OpenAI api key (not needed with --service_url)"
+    )
+    parser.add_argument(
+        "--vector_store",
+        type=str,
+        default="milvus",
+        choices=["milvus", "local"],
+        help="where vectors are searched: a milvus server or in-process",
+    )
+    parser.add_argument(
+        "--metadata_store",
+        type=str,
+        default="postgres",
+        choices=["postgres", "vector_store"],
+        help="read result metadata from postgres or from the vector store (must match the build)",
+    )
+    parser.add_argument(
+        "--passages",
+        action="store_true",
+        help="the index holds passages (built with --passages)",
+    )
+    parser.add_argument(
+        "--hybrid",
+        action="store_true",
+        help="fuse BM25 and vector search results",
+    )
+    parser.add_argument(
+        "--context_tokens",
+        type=int,
+        default=3000,
+        help="token budget of the search results in the prompt, whatever the number of results",
+    )
+    parser.add_argument(
+        "--rerank",
+        type=str,
+        nargs="+",
+        default=None,
+        choices=["exact", "cross_encoder"],
+        help="rescore more candidates than asked for: exactly on the stored vectors and/or with a local cross-encoder",
+    )
+    parser.add_argument(
+        "--rerank_depth",
+        type=int,
+        default=50,
+        help="number of candidates fetched for reranking",
+    )
+    parser.add_argument(
+        "--rerank_budget_ms",
+        type=float,
+        default=200,
+        help="milliseconds the cross-encoder may spend per query",
+    )
+    parser.add_argument(
+        "--rerank_model",
+        type=str,
+        default="cross-encoder/ms-marco-MiniLM-L-6-v2",
+        help="sentence-transformers cross-encoder used by --rerank cross_encoder",
+    )
+    parser.add_argument(
+        "--service_url",
+        type=str,
+        default=None,
+        help="url of the search service (api/service.py) to send queries to, instead of searching in-process",
     )
     args = parser.parse_args()
 
@@ -0,0 +1,145 @@
+"""
+Use this module to benchmark the asyncio inference pipeline against
+local fakes of OpenAI, Milvus and Postgres (no servers or api key needed).
+Each fake stage only waits for its configured latency, so the numbers
+measure how well the pipeline overlaps concurrent queries and how much
+cpu it spends per query.
+
+$ python cli/benchmark_inference.py --queries 2000 --concurrency 64
+
+"""
+
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+from src.tasks.async_inference import InferenceStages, async_inference
+
+
+class FakeStages(InferenceStages):
+    """
+    Inference stages that sleep instead of calling remote services.
+    Blocking stages (milvus, postgres) sleep in a worker thread, like
+    the real ones do.
+    """
+
+    def __init__(self, latencies, k):
+        super().__init__(openai_api_key="fake", model_name="fake")
+        self.latencies = latencies
+        self.k = k
+
+    async def prepare(self):
+        return None
+
+    async def embed(self, query):
+        await asyncio.sleep(self.latencies["embed"])
+        return [0.0] * 1536
+
+    async def search(self, query_embedding, k, filters=None):
+        await asyncio.to_thread(time.sleep, self.latencies["search"])
+        return [SimpleNamespace(id=i, distance=1.0 / (i + 1)) for i in range(k)]
+
+    async def fetch(self, milvus_results):
+        await asyncio.to_thread(time.sleep, self.latencies["fetch"])
+        return {
+            rank: {
+                "title": f"title {result.id}",
+                "abstract": "abstract " * 50,
+                "authors": "authors",
+                "url": f"https://example.org/{result.id}",
+                "id": result.id,
+                "distance": result.distance,
+            }
+            for rank, result in enumerate(milvus_results)
+        }
+
+    async def complete(self, prompt):
+        await asyncio.sleep(self.latencies["complete"])
+        return "fake answer"
+
+
+async def run_benchmark(queries, concurrency, k, latencies):
+    """
+    Run the given number of queries with at most
+    concurrency of them in flight, and return the
+    throughput measurements
+    """
+    stages = FakeStages(latencies=latencies, k=k)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one_query(i):
+        async with semaphore:
+            await async_inference(
+                {"query": f"query {i}", "no_of_results": k}, stages=stages
+            )
+
+    start_time, start_cpu = time.perf_counter(), time.process_time()
+    await asyncio.gather(*(one_query(i) for i in range(queries)))
+    seconds = time.perf_counter() - start_time
+    cpu_seconds = time.process_time() - start_cpu
+
+    return {
+        "queries": queries,
+        "concurrency": concurrency,
+        "no_of_results": k,
+        "latencies": latencies,
+        "seconds": round(seconds, 3),
+        "queries_per_second": round(queries / seconds, 1),
+        "cpu_seconds": round(cpu_seconds, 3),
+        "queries_per_cpu_second": round(queries / cpu_seconds, 1) if cpu_seconds else None,
+    }
+
+
+def parse_arguments():
+    """
+    Use this function to pass the number of queries, the
+    concurrency and the latency of every fake stage
+
+    Returns
+    -------
+    args : dict
+        a dict contaning benchmark paramters
+
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=int, default=1000, help="number of queries")
+    parser.add_argument(
+        "--concurrency", type=int, default=32, help="queries in flight at once"
+    )
+    parser.add_argument(
+        "--no_of_results", type=int, default=10, help="number of search results"
+    )
+    for stage, default in [
+        ("embed", 0.05),
+        ("search", 0.01),
+        ("fetch", 0.005),
+        ("complete", 0.5),
+    ]:
+        parser.add_argument(
+            f"--{stage}_latency",
+            type=float,
+            default=default,
+            help=f"seconds spent in the fake {stage} stage",
+        )
+    args = parser.parse_args()
+    return vars(args)
+
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+    latencies = {
+        stage: arguments[f"{stage}_latency"]
+        for stage in ["embed", "search", "fetch", "complete"]
+    }
+    results = asyncio.run(
+        run_benchmark(
+            queries=arguments["queries"],
+            concurrency=arguments["concurrency"],
+            k=arguments["no_of_results"],
+            latencies=latencies,
+        )
+    )
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,135 @@
+"""
+Use this module to compare the latency of the two metadata layouts
+for the k values you serve:
+  - postgres: vector search, then a postgres lookup of the top-k ids
+  - vector_store: a single search that returns the metadata of the
+    hits from the vector store (single-store mode)
+
+Both are timed against the same collection, which must have been
+built with --metadata_store vector_store (postgres is always loaded).
+
+$ python cli/benchmark_metadata.py --model_name "text-embedding-ada-002" --openai_api_key "<enter key here>" --no_of_results 5 10 50
+
+"""
+
+import json
+import time
+
+from src.benchmark.helpers import latency_summary
+from src.model.helpers import embed_query
+from src.postgres.helpers import postgres_fetch_metadata
+from src.vectorstore.helpers import (
+    PAYLOAD_FIELDS,
+    get_vector_store,
+    search_results_metadata,
+)
+
+# queries embedded once, before timing
+_QUERIES = [
+    "effect of face coverings for covid",
+    "incubation period of sars-cov-2",
+    "vaccine efficacy against new variants",
+    "transmission of coronavirus in schools",
+    "long term symptoms after covid infection",
+    "antiviral treatment for hospitalized patients",
+    "asymptomatic spread of the virus",
+    "mortality risk factors in the elderly",
+]
+
+
+def parse_arguments():
+    """
+    Use this function to pass the embedding model,
+    the vector store and the k values to benchmark
+
+    Returns
+    -------
+    args : dict
+        a dict contaning benchmark paramters
+
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model_name",
+        type=str,
+        required=True,
+        help="name of the embedding model (the one used at build time)",
+    )
+    parser.add_argument(
+        "--openai_api_key", type=str, default=None, help="OpenAI api key, for OpenAI models"
+    )
+    parser.add_argument(
+        "--vector_store",
+        type=str,
+        default="milvus",
+        choices=["milvus", "local"],
+        help="where vectors are stored and searched: a milvus server or in-process",
+    )
+    parser.add_argument(
+        "--no_of_results",
+        type=int,
+        nargs="+",
+        default=[5, 10, 20, 50],
+        help="k values to benchmark",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=50, help="timed searches per query and k"
+    )
+    args = parser.parse_args()
+    return vars(args)
+
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+    _COLLECTION_NAME = "rag_search"
+    _SEARCH_PARAM = {"metric_type": "IP", "params": {"nprobe": 128}}
+
+    vector_store = get_vector_store(
+        backend=arguments["vector_store"], collection_name=_COLLECTION_NAME
+    )
+    vector_store.load()
+    query_embeddings = [
+        embed_query(
+            openai_api_key=arguments["openai_api_key"],
+            query=query,
+            model_name=arguments["model_name"],
+        )
+        for query in _QUERIES
+    ]
+
+    def postgres_layout(query_embedding, k):
+        hits = vector_store.search(
+            query_embedding=query_embedding, search_params=_SEARCH_PARAM, k=k
+        )
+        return postgres_fetch_metadata(milvus_results=hits, table_name=_COLLECTION_NAME)
+
+    def vector_store_layout(query_embedding, k):
+        hits = vector_store.search(
+            query_embedding=query_embedding,
+            search_params=_SEARCH_PARAM,
+            k=k,
+            output_fields=PAYLOAD_FIELDS,
+        )
+        return search_results_metadata(hits)
+
+    results = []
+    for k in arguments["no_of_results"]:
+        for layout, fetch in [
+            ("postgres", postgres_layout),
+            ("vector_store", vector_store_layout),
+        ]:
+            # untimed warm-up
+            for query_embedding in query_embeddings:
+                fetch(query_embedding, k)
+
+            latencies = []
+            for _ in range(arguments["repeat"]):
+                for query_embedding in query_embeddings:
+                    start = time.perf_counter()
+                    fetch(query_embedding, k)
+                    latencies.append(time.perf_counter() - start)
+            results.append({"metadata_store": layout, "k": k, **latency_summary(latencies)})
+
+    print(json.dumps(results, indent=2))
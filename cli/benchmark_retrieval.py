@@ -0,0 +1,169 @@
+"""
+Use this module to measure how index and search parameters trade
+recall against latency, before shipping them in the build and
+inference configs. A corpus of vectors and a query set are generated
+(or loaded from .npy files), the exact top-k of every query is computed
+with brute-force numpy, then every index type is built and searched with
+every nprobe (IVF_*) or ef (HNSW) value. recall@k, p50/p95/p99 latency
+and QPS are written as json or csv.
+
+By default the indexes are built in the local vector store, in a
+temporary folder, so no server is needed. Pass --vector_store milvus to
+benchmark a running milvus server instead (in a separate collection).
+
+$ python cli/benchmark_retrieval.py --no_of_vectors 200000 --dim 256 --nprobe 16 64 128 --output results.csv
+
+"""
+
+import tempfile
+
+from src.benchmark.helpers import (
+    load_vectors,
+    run_sweep,
+    sample_queries,
+    synthetic_corpus,
+    write_results,
+)
+from src.vectorstore.helpers import LocalVectorStore, MilvusVectorStore
+
+
+def parse_arguments():
+    """
+    Use this function to pass the corpus, the index types and
+    the search parameter values to benchmark
+
+    Returns
+    -------
+    args : dict
+        a dict contaning benchmark paramters
+
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--vector_store",
+        type=str,
+        default="local",
+        choices=["local", "milvus"],
+        help="vector store the indexes are built in",
+    )
+    parser.add_argument(
+        "--corpus", type=str, default=None, help="optional .npy file of corpus vectors"
+    )
+    parser.add_argument(
+        "--queries", type=str, default=None, help="optional .npy file of query vectors"
+    )
+    parser.add_argument(
+        "--no_of_vectors", type=int, default=100000, help="size of a generated corpus"
+    )
+    parser.add_argument(
+        "--dim", type=int, default=256, help="dimension of a generated corpus"
+    )
+    parser.add_argument(
+        "--no_of_queries", type=int, default=1000, help="number of generated queries"
+    )
+    parser.add_argument(
+        "--no_of_results", type=int, default=10, help="k, for recall@k"
+    )
+    parser.add_argument(
+        "--metric_type", type=str, default="IP", choices=["IP", "L2"], help="metric"
+    )
+    parser.add_argument(
+        "--index_types",
+        type=str,
+        nargs="+",
+        default=["FLAT", "IVF_FLAT", "IVF_SQ8"],
+        help="index types to build, eg: FLAT IVF_FLAT IVF_SQ8 HNSW (milvus only)",
+    )
+    parser.add_argument(
+        "--nlist", type=int, default=4096, help="nlist of IVF_* indexes"
+    )
+    parser.add_argument(
+        "--nprobe",
+        type=int,
+        nargs="+",
+        default=[8, 16, 32, 64, 128],
+        help="nprobe values searched on IVF_* indexes",
+    )
+    parser.add_argument(
+        "--hnsw_m", type=int, default=16, help="M of HNSW indexes"
+    )
+    parser.add_argument(
+        "--ef",
+        type=int,
+        nargs="+",
+        default=[16, 64, 128, 256],
+        help="ef values searched on HNSW indexes",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="retrieval_benchmark.json",
+        help="results file, csv if it ends with .csv, json otherwise",
+    )
+    args = parser.parse_args()
+    return vars(args)
+
+
+def index_param(index_type, arguments):
+    """
+    Index parameters of an index type, in milvus' format
+    """
+    params = {}
+    if index_type.startswith("IVF"):
+        params = {"nlist": arguments["nlist"]}
+    elif index_type == "HNSW":
+        params = {"M": arguments["hnsw_m"], "efConstruction": max(arguments["ef"])}
+    return {
+        "metric_type": arguments["metric_type"],
+        "index_type": index_type,
+        "params": params,
+    }
+
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+
+    if arguments["corpus"]:
+        corpus = load_vectors(arguments["corpus"])
+        if arguments["queries"]:
+            queries = load_vectors(arguments["queries"])
+        else:
+            queries = sample_queries(corpus, arguments["no_of_queries"])
+    else:
+        corpus, queries = synthetic_corpus(
+            no_of_vectors=arguments["no_of_vectors"],
+            dim=arguments["dim"],
+            no_of_queries=arguments["no_of_queries"],
+        )
+    print(f"Benchmarking {len(queries)} queries against {len(corpus)} vectors\n")
+
+    index_types = arguments["index_types"]
+    if arguments["vector_store"] == "local":
+        unsupported = [name for name in index_types if name != "FLAT" and not name.startswith("IVF")]
+        if unsupported:
+            print(f"The local vector store has no {unsupported} index, skipping them\n")
+        index_types = [name for name in index_types if name not in unsupported]
+        if any(name in ("IVF_SQ8", "IVF_PQ") for name in index_types):
+            print("Note: the local vector store does not quantize, IVF_SQ8 and IVF_PQ are searched as IVF_FLAT\n")
+
+    with tempfile.TemporaryDirectory() as artifacts_dir:
+
+        def vector_store_factory(index_type):
+            collection_name = "benchmark_" + index_type.lower()
+            if arguments["vector_store"] == "local":
+                return LocalVectorStore(collection_name, artifacts_dir=artifacts_dir)
+            return MilvusVectorStore(collection_name)
+
+        rows = run_sweep(
+            vector_store_factory=vector_store_factory,
+            corpus=corpus,
+            queries=queries,
+            k=arguments["no_of_results"],
+            index_params=[index_param(name, arguments) for name in index_types],
+            sweep_values={"nprobe": arguments["nprobe"], "ef": arguments["ef"]},
+            metric_type=arguments["metric_type"],
+        )
+
+    write_results(rows, arguments["output"])
@@ -7,6 +7,10 @@ The setup includes:
   - ingesting embeddings to milvus
   - ingesting metadata to postgres
 
+Each stage is checkpointed under data/artifacts/, pass --resume to
+continue an interrupted build from where it stopped. Pass --incremental
+to update an existing index with only the documents that changed.
+
 Note: be sure to use this script *after* starting your Milvus & Postgres servers
 
 $ python cli/build.py --data_path "/abs/path/to/data.csv" --model_name "text-embedding-ada-002" --openai_api_key "<enter key here>"
@@ -43,13 +47,114 @@ def parse_arguments():
         "--model_name",
         type=str,
         required=True,
-        help="name of the nlp model for embeddings generation",
+        help="name of the embedding model: an OpenAI model, hashing-<dim> or local:<sentence-transformers model>",
     )
     parser.add_argument(
         "--openai_api_key",
         type=str,
-        required=True,
-        help="enter your OpenAI api key"
+        default=None,
+        help="enter your OpenAI api key (not needed for hashing or local models)"
+    )
+    parser.add_argument(
+        "--openai_base_url",
+        type=str,
+        default=None,
+        help="optional OpenAI-compatible endpoint, eg: a local fake server",
+    )
+    parser.add_argument(
+        "--embedding_batch_size",
+        type=int,
+        default=256,
+        help="maximum number of texts per embeddings request",
+    )
+    parser.add_argument(
+        "--embedding_max_batch_tokens",
+        type=int,
+        default=100000,
+        help="approximate maximum number of tokens per embeddings request",
+    )
+    parser.add_argument(
+        "--embedding_workers",
+        type=int,
+        default=8,
+        help="number of embeddings requests in flight at once",
+    )
+    parser.add_argument(
+        "--shard_size",
+        type=int,
+        default=10000,
+        help="number of csv rows read, embedded and inserted per checkpointed shard",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip finished shards of an interrupted build and continue from there",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only embed and upsert new or changed documents, and delete removed ones",
+    )
+    parser.add_argument(
+        "--vector_store",
+        type=str,
+        default="milvus",
+        choices=["milvus", "local"],
+        help="where vectors are stored and searched: a milvus server or in-process",
+    )
+    parser.add_argument(
+        "--embedding_cache",
+        type=str,
+        default="data/artifacts/embedding_cache.sqlite",
+        help="path to the embedding cache shared by build and inference",
+    )
+    parser.add_argument(
+        "--no_embedding_cache",
+        action="store_true",
+        help="always call the embedding model, bypassing the cache",
+    )
+    parser.add_argument(
+        "--trace_sinks",
+        type=str,
+        nargs="+",
+        default=None,
+        help="where to send per-stage timings: logging, otel, jsonl:<path> or prometheus:<path>",
+    )
+    parser.add_argument(
+        "--metadata_store",
+        type=str,
+        default="postgres",
+        choices=["postgres", "vector_store"],
+        help="also keep title, abstract, authors and url in the vector store (vector_store), so inference can skip postgres",
+    )
+    parser.add_argument(
+        "--passages",
+        action="store_true",
+        help="chunk abstracts into overlapping passages and index every passage",
+    )
+    parser.add_argument(
+        "--passage_tokens",
+        type=int,
+        default=256,
+        help="maximum number of tokens per passage, title included",
+    )
+    parser.add_argument(
+        "--passage_overlap",
+        type=int,
+        default=64,
+        help="number of tokens shared by consecutive passages",
+    )
+    parser.add_argument(
+        "--embedding_dtype",
+        type=str,
+        default="float32",
+        choices=["float32", "float16", "int8"],
+        help="storage type of the checkpointed shard embeddings (int8: scalar quantized, 4x smaller)",
+    )
+    parser.add_argument(
+        "--no_lexical_index",
+        action="store_true",
+        help="do not build the BM25 index used by hybrid search",
     )
     args = parser.parse_args()
     return vars(args)
@@ -58,4 +163,8 @@ def parse_arguments():
 if __name__ == "__main__":
 
     arguments = parse_arguments()
+    if "logging" in (arguments["trace_sinks"] or []):
+        import logging
+
+        logging.basicConfig(level=logging.INFO)
     build(arguments=arguments)
@@ -3,7 +3,20 @@ Use this module to perform a search against the RAG system
 
 $ python cli/inference.py --query "effect of face coverings for covid" --no_of_results 10 --model_name "text-embedding-ada-002" --openai_api_key "<enter key here>"
 
+To answer a whole question set (one query per line), written as JSONL:
+
+$ python cli/inference.py --queries_file questions.txt --output answers.jsonl --model_name "text-embedding-ada-002" --openai_api_key "<enter key here>"
+
+To list the ranked articles only, without generating a response:
+
+$ python cli/inference.py --query "effect of face coverings for covid" --retrieval_only --model_name "text-embedding-ada-002" --openai_api_key "<enter key here>"
+
 """
+import json
+import sys
+
+from src.filters.helpers import parse_filter_arguments
+from src.tasks.batch_inference import batch_inference, read_queries
 from src.tasks.inference import inference
 
 
@@ -28,7 +41,13 @@ def parse_arguments():
     import argparse
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--query", type=str, required=True, help=" search query")
+    queries = parser.add_mutually_exclusive_group(required=True)
+    queries.add_argument("--query", type=str, help=" search query")
+    queries.add_argument(
+        "--queries_file",
+        type=str,
+        help="file of queries to answer in batches, one per line (text, or json with a \"query\")",
+    )
     parser.add_argument(
         "--no_of_results",
         type=int,
@@ -39,15 +58,165 @@ def parse_arguments():
         "--model_name",
         type=str,
         required=True,
-        help="name of the nlp model for query embedding",
+        help="name of the embedding model (the one used at build time)",
     )
     parser.add_argument(
         "--openai_api_key", type=str, required=True, help="enter your OpenAI api key"
     )
+    parser.add_argument(
+        "--vector_store",
+        type=str,
+        default="milvus",
+        choices=["milvus", "local"],
+        help="where vectors are stored and searched: a milvus server or in-process",
+    )
+    parser.add_argument(
+        "--embedding_cache",
+        type=str,
+        default="data/artifacts/embedding_cache.sqlite",
+        help="path to the embedding cache shared by build and inference",
+    )
+    parser.add_argument(
+        "--no_embedding_cache",
+        action="store_true",
+        help="always call the embedding model, bypassing the cache",
+    )
+    parser.add_argument(
+        "--no_query_cache",
+        action="store_true",
+        help="do not look up or store responses in the query cache",
+    )
+    parser.add_argument(
+        "--query_cache_similarity",
+        type=float,
+        default=0.97,
+        help="minimum cosine similarity for reusing the response of a similar query",
+    )
+    parser.add_argument(
+        "--no_stream",
+        action="store_true",
+        help="print the response only once it is complete",
+    )
+    parser.add_argument(
+        "--trace_sinks",
+        type=str,
+        nargs="+",
+        default=None,
+        help="where to send per-stage timings: logging, otel, jsonl:<path> or prometheus:<path>",
+    )
+    parser.add_argument(
+        "--metadata_store",
+        type=str,
+        default="postgres",
+        choices=["postgres", "vector_store"],
+        help="read result metadata from postgres or from the vector store (must match the build)",
+    )
+    parser.add_argument(
+        "--filter",
+        type=str,
+        action="append",
+        default=None,
+        help="only search documents that match, repeatable: "
+        "publish_time>=2021-01-01, journal=Lancet, source=PMC,Medline (any of), license=cc-by",
+    )
+    parser.add_argument(
+        "--passages",
+        action="store_true",
+        help="the index holds passages (built with --passages), collapse the hits to documents",
+    )
+    parser.add_argument(
+        "--hybrid",
+        action="store_true",
+        help="fuse BM25 (exact terms) and vector search results, needs the lexical index of the build",
+    )
+    parser.add_argument(
+        "--context_tokens",
+        type=int,
+        default=3000,
+        help="token budget of the search results in the prompt, whatever the number of results",
+    )
+    parser.add_argument(
+        "--rerank",
+        type=str,
+        nargs="+",
+        default=None,
+        choices=["exact", "cross_encoder"],
+        help="rescore more candidates than --no_of_results: exactly on the stored vectors "
+        "and/or with a local cross-encoder (needs sentence-transformers)",
+    )
+    parser.add_argument(
+        "--rerank_depth",
+        type=int,
+        default=50,
+        help="number of candidates fetched for reranking",
+    )
+    parser.add_argument(
+        "--rerank_budget_ms",
+        type=float,
+        default=200,
+        help="milliseconds the cross-encoder may spend per query, the rest keep their order",
+    )
+    parser.add_argument(
+        "--rerank_model",
+        type=str,
+        default="cross-encoder/ms-marco-MiniLM-L-6-v2",
+        help="sentence-transformers cross-encoder used by --rerank cross_encoder",
+    )
+    parser.add_argument(
+        "--retrieval_only",
+        action="store_true",
+        help="print the ranked articles with their scores, without generating a response",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="JSONL file the answers to --queries_file are written to (default: stdout)",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=64,
+        help="queries per embedding and search request, with --queries_file",
+    )
+    parser.add_argument(
+        "--generation_workers",
+        type=int,
+        default=8,
+        help="chat completions in flight at once, with --queries_file",
+    )
     args = parser.parse_args()
     return vars(args)
 
 
 if __name__ == "__main__":
     arguments = parse_arguments()
-    print(inference(arguments=arguments))
+    arguments["filters"] = parse_filter_arguments(arguments["filter"])
+    if "logging" in (arguments["trace_sinks"] or []):
+        import logging
+
+        logging.basicConfig(level=logging.INFO)
+    if arguments["queries_file"]:
+        arguments["queries"] = read_queries(arguments["queries_file"])
+        output = open(arguments["output"], "w", encoding="utf-8") if arguments["output"] else sys.stdout
+        try:
+            # one line per query, written as soon as it is answered
+            for result in batch_inference(arguments=arguments):
+                output.write(json.dumps(result, default=str) + "\n")
+                output.flush()
+        finally:
+            if output is not sys.stdout:
+                output.close()
+    elif arguments["retrieval_only"]:
+        results = inference(arguments=arguments)
+        for rank, value in sorted(results.items()):
+            print(f"{rank + 1}. [{value['distance']:.4f}] {value['title']}")
+            print(f"   {value['url']}")
+    elif arguments["no_stream"]:
+        print(inference(arguments=arguments))
+    else:
+        # print the response as the model generates it
+        arguments["stream"] = True
+        for chunk in inference(arguments=arguments):
+            print(chunk, end="", flush=True)
+        print()
@@ -10,4 +10,15 @@ setup(
         "streamlit==1.30.0",
         "psycopg2-binary==2.9.9",
     ],
+    extras_require={
+        # local embedding models (--model_name local:<model>)
+        # and the reranking cross-encoder (--rerank cross_encoder)
+        "local": ["sentence-transformers"],
+        # trace sink (--trace_sinks otel)
+        "otel": ["opentelemetry-api"],
+        # exact token counts for the prompt budget (--context_tokens)
+        "tokens": ["tiktoken"],
+        # http search service (api/service.py)
+        "service": ["fastapi", "uvicorn"],
+    },
 )
@@ -0,0 +1,413 @@
+"""
+This module has functions to benchmark the recall and latency
+of vector store indexes:
+1. generate or load a corpus of vectors and a query set
+2. compute the exact top-k of every query with brute-force numpy
+3. build an index in a vector store and time searches against it
+4. sweep index types and search parameters (nprobe / ef)
+5. write the results as json or csv
+"""
+
+# search parameter swept for each index type
+SWEEP_PARAMETERS = {"IVF": "nprobe", "HNSW": "ef"}
+
+
+def synthetic_corpus(no_of_vectors, dim, no_of_queries, no_of_clusters=100, seed=0):
+    """
+    This function generates unit-length vectors drawn around random
+    cluster centers (real embeddings are clustered too, uniform random
+    vectors would make every ANN index look worse than it is), and
+    queries that are noisy copies of random corpus vectors
+
+    Arguments
+    ----------
+    no_of_vectors : int
+        size of the corpus
+    dim : int
+        dimension of the vectors
+    no_of_queries : int
+        number of queries
+    no_of_clusters : int
+        number of cluster centers
+    seed : int
+        random seed
+
+    Returns
+    -------
+    corpus, queries : np.ndarray, np.ndarray
+        float32 matrices
+
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((no_of_clusters, dim), dtype=np.float32)
+    corpus = centers[rng.integers(no_of_clusters, size=no_of_vectors)]
+    corpus += 0.5 * rng.standard_normal((no_of_vectors, dim), dtype=np.float32)
+    corpus /= np.linalg.norm(corpus, axis=1, keepdims=True)
+
+    return corpus, sample_queries(corpus, no_of_queries, seed=seed)
+
+
+def sample_queries(corpus, no_of_queries, noise=0.1, seed=0):
+    """
+    This function makes queries out of random corpus vectors
+    plus gaussian noise, renormalized to unit length
+
+    Arguments
+    ----------
+    corpus : np.ndarray
+        corpus vectors
+    no_of_queries : int
+        number of queries
+    noise : float
+        standard deviation of the noise
+    seed : int
+        random seed
+
+    Returns
+    -------
+    queries : np.ndarray
+        float32 matrix
+
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    picks = np.sort(rng.integers(len(corpus), size=no_of_queries))
+    queries = np.asarray(corpus[picks], dtype=np.float32)
+    queries = queries + noise * rng.standard_normal(queries.shape, dtype=np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return queries
+
+
+def load_vectors(filepath):
+    """
+    This function loads a float32 matrix from a .npy file
+    (memory-mapped, so large corpora are not read twice)
+
+    Arguments
+    ----------
+    filepath : string
+        path to a .npy file with one vector per row
+
+    Returns
+    -------
+    vectors : np.ndarray
+
+    """
+    import numpy as np
+
+    vectors = np.load(filepath, mmap_mode="r")
+    if vectors.ndim != 2:
+        raise ValueError(f"{filepath} should hold a 2d matrix, got shape {vectors.shape}")
+    return vectors.astype(np.float32, copy=False)
+
+
+def exact_ground_truth(corpus, queries, k, metric_type="IP", batch_size=65536):
+    """
+    This function computes the exact top-k of every query by scoring
+    it against the whole corpus, a batch of corpus rows at a time
+
+    Arguments
+    ----------
+    corpus : np.ndarray
+        corpus vectors, row i has id i
+    queries : np.ndarray
+        query vectors
+    k : int
+        number of neighbours
+    metric_type : string
+        "IP" or "L2"
+    batch_size : int
+        number of corpus rows scored at once
+
+    Returns
+    -------
+    ground_truth : np.ndarray
+        int64 matrix, the ids of the k nearest neighbours of each query
+
+    """
+    import numpy as np
+
+    queries = np.asarray(queries, dtype=np.float32)
+    best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+    best_ids = np.empty((len(queries), 0), dtype=np.int64)
+    for start in range(0, len(corpus), batch_size):
+        batch = np.asarray(corpus[start : start + batch_size], dtype=np.float32)
+        scores = queries @ batch.T
+        if metric_type == "L2":
+            scores = 2 * scores - (batch**2).sum(axis=1)
+        ids = np.broadcast_to(
+            np.arange(start, start + len(batch), dtype=np.int64), scores.shape
+        )
+        scores = np.concatenate([best_scores, scores], axis=1)
+        ids = np.concatenate([best_ids, ids], axis=1)
+        keep = min(k, scores.shape[1])
+        top = np.argpartition(-scores, keep - 1, axis=1)[:, :keep]
+        best_scores = np.take_along_axis(scores, top, axis=1)
+        best_ids = np.take_along_axis(ids, top, axis=1)
+
+    order = np.argsort(-best_scores, axis=1)
+    return np.take_along_axis(best_ids, order, axis=1)
+
+
+def recall_at_k(results, ground_truth, k):
+    """
+    This function computes the mean recall@k: the fraction of the
+    exact k nearest neighbours found in the first k results
+
+    Arguments
+    ----------
+    results : list(list(int))
+        ids returned for every query, best first
+    ground_truth : np.ndarray
+        exact neighbour ids of every query
+    k : int
+        number of neighbours
+
+    Returns
+    -------
+    recall : float
+
+    """
+    found = 0
+    for ids, exact in zip(results, ground_truth):
+        found += len(set(ids[:k]) & set(exact[:k].tolist()))
+    return found / (k * len(results)) if results else 0.0
+
+
+def latency_summary(latencies):
+    """
+    This function summarizes per-query latencies
+
+    Arguments
+    ----------
+    latencies : list(float)
+        seconds spent on every query
+
+    Returns
+    -------
+    summary : dict
+        p50, p95, p99 and mean in milliseconds, and
+        queries per second for sequential queries
+
+    """
+    import numpy as np
+
+    latencies = np.asarray(latencies, dtype=np.float64) * 1000
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "mean_ms": round(float(latencies.mean()), 3),
+        "qps": round(1000 * len(latencies) / float(latencies.sum()), 1),
+    }
+
+
+def build_index(vector_store, corpus, index_param, batch_size=100000):
+    """
+    This function (re)creates the collection of a vector store
+    and inserts the corpus, row i with id i
+
+    Arguments
+    ----------
+    vector_store : src.vectorstore.helpers.VectorStore
+        the store to build
+    corpus : np.ndarray
+        corpus vectors
+    index_param : dict
+        index parameters, as used by the build
+    batch_size : int
+        number of vectors per insert
+
+    Returns
+    -------
+    seconds : float
+        time spent building the index
+
+    """
+    import time
+    import numpy as np
+
+    start = time.perf_counter()
+    vector_store.create(dim=corpus.shape[1], index_param=index_param)
+    for i in range(0, len(corpus), batch_size):
+        batch = np.asarray(corpus[i : i + batch_size], dtype=np.float32)
+        # a list of rows, like the build passes
+        vector_store.insert(ids=list(range(i, i + len(batch))), dense_vectors=list(batch))
+    vector_store.finalize()
+    vector_store.load()
+    return time.perf_counter() - start
+
+
+def benchmark_search(vector_store, queries, ground_truth, search_params, k, warmup=10):
+    """
+    This function runs every query against a built index, one at a
+    time, and measures the recall@k and latency of the searches
+
+    Arguments
+    ----------
+    vector_store : src.vectorstore.helpers.VectorStore
+        a built and loaded store
+    queries : np.ndarray
+        query vectors
+    ground_truth : np.ndarray
+        exact neighbour ids of every query
+    search_params : dict
+        search parameters, as used by inference
+    k : int
+        number of results per query
+    warmup : int
+        number of untimed queries run first
+
+    Returns
+    -------
+    measurements : dict
+        recall@k and the latency summary
+
+    """
+    import time
+
+    for query in queries[:warmup]:
+        vector_store.search(query_embedding=query.tolist(), search_params=search_params, k=k)
+
+    results, latencies = [], []
+    for query in queries:
+        query = query.tolist()
+        start = time.perf_counter()
+        hits = vector_store.search(query_embedding=query, search_params=search_params, k=k)
+        latencies.append(time.perf_counter() - start)
+        results.append([hit.id for hit in hits])
+
+    return {f"recall@{k}": round(recall_at_k(results, ground_truth, k), 4), **latency_summary(latencies)}
+
+
+def sweep_parameter(index_type):
+    """
+    Name of the search parameter swept for an index type, if any
+    """
+    for prefix, parameter in SWEEP_PARAMETERS.items():
+        if index_type.startswith(prefix):
+            return parameter
+    return None
+
+
+def run_sweep(
+    vector_store_factory,
+    corpus,
+    queries,
+    k,
+    index_params,
+    sweep_values,
+    metric_type="IP",
+):
+    """
+    This function builds one index per index type and searches it
+    with every value of its search parameter (nprobe for IVF_*,
+    ef for HNSW, none for FLAT)
+
+    Arguments
+    ----------
+    vector_store_factory : callable
+        returns an empty vector store for an index type
+    corpus : np.ndarray
+        corpus vectors
+    queries : np.ndarray
+        query vectors
+    k : int
+        number of results per query
+    index_params : list(dict)
+        index parameters to benchmark, eg:
+        {"metric_type": "IP", "index_type": "IVF_SQ8", "params": {"nlist": 4096}}
+    sweep_values : dict
+        values of each search parameter, eg: {"nprobe": [16, 128]}
+    metric_type : string
+        "IP" or "L2"
+
+    Returns
+    -------
+    rows : list(dict)
+        one row of measurements per (index, search parameter)
+
+    """
+    import time
+
+    start = time.perf_counter()
+    ground_truth = exact_ground_truth(corpus, queries, k, metric_type)
+    print(f"Computed exact top-{k} of {len(queries)} queries in {time.perf_counter() - start:.2f}s\n")
+
+    rows = []
+    for index_param in index_params:
+        index_type = index_param["index_type"]
+        vector_store = vector_store_factory(index_type)
+        try:
+            build_seconds = build_index(vector_store, corpus, index_param)
+        except Exception as e:
+            print(f"Skipping {index_type}, could not build the index\n")
+            print(e)
+            continue
+
+        parameter = sweep_parameter(index_type)
+        for value in sweep_values.get(parameter, [None]) if parameter else [None]:
+            search_params = {"metric_type": metric_type, "params": {}}
+            if parameter:
+                search_params["params"][parameter] = value
+            measurements = benchmark_search(
+                vector_store, queries, ground_truth, search_params, k
+            )
+            row = {
+                "index_type": index_type,
+                "index_params": index_param.get("params", {}),
+                "search_parameter": parameter,
+                "search_value": value,
+                "vectors": len(corpus),
+                "queries": len(queries),
+                "k": k,
+                "build_seconds": round(build_seconds, 3),
+                **measurements,
+            }
+            setting = f" {parameter}={value}" if parameter else ""
+            print(
+                f"{index_type}{setting}: recall@{k} {row[f'recall@{k}']}, p50 {row['p50_ms']}ms, "
+                f"p99 {row['p99_ms']}ms, {row['qps']} qps"
+            )
+            rows.append(row)
+    return rows
+
+
+def write_results(rows, filepath):
+    """
+    This function writes the benchmark rows as json,
+    or as csv if filepath ends with .csv
+
+    Arguments
+    ----------
+    rows : list(dict)
+        benchmark measurements
+    filepath : string
+        output file
+
+    """
+    import csv
+    import json
+
+    if filepath.endswith(".csv"):
+        columns = []
+        for row in rows:
+            columns += [column for column in row if column not in columns]
+        with open(filepath, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(
+                    {
+                        column: json.dumps(value) if isinstance(value, dict) else value
+                        for column, value in row.items()
+                    }
+                )
+    else:
+        with open(filepath, "w") as f:
+            json.dump(rows, f, indent=2)
+    print(f"\nWrote {len(rows)} results to {filepath}")
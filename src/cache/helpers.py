@@ -0,0 +1,421 @@
+"""
+This module has:
+1. a persistent, content-addressed embedding cache shared by
+   the build and the inference paths
+2. an in-memory cache of query responses, looked up by
+   normalized query text and by query embedding similarity
+3. the same cache, holding retrieval results instead of responses
+"""
+
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+# default location of the embedding cache
+EMBEDDING_CACHE_PATH = "data/artifacts/embedding_cache.sqlite"
+
+
+def normalize_text(text):
+    """
+    Normalize a text before it is hashed or embedded:
+    newlines and runs of whitespace become a single space
+    """
+    return " ".join(text.split())
+
+
+def text_hash(text):
+    """
+    sha256 digest of the normalized text
+    """
+    import hashlib
+
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    """
+    A SQLite backed cache of embeddings keyed on
+    (model_name, sha256 of the normalized text).
+    Embeddings are stored as float32 blobs.
+    The instance keeps hit and miss counters and
+    can be shared between threads.
+
+    Arguments
+    ----------
+    path : string
+        path to the sqlite file, created if needed
+    """
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH):
+        import os
+        import sqlite3
+        import threading
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("pragma journal_mode=wal")
+        self._connection.execute(
+            "create table if not exists embeddings ("
+            "model_name text, text_hash blob, embedding blob, "
+            "primary key (model_name, text_hash))"
+        )
+        self._connection.commit()
+
+    def get_many(self, model_name, texts):
+        """
+        This function looks up the embeddings of a list of texts
+
+        Arguments
+        ----------
+        model_name : string
+            name of the embedding model
+        texts : list(str)
+            texts to look up
+
+        Returns
+        -------
+        embeddings : list(np.ndarray or None)
+            the cached float32 embedding of each text, None on a miss
+
+        """
+        import numpy as np
+
+        hashes = [text_hash(text) for text in texts]
+        found = {}
+        with self._lock:
+            # sqlite limits the number of bound parameters per statement
+            for i in range(0, len(hashes), 500):
+                batch = list(set(hashes[i : i + 500]))
+                rows = self._connection.execute(
+                    "select text_hash, embedding from embeddings where model_name = ? "
+                    "and text_hash in (" + ",".join("?" * len(batch)) + ")",
+                    [model_name] + batch,
+                ).fetchall()
+                found.update(rows)
+
+            embeddings = [
+                np.frombuffer(found[h], dtype=np.float32) if h in found else None
+                for h in hashes
+            ]
+            hits = sum(embedding is not None for embedding in embeddings)
+            self.hits += hits
+            self.misses += len(embeddings) - hits
+
+        return embeddings
+
+    def put_many(self, model_name, texts, embeddings):
+        """
+        This function stores the embeddings of a list of texts
+
+        Arguments
+        ----------
+        model_name : string
+            name of the embedding model
+        texts : list(str)
+            texts that were embedded
+        embeddings : list
+            one embedding for each text
+
+        """
+        import numpy as np
+
+        rows = [
+            (model_name, text_hash(text), np.asarray(embedding, dtype=np.float32).tobytes())
+            for text, embedding in zip(texts, embeddings)
+        ]
+        with self._lock:
+            self._connection.executemany(
+                "insert or replace into embeddings values (?, ?, ?)", rows
+            )
+            self._connection.commit()
+
+    def summary(self):
+        """
+        Hit and miss counts as a printable string
+        """
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return f"embedding cache: {self.hits} hits, {self.misses} misses ({rate:.1%} hit rate)"
+
+    def close(self):
+        """
+        Close the underlying sqlite connection
+        """
+        with self._lock:
+            self._connection.close()
+
+
+@functools.lru_cache(maxsize=None)
+def get_embedding_cache(path=EMBEDDING_CACHE_PATH):
+    """
+    This function returns a long-lived embedding cache,
+    opened once per path and shared by every caller
+
+    Arguments
+    ----------
+    path : string
+        path to the sqlite file
+
+    Returns
+    -------
+    cache : EmbeddingCache
+
+    """
+    return EmbeddingCache(path)
+
+
+class QueryResultCache:
+    """
+    An in-memory LRU cache of query responses with two tiers:
+    - exact: keyed on the normalized query text
+    - semantic: the most similar cached query embedding, if its
+      cosine similarity is at least similarity_threshold
+    Entries expire after ttl seconds. Entries are grouped by scope
+    (eg: model name and number of results) and only match queries
+    of the same scope. The whole cache is dropped when the version
+    of the indexed collection changes.
+
+    Arguments
+    ----------
+    max_entries : int
+        maximum number of cached responses, least recently used go first
+    ttl : float
+        seconds an entry stays valid
+    similarity_threshold : float
+        minimum cosine similarity for a semantic hit,
+        None disables the semantic tier
+    version_check_interval : float
+        minimum seconds between two collection version checks
+    """
+
+    def __init__(
+        self,
+        max_entries=1024,
+        ttl=3600,
+        similarity_threshold=0.97,
+        version_check_interval=10,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.version_check_interval = version_check_interval
+        self._lock = threading.Lock()
+        self._version = None
+        self._version_checked_at = None
+        self._counters = {
+            "exact_hits": 0,
+            "exact_lookups": 0,
+            "semantic_hits": 0,
+            "semantic_lookups": 0,
+            "evictions": 0,
+            "invalidations": 0,
+        }
+        self._clear()
+
+    def _clear(self):
+        # (scope, normalized query) -> [slot, response, expires_at]
+        self._entries = OrderedDict()
+        # unit query embeddings, one row per slot
+        self._vectors = None
+        self._slot_keys = [None] * self.max_entries
+        self._free_slots = list(range(self.max_entries))
+
+    def check_version(self, fetch_version):
+        """
+        Drop every entry if the collection version changed.
+        fetch_version is only called every version_check_interval seconds
+        """
+        now = time.monotonic()
+        with self._lock:
+            if (
+                self._version_checked_at is not None
+                and now - self._version_checked_at < self.version_check_interval
+            ):
+                return
+            self._version_checked_at = now
+        version = fetch_version()
+        with self._lock:
+            if version != self._version:
+                if self._version is not None or self._entries:
+                    self._counters["invalidations"] += 1
+                self._clear()
+                self._version = version
+
+    def invalidate(self):
+        """
+        Drop every entry
+        """
+        with self._lock:
+            self._counters["invalidations"] += 1
+            self._clear()
+
+    def _remove(self, key):
+        slot = self._entries.pop(key)[0]
+        self._slot_keys[slot] = None
+        self._free_slots.append(slot)
+
+    def get_exact(self, scope, query):
+        """
+        Look up the response of a query by its normalized text
+
+        Returns
+        -------
+        response : object or None
+        """
+        key = (scope, normalize_text(query).lower())
+        with self._lock:
+            self._counters["exact_lookups"] += 1
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            self._counters["exact_hits"] += 1
+            return entry[1]
+
+    def get_semantic(self, scope, query_embedding):
+        """
+        Look up the response of the cached query of the same scope
+        whose embedding is the most similar to query_embedding
+
+        Returns
+        -------
+        response : object or None
+        """
+        import numpy as np
+
+        if self.similarity_threshold is None:
+            return None
+        with self._lock:
+            self._counters["semantic_lookups"] += 1
+            if self._vectors is None or not self._entries:
+                return None
+            query_vector = np.asarray(query_embedding, dtype=np.float32)
+            query_vector = query_vector / (np.linalg.norm(query_vector) or 1.0)
+            similarities = self._vectors @ query_vector
+            for slot, key in enumerate(self._slot_keys):
+                if key is None or key[0] != scope:
+                    similarities[slot] = -np.inf
+            slot = int(np.argmax(similarities))
+            if similarities[slot] < self.similarity_threshold:
+                return None
+            key = self._slot_keys[slot]
+            entry = self._entries[key]
+            if entry[2] < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            self._counters["semantic_hits"] += 1
+            return entry[1]
+
+    def put(self, scope, query, query_embedding, response):
+        """
+        Cache the response of a query
+        """
+        import numpy as np
+
+        key = (scope, normalize_text(query).lower())
+        query_vector = np.asarray(query_embedding, dtype=np.float32)
+        query_vector = query_vector / (np.linalg.norm(query_vector) or 1.0)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if not self._free_slots:
+                # evict the least recently used entry
+                self._remove(next(iter(self._entries)))
+                self._counters["evictions"] += 1
+            if self._vectors is None or self._vectors.shape[1] != query_vector.shape[0]:
+                self._vectors = np.zeros(
+                    (self.max_entries, query_vector.shape[0]), dtype=np.float32
+                )
+            slot = self._free_slots.pop()
+            self._vectors[slot] = query_vector
+            self._slot_keys[slot] = key
+            self._entries[key] = [slot, response, time.monotonic() + self.ttl]
+
+    def metrics(self):
+        """
+        Hit rates per tier
+
+        Returns
+        -------
+        metrics : dict
+            {"exact": {"hits": 0, "lookups": 0, "hit_rate": 0.0},
+             "semantic": {...}, "entries": 0, "evictions": 0,
+             "invalidations": 0}
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            entries = len(self._entries)
+
+        def tier(name):
+            hits, lookups = counters[name + "_hits"], counters[name + "_lookups"]
+            return {
+                "hits": hits,
+                "lookups": lookups,
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
+
+        return {
+            "exact": tier("exact"),
+            "semantic": tier("semantic"),
+            "entries": entries,
+            "evictions": counters["evictions"],
+            "invalidations": counters["invalidations"],
+        }
+
+
+@functools.lru_cache(maxsize=None)
+def get_query_cache(max_entries=1024, ttl=3600, similarity_threshold=0.97):
+    """
+    This function returns the process-wide query response cache
+    for the given settings
+
+    Arguments
+    ----------
+    max_entries : int
+        maximum number of cached responses
+    ttl : float
+        seconds an entry stays valid
+    similarity_threshold : float
+        minimum cosine similarity for a semantic hit, None disables it
+
+    Returns
+    -------
+    cache : QueryResultCache
+
+    """
+    return QueryResultCache(
+        max_entries=max_entries, ttl=ttl, similarity_threshold=similarity_threshold
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_retrieval_cache(max_entries=1024, ttl=600):
+    """
+    This function returns the process-wide cache of retrieval results
+    (the ranked articles of a query and its embedding), so that a
+    response can be generated later for a search without searching
+    again. Only the exact tier is used.
+
+    Arguments
+    ----------
+    max_entries : int
+        maximum number of cached results
+    ttl : float
+        seconds an entry stays valid
+
+    Returns
+    -------
+    cache : QueryResultCache
+
+    """
+    return QueryResultCache(max_entries=max_entries, ttl=ttl, similarity_threshold=None)
@@ -0,0 +1,299 @@
+"""
+This module has functions to:
+1. read and write the build manifest that records finished build stages,
+2. save and load the per-shard embedding files,
+so that an interrupted build can be resumed where it stopped
+
+Shard embeddings are stored as float32, float16 or int8 (scalar
+quantized, with a float32 scale per row) matrices, and read back
+memory-mapped: the build only pages in the rows it inserts.
+"""
+
+# storage types of the shard embeddings, and their bytes per dimension
+EMBEDDING_DTYPES = {"float32": 4, "float16": 2, "int8": 1}
+
+
+class EmbeddingMatrix:
+    """
+    Read-only float32 view of a (memory-mapped) embeddings matrix.
+    Slices of float32 matrices are views of the file, float16 and
+    int8 ones are decoded one slice at a time, so inserting in
+    batches never holds the whole matrix as float32.
+
+    Arguments
+    ----------
+    codes : np.ndarray
+        float32, float16 or int8 matrix with one row per record
+    scales : np.ndarray
+        float32 scale of every row, for int8 codes
+    """
+
+    def __init__(self, codes, scales=None):
+        self.codes = codes
+        self.scales = scales
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def __getitem__(self, index):
+        import numpy as np
+
+        codes = self.codes[index]
+        if self.scales is not None:
+            return codes.astype(np.float32) * np.asarray(self.scales[index])[..., None]
+        return codes if codes.dtype == np.float32 else codes.astype(np.float32)
+
+    def __array__(self, dtype=None, copy=None):
+        import numpy as np
+
+        return np.asarray(self[:], dtype=dtype)
+
+
+def quantize_embeddings(dense_vectors, dtype="float32"):
+    """
+    This function converts embeddings to their storage type. int8 codes
+    are symmetric per row: a row is divided by its largest absolute
+    value / 127 and rounded, and that scale is kept to decode it.
+
+    Arguments
+    ----------
+    dense_vectors : np.ndarray or list(np.ndarray)
+        embeddings, one per record
+    dtype : string
+        one of EMBEDDING_DTYPES
+
+    Returns
+    -------
+    codes : np.ndarray
+        matrix of the given type
+    scales : np.ndarray
+        float32 scale of every row for int8, else None
+
+    """
+    import numpy as np
+
+    if dtype not in EMBEDDING_DTYPES:
+        raise ValueError(f"Unknown embedding dtype {dtype}, choose one of {list(EMBEDDING_DTYPES)}")
+    matrix = np.asarray(dense_vectors, dtype=np.float32)
+    if dtype != "int8":
+        return matrix.astype(dtype, copy=False), None
+    scales = np.abs(matrix).max(axis=1) / 127
+    scales = np.where(scales == 0, 1, scales).astype(np.float32)
+    codes = np.rint(matrix / scales[:, None]).astype(np.int8)
+    return codes, scales
+
+
+def _atomic_write(path, write):
+    """
+    Write a file through a temporary file and rename it into
+    place, so that a crash never leaves a half-written file behind
+
+    Arguments
+    ----------
+    path : string
+        destination path
+    write : callable
+        called with an open binary file object
+
+    """
+    import os
+
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def new_manifest(data_path, model_name, shard_size):
+    """
+    This function creates an empty build manifest
+
+    Arguments
+    ----------
+    data_path : string
+        path to the input dataset
+    model_name : string
+        name of the embedding model
+    shard_size : int
+        number of records per shard
+
+    Returns
+    -------
+    manifest : dict
+        {"data_path": "", "model_name": "", "shard_size": 0,
+         "stages": {}, "shards": {}}
+
+    """
+    return {
+        "data_path": data_path,
+        "model_name": model_name,
+        "shard_size": shard_size,
+        "stages": {},
+        "shards": {},
+    }
+
+
+def load_manifest(artifacts_dir):
+    """
+    This function loads the build manifest from the artifacts folder
+
+    Arguments
+    ----------
+    artifacts_dir : string
+        folder holding the build checkpoints
+
+    Returns
+    -------
+    manifest : dict or None
+        the manifest, or None if no build has been checkpointed yet
+
+    """
+    import json
+    import os
+
+    manifest_path = os.path.join(artifacts_dir, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, artifacts_dir):
+    """
+    This function durably writes the build manifest to the artifacts folder
+
+    Arguments
+    ----------
+    manifest : dict
+        the build manifest
+    artifacts_dir : string
+        folder holding the build checkpoints
+
+    """
+    import json
+    import os
+
+    os.makedirs(artifacts_dir, exist_ok=True)
+    payload = json.dumps(manifest, indent=2).encode("utf-8")
+    _atomic_write(os.path.join(artifacts_dir, "manifest.json"), lambda f: f.write(payload))
+
+
+def shard_status(manifest, shard_no, start, end):
+    """
+    This function returns the status entry of a shard,
+    adding a fresh one to the manifest if needed
+
+    Arguments
+    ----------
+    manifest : dict
+        the build manifest
+    shard_no : int
+        shard number
+    start : int
+        index of the first record of the shard
+    end : int
+        index after the last record of the shard
+
+    Returns
+    -------
+    status : dict
+        {"start": 0, "end": 0, "embed": False, "milvus": False, "postgres": False}
+
+    """
+    key = str(shard_no)
+    status = manifest["shards"].get(key)
+    if status is None or (status["start"], status["end"]) != (start, end):
+        status = {
+            "start": start,
+            "end": end,
+            "embed": False,
+            "milvus": False,
+            "postgres": False,
+        }
+        manifest["shards"][key] = status
+    return status
+
+
+def shard_embeddings_path(artifacts_dir, shard_no):
+    """
+    Path of the embeddings file of a shard
+    """
+    import os
+
+    return os.path.join(artifacts_dir, f"shard_{shard_no:05d}.npy")
+
+
+def save_shard_embeddings(artifacts_dir, shard_no, dense_vectors, dtype="float32"):
+    """
+    This function durably saves the embeddings of a shard
+    as a float32, float16 or int8 matrix
+
+    Arguments
+    ----------
+    artifacts_dir : string
+        folder holding the build checkpoints
+    shard_no : int
+        shard number
+    dense_vectors : np.ndarray
+        embeddings of the shard, one row per record
+    dtype : string
+        storage type, one of EMBEDDING_DTYPES
+
+    """
+    import numpy as np
+
+    codes, scales = quantize_embeddings(dense_vectors, dtype)
+    path = shard_embeddings_path(artifacts_dir, shard_no)
+    # the scales go first: the codes file marks the shard as saved
+    if scales is not None:
+        _atomic_write(path[: -len(".npy")] + ".scales.npy", lambda f: np.save(f, scales))
+    _atomic_write(path, lambda f: np.save(f, codes))
+
+
+def load_shard_embeddings(artifacts_dir, shard_no):
+    """
+    This function loads the embeddings of a shard
+
+    Arguments
+    ----------
+    artifacts_dir : string
+        folder holding the build checkpoints
+    shard_no : int
+        shard number
+
+    Returns
+    -------
+    dense_vectors : EmbeddingMatrix
+        memory-mapped float32 view with one row per record
+
+    """
+    import numpy as np
+
+    path = shard_embeddings_path(artifacts_dir, shard_no)
+    codes = np.load(path, mmap_mode="r")
+    scales = None
+    if codes.dtype == np.int8:
+        scales = np.load(path[: -len(".npy")] + ".scales.npy", mmap_mode="r")
+    return EmbeddingMatrix(codes, scales)
+
+
+def clear_checkpoints(artifacts_dir):
+    """
+    This function removes the manifest and shard files of a previous build
+
+    Arguments
+    ----------
+    artifacts_dir : string
+        folder holding the build checkpoints
+
+    """
+    import shutil
+
+    shutil.rmtree(artifacts_dir, ignore_errors=True)
+
@@ -1,9 +1,34 @@
 """
 This module has functions to:
 1. load a csv file into a pandas dataframe
-2. preprocess a pandas dataframe 
+2. stream a csv file as a sequence of preprocessed chunks
+3. preprocess a pandas dataframe
+4. derive stable document ids and content hashes
+5. chunk documents into overlapping passages
 """
 
+# a passage id is its document id with the passage number in the low
+# bits, so the parent document of any passage hit is id & PARENT_ID_MASK
+PASSAGE_BITS = 5
+MAX_PASSAGES = 1 << PASSAGE_BITS
+PARENT_ID_MASK = 0x7FFFFFFFFFFFFFFF & ~(MAX_PASSAGES - 1)
+
+# columns read from the csv file, all of them are free text. The last
+# four hold the filterable fields (see src/filters/helpers.py), they are
+# left empty if the csv file does not have them
+DATASET_COLUMNS = [
+    "cord_uid",
+    "title",
+    "abstract",
+    "authors",
+    "url",
+    "publish_time",
+    "journal",
+    "source_x",
+    "license",
+]
+
+
 def load_dataset(filepath):
     """
     This function loads the dataset into a pandas df.
@@ -31,41 +56,221 @@ def load_dataset(filepath):
         print(e)
 
 
-def preprocess_dataset(df):
+def load_dataset_in_chunks(filepath, chunksize=10000):
+    """
+    This generator reads the dataset chunk by chunk, keeping
+    only the columns we need, and yields each chunk already
+    preprocessed. Memory use is bounded by the chunk size
+    instead of the size of the csv file.
+
+    Arguments
+    ----------
+    filepath : string
+        path to dataset
+    chunksize : int
+        number of csv rows read per chunk
+
+    Yields
+    -------
+    df : pd.DataFrame
+        a preprocessed chunk (may be empty if every row was filtered out)
+
+    """
+
+    import pandas as pd
+
+    reader = pd.read_csv(
+        filepath,
+        header=0,
+        usecols=lambda column: column in DATASET_COLUMNS,
+        dtype={column: str for column in DATASET_COLUMNS},
+        chunksize=chunksize,
+    )
+    with reader:
+        for chunk in reader:
+            df = preprocess_dataset(df=chunk, verbose=False)
+            if df is None:
+                raise ValueError(f"Could not preprocess a chunk of {filepath}")
+            yield df
+
+
+def preprocess_dataset(df, verbose=True):
     """
     This function preprocesses a pandas dataframe
     by keeping only the required columns and
     filtering out null rows in the column that
-    embedding generation is based on. 
+    embedding generation is based on.
     In this case, the required columns are title & abstract.
 
     Arguments
     ----------
     df : pd.DataFrame
         csv file loaded into a df
+    verbose : bool
+        print a summary once done
 
     Returns
     -------
     df : pd.DataFrame
-        the preprocessed dataframe
+        the preprocessed dataframe, with extra
+        embedding_text, doc_id and content_hash columns
     """
 
-    import pandas as pd
-
     try:
-        # keep only necessary columns
-        cols_to_keep = ["title", "abstract", "authors", "url"]
-        df = df[cols_to_keep]
-
         # we're creating embeddings based on title + abstract fields
-        # so, first filter out rows where both fields are empty
-        df = df[df.title.notna() | df.abstract.notna()]
+        # so, keep only necessary columns of rows where either field is set
+        # (a single selection makes one copy instead of two, and
+        # adds any missing column as empty)
+        df = df.loc[df.title.notna() | df.abstract.notna()].reindex(
+            columns=DATASET_COLUMNS
+        )
 
         # create a new column that contains "title + abstract" data field
-        df['embedding_text'] = (' ' + df['title']).fillna('') + (' ' + df['abstract']).fillna('')
+        df["embedding_text"] = (" " + df["title"]).fillna("") + (
+            " " + df["abstract"]
+        ).fillna("")
 
-        print(f"Preprocessed Dataset Successfully. Df has {df.count()} records\n")
+        # stable id derived from the document key, and a hash of
+        # the content to detect documents that changed between builds
+        df["doc_id"] = document_ids(df)
+        df["content_hash"] = content_hashes(df)
+
+        if verbose:
+            print(f"Preprocessed Dataset Successfully. Df has {len(df)} records\n")
         return df
     except Exception as e:
         print("Preprocessing of Dataset Failed\n")
         print(e)
+
+
+def document_ids(df):
+    """
+    This function derives a stable int64 id for every
+    document from its cord_uid (or, for rows without one,
+    from its embedding text). The same document gets the
+    same id in every build, which is what lets incremental
+    builds match incoming rows to indexed ones.
+
+    Arguments
+    ----------
+    df : pd.DataFrame
+        dataframe with cord_uid and embedding_text columns
+
+    Returns
+    -------
+    ids : list(int)
+        one non-negative 63-bit id for each row
+
+    """
+    import hashlib
+
+    ids = []
+    for cord_uid, text in zip(df["cord_uid"].values, df["embedding_text"].values):
+        key = cord_uid if isinstance(cord_uid, str) and cord_uid else "text:" + text
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+        ids.append(int.from_bytes(digest, "big") & 0x7FFFFFFFFFFFFFFF)
+    return ids
+
+
+def content_hashes(df):
+    """
+    This function hashes the fields of every row that end
+    up in milvus or postgres
+
+    Arguments
+    ----------
+    df : pd.DataFrame
+        the dataframe
+
+    Returns
+    -------
+    hashes : list(str)
+        one hex digest for each row
+
+    """
+    import hashlib
+
+    columns = ["embedding_text"] + DATASET_COLUMNS[1:]
+    hashes = []
+    for row in zip(*(df[column].values for column in columns)):
+        content = "\x1f".join(value if isinstance(value, str) else "" for value in row)
+        hashes.append(hashlib.sha256(content.encode("utf-8")).hexdigest())
+    return hashes
+
+
+def passage_ids(doc_ids):
+    """
+    This function lists every passage id that the given
+    documents can have (used to delete all their passages)
+
+    Arguments
+    ----------
+    doc_ids : list(int)
+        document ids, with their low PASSAGE_BITS cleared
+
+    Returns
+    -------
+    ids : list(int)
+
+    """
+    return [doc_id + no for doc_id in doc_ids for no in range(MAX_PASSAGES)]
+
+
+def chunk_passages(df, passage_tokens=256, overlap_tokens=64):
+    """
+    This function splits the abstract of every document into windows
+    of at most passage_tokens tokens that overlap by overlap_tokens.
+    Every passage is embedded with the title of its document in front.
+    Tokens are words and punctuation marks, which is close to what
+    the embedding models count. Documents get at most MAX_PASSAGES
+    passages, the rest of very long abstracts is dropped.
+
+    Arguments
+    ----------
+    df : pd.DataFrame
+        a preprocessed dataframe, whose doc_id have their
+        low PASSAGE_BITS cleared (see PARENT_ID_MASK)
+    passage_tokens : int
+        maximum number of tokens per passage, title included
+    overlap_tokens : int
+        number of tokens shared by consecutive passages, at
+        most half of the tokens left to the abstract
+
+    Returns
+    -------
+    passages_df : pd.DataFrame
+        one row per passage, with the columns of its document,
+        embedding_text replaced by the passage, and
+        a passage_id column (doc_id + passage number)
+
+    """
+    import re
+
+    token_pattern = re.compile(r"\w+|[^\w\s]")
+    rows, texts, ids = [], [], []
+    for row, (doc_id, title, abstract) in enumerate(
+        zip(df["doc_id"].values, df["title"].values, df["abstract"].values)
+    ):
+        title = title if isinstance(title, str) else ""
+        abstract = abstract if isinstance(abstract, str) else ""
+        spans = [match.span() for match in token_pattern.finditer(abstract)]
+
+        # the title is repeated in every passage, the abstract gets the rest
+        window = max(passage_tokens - len(token_pattern.findall(title)), 32)
+        # an overlap as long as the window would never get past its start
+        overlap = min(overlap_tokens, window // 2)
+        stride = window - overlap
+        starts = range(0, max(len(spans) - overlap, 1), stride)
+        for no, start in enumerate(starts[:MAX_PASSAGES]):
+            passage = ""
+            if spans:
+                end = min(start + window, len(spans)) - 1
+                passage = abstract[spans[start][0] : spans[end][1]]
+            rows.append(row)
+            texts.append((" " + title if title else "") + (" " + passage if passage else ""))
+            ids.append(int(doc_id) + no)
+
+    passages_df = df.iloc[rows].copy()
+    passages_df["embedding_text"] = texts
+    passages_df["passage_id"] = ids
+    return passages_df
@@ -0,0 +1,273 @@
+"""
+This module has functions to:
+1. derive the filterable fields of a document (publish date,
+   journal, source and license) from the dataset columns
+2. validate and normalize a metadata filter
+3. turn a filter into a milvus boolean expression, or into a
+   boolean mask over the columns of the local vector store
+4. parse filters from the command line ("journal=Lancet")
+
+A filter is a dict with one condition per field:
+    {"publish_time": {">=": "2021-01-01", "<": "2022-01-01"},
+     "journal": "Lancet",
+     "source": ["PMC", "Medline"]}
+a scalar value means equality, a list means "any of", and a dict maps
+comparison operators to values. Conditions on different fields are
+combined with "and".
+"""
+
+# filterable fields, and their type in the vector store
+FILTER_FIELDS = {
+    "publish_time": "int",  # yyyymmdd, 0 when unknown
+    "journal": "str",
+    "source": "str",
+    "license": "str",
+}
+
+# dataset column that holds each filterable field
+FILTER_FIELD_COLUMNS = {
+    "publish_time": "publish_time",
+    "journal": "journal",
+    "source": "source_x",
+    "license": "license",
+}
+
+FILTER_OPERATORS = ["==", "!=", ">", ">=", "<", "<="]
+
+
+def publish_date(value, strict=False):
+    """
+    This function converts a publish time ("2020-03-12", "2020-03"
+    or "2020", as found in the dataset, or an int: yyyymmdd, yyyymm
+    or yyyy) into a yyyymmdd int. Missing month or day count as 01.
+
+    Arguments
+    ----------
+    value : str or int
+        a publish time
+    strict : bool
+        raise a ValueError for values that are not such a date (eg: in
+        a filter), instead of reading them as unknown dates (0), as
+        for the values of the dataset
+
+    Returns
+    -------
+    date : int
+
+    """
+    import numbers
+    import re
+
+    date = 0
+    if isinstance(value, numbers.Integral) and not isinstance(value, bool):
+        if value == 0:
+            return 0
+        # a year or a month, like their string forms
+        date = int(value)
+        if 1000 <= date <= 9999:
+            date = date * 100 + 1
+        if 100000 <= date <= 999999:
+            date = date * 100 + 1
+        if not 10000000 <= date <= 99999999:
+            date = 0
+    elif isinstance(value, str):
+        # dataset values may carry a time after the date, filters may not
+        pattern = r"^\s*(\d{4})(?:-(\d{1,2})(?:-(\d{1,2}))?)?" + (r"\s*$" if strict else "")
+        match = re.match(pattern, value)
+        if match is not None:
+            year, month, day = match.groups()
+            date = int(year) * 10000 + int(month or 1) * 100 + int(day or 1)
+
+    if date and 1 <= date // 100 % 100 <= 12 and 1 <= date % 100 <= 31:
+        return date
+    if strict:
+        raise ValueError(
+            f"Cannot read {value!r} as a publish time, use yyyy[-mm[-dd]], "
+            "or yyyymmdd, yyyymm or yyyy numbers"
+        )
+    return 0
+
+
+def filter_columns(df):
+    """
+    This function derives the filterable fields of every row
+
+    Arguments
+    ----------
+    df : pd.DataFrame
+        a preprocessed dataframe (missing dataset columns are empty)
+
+    Returns
+    -------
+    columns : dict(list)
+        one list per field of FILTER_FIELDS, ints for publish_time
+        and strings (empty when missing) for the others
+
+    """
+    columns = {}
+    for field, kind in FILTER_FIELDS.items():
+        values = df[FILTER_FIELD_COLUMNS[field]].values
+        if kind == "int":
+            columns[field] = [publish_date(value) for value in values]
+        else:
+            columns[field] = [value if isinstance(value, str) else "" for value in values]
+    return columns
+
+
+def normalize_filters(filters):
+    """
+    This function checks a filter and brings it to the
+    form {field: [(operator, value), ...]}
+
+    Arguments
+    ----------
+    filters : dict
+        a filter, see the module docstring
+
+    Returns
+    -------
+    conditions : dict(list(tuple))
+        for lists of values the operator is "in"
+
+    """
+    conditions = {}
+    for field, condition in (filters or {}).items():
+        if field not in FILTER_FIELDS:
+            raise ValueError(
+                f"Cannot filter on {field}, choose one of {list(FILTER_FIELDS)}"
+            )
+        if isinstance(condition, dict):
+            pairs = list(condition.items())
+        elif isinstance(condition, (list, tuple, set)):
+            pairs = [("in", list(condition))]
+        else:
+            pairs = [("==", condition)]
+
+        normalized = []
+        for operator, value in pairs:
+            if operator not in FILTER_OPERATORS + ["in"]:
+                raise ValueError(
+                    f"Unknown operator {operator}, choose one of {FILTER_OPERATORS}"
+                )
+            if FILTER_FIELDS[field] == "int":
+                value = (
+                    [publish_date(v, strict=True) for v in value]
+                    if operator == "in"
+                    else publish_date(value, strict=True)
+                )
+            elif operator == "in":
+                value = [str(v) for v in value]
+            else:
+                value = str(value)
+            normalized.append((operator, value))
+        conditions[field] = normalized
+    return conditions
+
+
+def filter_expression(filters):
+    """
+    This function turns a filter into a milvus boolean expression
+
+    Arguments
+    ----------
+    filters : dict
+        a filter, see the module docstring
+
+    Returns
+    -------
+    expr : string
+        eg: 'publish_time >= 20210101 and journal in ["Lancet"]',
+        or None for an empty filter
+
+    """
+    import json
+
+    clauses = []
+    for field, conditions in normalize_filters(filters).items():
+        for operator, value in conditions:
+            clauses.append(f"{field} {operator} {json.dumps(value)}")
+    return " and ".join(clauses) or None
+
+
+def filter_mask(filters, columns, vocabularies=None):
+    """
+    This function evaluates a filter over the filter columns of the
+    local vector store: publish_time as an int64 array and the other
+    fields as int32 codes into a vocabulary of strings
+
+    Arguments
+    ----------
+    filters : dict
+        a filter, see the module docstring
+    columns : dict(np.ndarray)
+        one array per field
+    vocabularies : dict(dict)
+        for each string field, the code of every string
+
+    Returns
+    -------
+    mask : np.ndarray
+        boolean mask of the rows that match, or None for an empty filter
+
+    """
+    import operator as op
+    import numpy as np
+
+    comparisons = {
+        "==": op.eq, "!=": op.ne, ">": op.gt, ">=": op.ge, "<": op.lt, "<=": op.le,
+    }
+
+    mask = None
+    for field, conditions in normalize_filters(filters).items():
+        values = np.asarray(columns[field])
+        for operator, value in conditions:
+            if FILTER_FIELDS[field] == "str":
+                # compare codes: strings missing from the vocabulary match nothing
+                vocabulary = vocabularies[field]
+                if operator == "in":
+                    value = [vocabulary[v] for v in value if v in vocabulary]
+                elif operator in ("==", "!="):
+                    value = vocabulary.get(value, -1)
+                else:
+                    raise ValueError(f"{field} only supports ==, != and lists of values")
+            matches = (
+                np.isin(values, value)
+                if operator == "in"
+                else comparisons[operator](values, value)
+            )
+            mask = matches if mask is None else mask & matches
+    return mask
+
+
+def parse_filter_arguments(filter_arguments):
+    """
+    This function parses filters given on the command line
+
+    Arguments
+    ----------
+    filter_arguments : list(str)
+        conditions like "publish_time>=2021-01-01",
+        "journal=Lancet" or "source=PMC,Medline" (any of)
+
+    Returns
+    -------
+    filters : dict
+        a filter, see the module docstring
+
+    """
+    import re
+
+    filters = {}
+    for argument in filter_arguments or []:
+        match = re.match(r"^\s*(\w+)\s*(==|!=|>=|<=|>|<|=)\s*(.*?)\s*$", argument)
+        if match is None:
+            raise ValueError(f"Cannot parse filter {argument}, eg: journal=Lancet")
+        field, operator, value = match.groups()
+        operator = "==" if operator == "=" else operator
+        if operator == "==" and "," in value:
+            filters[field] = [v.strip() for v in value.split(",")]
+        elif isinstance(filters.setdefault(field, {}), dict):
+            filters[field][operator] = value
+        else:
+            raise ValueError(f"Cannot combine a list of values with other conditions on {field}")
+    return filters
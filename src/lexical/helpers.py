@@ -0,0 +1,493 @@
+"""
+This module has a BM25 retriever over the same embedding_text as the
+vector store, for the exact terms (gene and drug names, trial ids) that
+dense retrieval misses, and functions to fuse its ranking with the
+vector search ranking (reciprocal rank fusion).
+
+The inverted index is stored under data/artifacts/lexical/ as segments,
+one per insert, like the local vector store. Every segment holds its
+terms as sorted 64-bit hashes, and its postings as flat arrays (rows
+and term frequencies) with an offsets array per term, all saved as .npy
+files that are memory-mapped at load time. Deletes are recorded as a
+per-segment mask. Document frequencies and the average document length
+are summed over the segments at query time.
+"""
+
+import functools
+import threading
+
+from src.vectorstore.helpers import SearchHit
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# reciprocal rank fusion constant, as in the original paper
+RRF_K = 60
+
+# least number of results fused from each retriever
+FUSION_DEPTH = 100
+
+# frequent english words, left out of the postings
+STOPWORDS = frozenset(
+    """a an and are as at be by for from has have in is it its of on or
+    that the this to was were which with we our these those than not
+    been but can may also""".split()
+)
+
+
+def tokenize(text):
+    """
+    This function splits a text into lowercase terms. Terms with
+    inner hyphens, dots or slashes (IL-6, SARS-CoV-2, 2019-nCoV)
+    are kept whole, and their parts are added too.
+
+    Arguments
+    ----------
+    text : string
+        a document or a query
+
+    Returns
+    -------
+    terms : list(str)
+
+    """
+    import re
+
+    if not isinstance(text, str):
+        return []
+    terms = []
+    for match in re.finditer(r"\w+(?:[-./]\w+)*", text.lower()):
+        term = match.group()
+        if term not in STOPWORDS:
+            terms.append(term)
+        if any(c in term for c in "-./"):
+            terms.extend(
+                part for part in re.split(r"[-./]", term) if part and part not in STOPWORDS
+            )
+    return terms
+
+
+def term_hashes(terms):
+    """
+    This function maps terms to stable 64-bit hashes
+
+    Arguments
+    ----------
+    terms : list(str)
+
+    Returns
+    -------
+    hashes : np.ndarray
+        uint64 array
+
+    """
+    import hashlib
+    import numpy as np
+
+    return np.fromiter(
+        (
+            int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "big")
+            for term in terms
+        ),
+        dtype=np.uint64,
+        count=len(terms),
+    )
+
+
+class LexicalIndex:
+    """
+    BM25 inverted index stored under data/artifacts/lexical/
+
+    Arguments
+    ----------
+    collection_name : string
+        name of the index, the same as the vector collection
+    artifacts_dir : string
+        folder holding the indexes, one sub-folder each
+    """
+
+    def __init__(self, collection_name, artifacts_dir="data/artifacts"):
+        import os
+
+        self.collection_name = collection_name
+        self.path = os.path.join(artifacts_dir, "lexical", collection_name)
+        self._lock = threading.Lock()
+        self._loaded = None
+        self._loaded_version = None
+
+    # ---- files
+
+    def _file(self, name):
+        import os
+
+        return os.path.join(self.path, name)
+
+    def _read_meta(self):
+        import json
+
+        with open(self._file("meta.json"), "r") as f:
+            return json.load(f)
+
+    def _write_meta(self, meta):
+        import json
+        import os
+
+        meta["version"] = meta.get("version", 0) + 1
+        temp_path = self._file("meta.json.tmp")
+        with open(temp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(temp_path, self._file("meta.json"))
+
+    def _save(self, name, array):
+        import os
+        import numpy as np
+
+        temp_path = self._file(name + ".tmp")
+        with open(temp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(temp_path, self._file(name))
+
+    # ---- writes
+
+    def exists(self):
+        import os
+
+        return os.path.exists(self._file("meta.json"))
+
+    def create(self, filter_fields=None):
+        """
+        Create an empty index, dropping any existing one
+        """
+        import os
+        import shutil
+
+        # the version keeps counting, a recreated index must not
+        # look like one a reader already loaded
+        version = self._read_meta().get("version", 0) if self.exists() else 0
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path)
+        self._write_meta(
+            {
+                "version": version,
+                "filter_fields": list(filter_fields or []),
+                # string filter fields are stored as int32 codes into these lists
+                "vocabularies": {},
+                "segments": [],
+                "next_segment": 0,
+            }
+        )
+        print(f"Lexical index {self.collection_name} created successfully\n")
+
+    def insert(self, ids, texts, filter_values=None):
+        """
+        Index texts under the given ids, as a new segment
+
+        Arguments
+        ----------
+        ids : list(int)
+            the ids of the vectors of the texts
+        texts : list(str)
+            the embedding_text of every row
+        filter_values : dict(list)
+            filterable fields of every row (see src/filters/helpers.py)
+
+        """
+        import collections
+        import numpy as np
+        from src.filters.helpers import FILTER_FIELDS
+
+        row_terms, row_nos, tfs, lengths = [], [], [], []
+        for row, text in enumerate(texts):
+            counts = collections.Counter(tokenize(text))
+            lengths.append(sum(counts.values()))
+            row_terms.extend(counts)
+            row_nos.extend([row] * len(counts))
+            tfs.extend(counts.values())
+
+        hashes = term_hashes(row_terms)
+        row_nos = np.asarray(row_nos, dtype=np.int32)
+        # postings sorted by term, then by row
+        order = np.lexsort((row_nos, hashes))
+        hashes = hashes[order]
+        terms, starts = np.unique(hashes, return_index=True)
+
+        with self._lock:
+            meta = self._read_meta()
+            name = f"segment_{meta['next_segment']:06d}"
+            self._save(name + ".ids.npy", np.asarray(ids, dtype=np.int64))
+            self._save(name + ".lengths.npy", np.asarray(lengths, dtype=np.int32))
+            self._save(name + ".terms.npy", terms)
+            self._save(
+                name + ".offsets.npy",
+                np.append(starts, len(hashes)).astype(np.int64),
+            )
+            self._save(name + ".rows.npy", row_nos[order])
+            self._save(
+                name + ".tfs.npy",
+                np.minimum(np.asarray(tfs, dtype=np.int64)[order], 65535).astype(np.uint16),
+            )
+            for field, values in (filter_values or {}).items():
+                if FILTER_FIELDS[field] == "int":
+                    column = np.asarray(values, dtype=np.int64)
+                else:
+                    vocabulary = meta.setdefault("vocabularies", {}).setdefault(field, [])
+                    codes = {value: code for code, value in enumerate(vocabulary)}
+                    for value in values:
+                        if value not in codes:
+                            codes[value] = len(vocabulary)
+                            vocabulary.append(value)
+                    column = np.asarray([codes[value] for value in values], dtype=np.int32)
+                self._save(f"{name}.filter.{field}.npy", column)
+            meta["segments"].append(name)
+            meta["next_segment"] += 1
+            self._write_meta(meta)
+        print(f"Indexed {len(lengths)} texts ({len(terms)} terms) into the lexical index\n")
+
+    def delete(self, ids):
+        """
+        Delete the rows with the given ids
+        """
+        import os
+        import numpy as np
+
+        ids = np.asarray(ids, dtype=np.int64)
+        with self._lock:
+            meta = self._read_meta()
+            for name in meta["segments"]:
+                segment_ids = np.load(self._file(name + ".ids.npy"), mmap_mode="r")
+                hit = np.isin(segment_ids, ids)
+                if not hit.any():
+                    continue
+                deleted_path = self._file(name + ".deleted.npy")
+                if os.path.exists(deleted_path):
+                    hit |= np.load(deleted_path)
+                self._save(name + ".deleted.npy", hit)
+            self._write_meta(meta)
+
+    # ---- reads
+
+    def load(self):
+        """
+        Memory-map the segments, again only if the index changed
+        """
+        import os
+        import numpy as np
+
+        # every write bumps the version in meta.json, which tells us
+        # whether the mapped segments are still current (an mtime can
+        # miss two writes within its resolution)
+        meta = self._read_meta()
+        version = meta.get("version")
+        if self._loaded is not None and version == self._loaded_version:
+            return self._loaded
+
+        segments = []
+        no_of_rows = total_length = 0
+        for name in meta["segments"]:
+            segment = {
+                array: np.load(self._file(f"{name}.{array}.npy"), mmap_mode="r")
+                for array in ["ids", "lengths", "terms", "offsets", "rows", "tfs"]
+            }
+            segment["deleted"] = None
+            if os.path.exists(self._file(name + ".deleted.npy")):
+                segment["deleted"] = np.load(self._file(name + ".deleted.npy"))
+            segment["filters"] = {
+                field: np.load(self._file(f"{name}.filter.{field}.npy"), mmap_mode="r")
+                for field in meta.get("filter_fields", [])
+                if os.path.exists(self._file(f"{name}.filter.{field}.npy"))
+            }
+            lengths = np.asarray(segment["lengths"], dtype=np.int64)
+            if segment["deleted"] is not None:
+                lengths = lengths[~segment["deleted"]]
+            no_of_rows += len(lengths)
+            total_length += int(lengths.sum())
+            segments.append(segment)
+
+        loaded = {
+            "segments": segments,
+            "no_of_rows": no_of_rows,
+            "average_length": total_length / no_of_rows if no_of_rows else 1.0,
+            "vocabularies": {
+                field: {value: code for code, value in enumerate(vocabulary)}
+                for field, vocabulary in meta.get("vocabularies", {}).items()
+            },
+        }
+        self._loaded, self._loaded_version = loaded, version
+        return loaded
+
+    def search(self, query, k, filters=None):
+        """
+        Return the k rows with the highest BM25 score for the query
+        that match filters, best first, as SearchHits whose distance
+        is the score. Document frequencies count deleted rows until
+        the index is rebuilt, as in most inverted indexes.
+
+        Arguments
+        ----------
+        query : string
+            the query text
+        k : int
+            number of results
+        filters : dict
+            optional metadata filter (see src/filters/helpers.py)
+
+        Returns
+        -------
+        results : list(SearchHit)
+
+        """
+        import numpy as np
+        from src.filters.helpers import filter_mask
+
+        loaded = self.load()
+        query_terms = np.unique(term_hashes(sorted(set(tokenize(query)))))
+        if not len(query_terms) or not loaded["no_of_rows"]:
+            return []
+
+        # where every query term's postings are in every segment
+        postings = []
+        document_frequency = np.zeros(len(query_terms), dtype=np.int64)
+        for segment in loaded["segments"]:
+            if not len(segment["terms"]):
+                postings.append((document_frequency * 0, document_frequency * 0))
+                continue
+            slots = np.searchsorted(segment["terms"], query_terms)
+            slots = np.minimum(slots, len(segment["terms"]) - 1)
+            found = segment["terms"][slots] == query_terms
+            starts = np.where(found, segment["offsets"][slots], 0)
+            ends = np.where(found, segment["offsets"][slots + 1], 0)
+            document_frequency += ends - starts
+            postings.append((starts, ends))
+
+        n = loaded["no_of_rows"]
+        idf = np.log(1 + (n - document_frequency + 0.5) / (document_frequency + 0.5))
+
+        all_scores, all_ids = [], []
+        for segment, (starts, ends) in zip(loaded["segments"], postings):
+            if not (ends - starts).any():
+                continue
+            rows = np.concatenate(
+                [segment["rows"][start:end] for start, end in zip(starts, ends)]
+            )
+            tfs = np.concatenate(
+                [segment["tfs"][start:end] for start, end in zip(starts, ends)]
+            ).astype(np.float32)
+            weights = np.repeat(idf, ends - starts).astype(np.float32)
+            lengths = np.asarray(segment["lengths"])[rows]
+            norms = BM25_K1 * (1 - BM25_B + BM25_B * lengths / loaded["average_length"])
+            scores = np.bincount(
+                rows,
+                weights=weights * tfs * (BM25_K1 + 1) / (tfs + norms),
+                minlength=len(segment["ids"]),
+            )
+
+            matched = scores > 0
+            if segment["deleted"] is not None:
+                matched &= ~segment["deleted"]
+            if filters:
+                if set(filters) - set(segment["filters"]):
+                    raise ValueError(
+                        f"Lexical index {self.collection_name} has no filter fields "
+                        f"{sorted(set(filters) - set(segment['filters']))}, rebuild it"
+                    )
+                matched &= filter_mask(filters, segment["filters"], loaded["vocabularies"])
+            rows = np.flatnonzero(matched)
+            all_scores.append(scores[rows])
+            all_ids.append(np.asarray(segment["ids"])[rows])
+
+        if not all_scores:
+            return []
+        scores, ids = np.concatenate(all_scores), np.concatenate(all_ids)
+        k = min(k, len(scores))
+        if not k:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [SearchHit(int(id), float(score)) for id, score in zip(ids[top], scores[top])]
+
+
+def reciprocal_rank_fusion(rankings, k, rrf_k=RRF_K):
+    """
+    This function fuses several rankings of the same ids: every id
+    scores the sum of 1 / (rrf_k + rank) over the rankings it is in
+
+    Arguments
+    ----------
+    rankings : list(list(SearchHit))
+        the results of each retriever, best first
+    k : int
+        number of results to keep
+    rrf_k : int
+        damping constant, larger values flatten the rank weights
+
+    Returns
+    -------
+    results : list(SearchHit)
+        best first, with the fused score as distance and
+        the payload of the first ranking that has one
+
+    """
+    scores, payloads = {}, {}
+    for ranking in rankings:
+        for rank, hit in enumerate(ranking, start=1):
+            id = int(hit.id)
+            scores[id] = scores.get(id, 0.0) + 1.0 / (rrf_k + rank)
+            if payloads.get(id) is None:
+                payloads[id] = getattr(hit, "payload", None)
+    fused = sorted(scores, key=lambda id: -scores[id])[:k]
+    return [SearchHit(id, scores[id], payloads[id]) for id in fused]
+
+
+def lexical_search_documents(lexical_index, query, k, filters=None, passages=False):
+    """
+    This function searches the k documents with the highest BM25
+    score, collapsing passage hits to their documents like
+    src.vectorstore.helpers.search_documents
+
+    Arguments
+    ----------
+    lexical_index : LexicalIndex
+        the index to search
+    query : string
+        the query text
+    k : int
+        number of documents
+    filters : dict
+        optional metadata filter (see src/filters/helpers.py)
+    passages : bool
+        whether the index holds passages (as at build time)
+
+    Returns
+    -------
+    results : list(SearchHit)
+        document hits, best first
+
+    """
+    from src.dataset.helpers import MAX_PASSAGES
+    from src.vectorstore.helpers import collapse_passages
+
+    if not passages:
+        return lexical_index.search(query, k, filters=filters)
+    # every row is scored anyway, fetching more costs little
+    return collapse_passages(
+        lexical_index.search(query, k * MAX_PASSAGES, filters=filters), k
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_lexical_index(collection_name="rag_search"):
+    """
+    This function returns a long-lived lexical index
+
+    Arguments
+    ----------
+    collection_name : string
+        name of the index
+
+    Returns
+    -------
+    lexical_index : LexicalIndex
+
+    """
+    return LexicalIndex(collection_name)
@@ -3,17 +3,32 @@ This module has functions to:
 1. connect to milvus server, 
 2. create a milvus collection, 
 3. insert into a milvus collection, 
-4. peform a vector search in a milvus collection
+4. delete from a milvus collection,
+5. peform a vector search in a milvus collection
 """
 
+import threading
+
+# maximum length (in bytes) of the VARCHAR payload and filter fields
+MILVUS_VARCHAR_MAX_LENGTH = 65535
+MILVUS_FILTER_MAX_LENGTH = 1024
+
+# loaded collection handles reused across searches, by collection name
+_LOADED_COLLECTIONS = {}
+_LOADED_COLLECTIONS_LOCK = threading.Lock()
+
 
 def milvus_connect():
     """
-    Connect to a Milvus Server
+    Connect to a Milvus Server, reusing the
+    existing connection if there already is one
     """
     from pymilvus import connections
     import os
 
+    if connections.has_connection("default"):
+        return
+
     MILVUS_HOST = os.environ["MILVUS_HOST"]
 
     try:
@@ -23,7 +38,66 @@ def milvus_connect():
         print(e)
 
 
-def milvus_collection_creation(collection_name, index_name, index_param):
+def milvus_loaded_collection(collection_name, reload=False):
+    """
+    This function returns a handle to a collection that
+    has been loaded into memory. The collection is only
+    loaded the first time, later calls reuse the handle.
+
+    Arguments
+    ----------
+    collection_name : string
+        name of the collection
+    reload : bool
+        discard the cached handle and load the collection again
+        (eg: after it was rebuilt by another process)
+
+    Returns
+    -------
+    collection : pymilvus.Collection
+
+    """
+    from pymilvus import Collection
+
+    with _LOADED_COLLECTIONS_LOCK:
+        if reload or collection_name not in _LOADED_COLLECTIONS:
+            milvus_connect()
+            collection = Collection(collection_name)
+            # loading collection
+            collection.load()
+            _LOADED_COLLECTIONS[collection_name] = collection
+        return _LOADED_COLLECTIONS[collection_name]
+
+
+def milvus_has_collection(collection_name):
+    """
+    This function checks whether a milvus collection exists
+
+    Arguments
+    ----------
+    collection_name : string
+        name of the collection
+
+    Returns
+    -------
+    exists : bool
+
+    """
+    from pymilvus import utility
+
+    milvus_connect()
+    return utility.has_collection(collection_name)
+
+
+def milvus_collection_creation(
+    collection_name,
+    index_name,
+    index_param,
+    auto_id=True,
+    dim=1536,
+    payload_fields=None,
+    filter_fields=None,
+):
     """
     This function creates a milvus collection and
     an index using the given index parameters
@@ -37,6 +111,16 @@ def milvus_collection_creation(collection_name, index_name, index_param):
     index_param : dict
         the metric_type, index_type, and params to be used
         (see https://milvus.io/docs/build_index.md)
+    auto_id : bool
+        let milvus assign ids; set to False to insert your own ids
+    dim : int
+        dimension of the vectors
+    payload_fields : list(str)
+        optional VARCHAR fields stored next to the vectors
+        and returned by searches, eg: ["title", "url"]
+    filter_fields : list(str)
+        optional scalar fields that searches can filter on
+        (see src/filters/helpers.py), with a scalar index each
 
     """
     from pymilvus import (
@@ -51,13 +135,31 @@ def milvus_collection_creation(collection_name, index_name, index_param):
 
     if utility.has_collection(collection_name):
         utility.drop_collection(collection_name)
+    with _LOADED_COLLECTIONS_LOCK:
+        _LOADED_COLLECTIONS.pop(collection_name, None)
 
     # define key and vector index schema
-    key = FieldSchema(name="ID", dtype=DataType.INT64, is_primary=True, auto_id=True)
+    key = FieldSchema(name="ID", dtype=DataType.INT64, is_primary=True, auto_id=auto_id)
     field = FieldSchema(
-        name=index_name, dtype=DataType.FLOAT_VECTOR, dim=1536, description="vector"
+        name=index_name, dtype=DataType.FLOAT_VECTOR, dim=dim, description="vector"
+    )
+    payload = [
+        FieldSchema(name=name, dtype=DataType.VARCHAR, max_length=MILVUS_VARCHAR_MAX_LENGTH)
+        for name in payload_fields or []
+    ]
+    from src.filters.helpers import FILTER_FIELDS
+
+    filters = [
+        FieldSchema(name=name, dtype=DataType.INT64)
+        if FILTER_FIELDS[name] == "int"
+        else FieldSchema(
+            name=name, dtype=DataType.VARCHAR, max_length=MILVUS_FILTER_MAX_LENGTH
+        )
+        for name in filter_fields or []
+    ]
+    schema = CollectionSchema(
+        fields=[key, field] + payload + filters, description="embedding collection"
     )
-    schema = CollectionSchema(fields=[key, field], description="embedding collection")
 
     # create collection
     collection = Collection(name=collection_name, schema=schema)
@@ -65,13 +167,16 @@ def milvus_collection_creation(collection_name, index_name, index_param):
 
     # index creation
     collection.create_index(field_name=index_name, index_params=index_param)
+    for name in filter_fields or []:
+        # scalar index, for selective filters
+        collection.create_index(field_name=name, index_name=name + "_index")
     if utility.has_collection(collection_name) and collection.indexes:
         print(
             f"Collection {collection_name} created successfully. Index {index_name} created successfully. \n"
         )
 
 
-def milvus_insert_into_db(collection_name, dense_vectors):
+def milvus_insert_into_db(collection_name, dense_vectors, ids=None, scalars=None):
     """
     This function inserts the dense vectors into
     the milvus collection
@@ -80,8 +185,16 @@ def milvus_insert_into_db(collection_name, dense_vectors):
     ----------
     collection_name : string
         milvus collection name
-    dense_vectors : list(np.ndarray)
-        list of dense vectors
+    dense_vectors : list(np.ndarray) or np.ndarray
+        dense vectors, or a matrix (eg: a memory-mapped
+        src.checkpoint.helpers.EmbeddingMatrix) sliced per batch
+    ids : list
+        ids for the vectors, required if the collection
+        was created with auto_id=False
+    scalars : dict(list)
+        values of the payload and filter fields, one list per field
+        in the order of the collection schema (VARCHAR values of at
+        most MILVUS_VARCHAR_MAX_LENGTH / MILVUS_FILTER_MAX_LENGTH bytes)
 
     Returns
     -------
@@ -99,7 +212,12 @@ def milvus_insert_into_db(collection_name, dense_vectors):
     batch_size = 10000
     # insert into collection in batches of [batch_size]
     for i in range(0, len(dense_vectors), batch_size):
-        mr = collection.insert([dense_vectors[i : i + batch_size]])
+        columns = [list(dense_vectors[i : i + batch_size])]
+        if ids is not None:
+            columns.insert(0, list(ids[i : i + batch_size]))
+        for values in (scalars or {}).values():
+            columns.append(list(values[i : i + batch_size]))
+        mr = collection.insert(columns)
         all_ids.append(mr.primary_keys)
 
     # flattening all_ids which is a list of list into a list
@@ -110,6 +228,71 @@ def milvus_insert_into_db(collection_name, dense_vectors):
     return milvus_ids
 
 
+def milvus_delete_ids(collection_name, ids):
+    """
+    This function deletes the vectors with the given
+    ids from the milvus collection
+
+    Arguments
+    ----------
+    collection_name : string
+        milvus collection name
+    ids : list
+        ids of the vectors to delete
+
+    """
+    from pymilvus import Collection
+
+    milvus_connect()
+    collection = Collection(collection_name)
+
+    # deletion batch size, keeps the boolean expression small
+    batch_size = 10000
+    for i in range(0, len(ids), batch_size):
+        batch = [int(id) for id in ids[i : i + batch_size]]
+        collection.delete(expr=f"ID in {batch}")
+    collection.flush()
+
+
+def milvus_fetch_vectors(collection_name, index_name, ids):
+    """
+    This function reads the stored (full precision) vectors
+    with the given ids from the loaded collection
+
+    Arguments
+    ----------
+    collection_name : string
+        milvus collection name
+    index_name : string
+        name of the vector field
+    ids : list
+        ids of the vectors, missing ones are skipped
+
+    Returns
+    -------
+    vectors : dict(list(float))
+        the vector of every id found
+
+    """
+
+    def query(collection, batch):
+        return collection.query(expr=f"ID in {batch}", output_fields=[index_name])
+
+    vectors = {}
+    # query batch size, keeps the boolean expression small
+    batch_size = 10000
+    for i in range(0, len(ids), batch_size):
+        batch = [int(id) for id in ids[i : i + batch_size]]
+        try:
+            rows = query(milvus_loaded_collection(collection_name), batch)
+        except Exception:
+            # stale handle, see milvus_search_many
+            rows = query(milvus_loaded_collection(collection_name, reload=True), batch)
+        for row in rows:
+            vectors[row["ID"]] = row[index_name]
+    return vectors
+
+
 def milvus_query_results_openai(
     openai_api_key,
     collection_name,
@@ -118,6 +301,8 @@ def milvus_query_results_openai(
     model_name,
     search_params,
     k,
+    embedding_cache=None,
+    filters=None,
 ):
     """
     This function lets you query against the milvus vector database
@@ -139,35 +324,139 @@ def milvus_query_results_openai(
         (see https://milvus.io/docs/v1.1.1/search_vector_python.md)
     k : int
         number of articles you want to retrieve
+    embedding_cache : src.cache.helpers.EmbeddingCache
+        optional embedding cache shared with the build
+    filters : dict
+        optional metadata filter, pushed down into the search
+        (see src/filters/helpers.py)
 
     Returns
     -------
     results : list(Tuple)
         a list of tuples containing milvus id and distance of the search result
     """
-    from pymilvus import Collection
-    from openai import OpenAI
+    from src.filters.helpers import filter_expression
+    from src.model.helpers import embed_query
 
-    client = OpenAI(api_key=openai_api_key)
+    query_embedding = embed_query(
+        openai_api_key=openai_api_key,
+        query=query,
+        model_name=model_name,
+        embedding_cache=embedding_cache,
+    )
 
-    # obtain query embedding from OpenAI model
-    text = query.replace("\n", " ")
-    query_embedding = (
-        client.embeddings.create(input=[text], model=model_name).data[0].embedding
+    return milvus_search(
+        collection_name=collection_name,
+        index_name=index_name,
+        query_embedding=query_embedding,
+        search_params=search_params,
+        k=k,
+        expr=filter_expression(filters),
     )
 
-    milvus_connect()
-    collection = Collection(collection_name)
-    # loading collection
-    collection.load()
 
-    # performing a vector search
-    search_results = collection.search(
-        data=[query_embedding],
-        anns_field=index_name,
-        param=search_params,
-        limit=k,
-        expr=None,
+def milvus_search(
+    collection_name,
+    index_name,
+    query_embedding,
+    search_params,
+    k,
+    output_fields=None,
+    expr=None,
+):
+    """
+    This function performs a vector search with a query
+    embedding, using a loaded collection handle that is
+    reused across calls
+
+    Arguments
+    ----------
+    collection_name : string
+        name of the collection
+    index_name : string
+        name of the index
+    query_embedding : list(float)
+        the query vector
+    search_params : dict
+        certain parameters such as nprobe, metric_type
+    k : int
+        number of articles you want to retrieve
+    output_fields : list(str)
+        payload fields to return with every hit
+    expr : string
+        optional boolean expression on the scalar fields,
+        applied during the search (see src/filters/helpers.py)
+
+    Returns
+    -------
+    results : list(Tuple)
+        a list of tuples containing milvus id and distance of the search result
+        (and the payload fields in hit.entity)
+    """
+    return milvus_search_many(
+        collection_name,
+        index_name,
+        [query_embedding],
+        search_params,
+        k,
+        output_fields=output_fields,
+        expr=expr,
     )[0]
 
-    return search_results
+
+def milvus_search_many(
+    collection_name,
+    index_name,
+    query_embeddings,
+    search_params,
+    k,
+    output_fields=None,
+    expr=None,
+):
+    """
+    This function searches many query embeddings
+    in a single multi-vector search request
+
+    Arguments
+    ----------
+    collection_name : string
+        name of the collection
+    index_name : string
+        name of the index
+    query_embeddings : list(list(float))
+        the query vectors
+    search_params : dict
+        certain parameters such as nprobe, metric_type
+    k : int
+        number of articles you want to retrieve per query
+    output_fields : list(str)
+        payload fields to return with every hit
+    expr : string
+        optional boolean expression on the scalar fields,
+        applied to every query
+
+    Returns
+    -------
+    results : list(list(Tuple))
+        the results of every query, as returned by milvus_search
+    """
+
+    def search(collection):
+        return list(
+            collection.search(
+                data=list(query_embeddings),
+                anns_field=index_name,
+                param=search_params,
+                limit=k,
+                expr=expr,
+                output_fields=output_fields,
+            )
+        )
+
+    # performing a vector search
+    try:
+        return search(milvus_loaded_collection(collection_name))
+    except Exception:
+        # the cached handle goes stale if the collection was
+        # dropped and rebuilt since it was loaded, retry once
+        return search(milvus_loaded_collection(collection_name, reload=True))
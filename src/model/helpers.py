@@ -1,20 +1,241 @@
 """
 This module has functions to:
 - generate embeddings for vector search using OpenAI models
-- generate a prompt template using context and user query
+  (or any embedding provider from src/model/providers.py)
+- embed a search query, or many at once
+- generate a prompt template using context and user query,
+  within a token budget
 - openAI chat completion function
 """
 
+import functools
+
+# default token budget of the context (title, abstract and url
+# of the search results) in the prompt, and of a single article
+CONTEXT_TOKENS = 3000
+ARTICLE_TOKENS = 500
+
+
+def openai_client(openai_api_key, base_url=None):
+    """
+    This function returns an OpenAI client, creating it
+    only once per (api key, base url) so that its http
+    connection pool is reused across calls
+
+    Arguments:
+    -------
+    openai_api_key : str
+        OpenAI api key
+    base_url : str
+        optional OpenAI-compatible endpoint
+
+    Returns:
+    -------
+    client : openai.OpenAI
+
+    """
+    return _openai_client(openai_api_key, base_url)
+
+
+@functools.lru_cache(maxsize=None)
+def _openai_client(openai_api_key, base_url):
+    from openai import OpenAI
+
+    return OpenAI(api_key=openai_api_key, base_url=base_url)
+
+
+def batch_texts(texts, batch_size=256, max_batch_tokens=100000):
+    """
+    This function packs texts into consecutive batches so that each
+    batch holds at most batch_size texts and roughly max_batch_tokens
+    tokens (estimated at ~4 characters per token).
+
+    Arguments:
+    -------
+    texts : list(str)
+        texts to be embedded
+    batch_size : int
+        maximum number of texts per request
+    max_batch_tokens : int
+        approximate maximum number of tokens per request
+
+    Returns:
+    -------
+    batches : list(Tuple)
+        a list of (start, end) index ranges into texts
+
+    """
+
+    batches = []
+    start, tokens = 0, 0
+    for i, text in enumerate(texts):
+        text_tokens = len(text) // 4 + 1
+        if i > start and (i - start >= batch_size or tokens + text_tokens > max_batch_tokens):
+            batches.append((start, i))
+            start, tokens = i, 0
+        tokens += text_tokens
+    if start < len(texts):
+        batches.append((start, len(texts)))
+
+    return batches
+
+
+def openai_embed_texts(
+    client,
+    texts,
+    model_name="text-embedding-ada-002",
+    batch_size=256,
+    max_batch_tokens=100000,
+    max_workers=8,
+    progress=None,
+):
+    """
+    This function embeds a list of texts by sending batches of them
+    to OpenAI's embeddings.create() endpoint, with up to max_workers
+    requests in flight at once. Embeddings are returned in the same
+    order as the input texts.
+
+    Arguments:
+    -------
+    client : openai.OpenAI
+        OpenAI client (point its base_url at a local server for testing)
+    texts : list(str)
+        texts to be embedded
+    model_name : str
+        OpenAI model name
+    batch_size : int
+        maximum number of texts per request
+    max_batch_tokens : int
+        approximate maximum number of tokens per request
+    max_workers : int
+        maximum number of concurrent requests
+    progress : tqdm.tqdm
+        optional progress bar, updated as batches complete
+
+    Returns:
+    -------
+    embeddings : list(list(float))
+        one embedding for each text
+
+    """
+
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    texts = [text.replace("\n", " ") for text in texts]
+    embeddings = [None] * len(texts)
+
+    def get_embeddings(start, end):
+        response = client.embeddings.create(input=texts[start:end], model=model_name)
+        # every item carries the position of its input in the request
+        for item in response.data:
+            embeddings[start + item.index] = item.embedding
+        return end - start
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(get_embeddings, start, end)
+            for start, end in batch_texts(texts, batch_size, max_batch_tokens)
+        ]
+        for future in as_completed(futures):
+            done = future.result()
+            if progress is not None:
+                progress.update(done)
+
+    return embeddings
+
+
+def generate_embeddings(provider, df, column_name="embedding_text", cache=None):
+    """
+    This function generates embeddings for the texts of a
+    dataframe column with any embedding provider (see
+    src/model/providers.py). If a cache is given, only texts
+    that are not cached yet are embedded.
+
+    Arguments:
+    -------
+    provider : src.model.providers.EmbeddingProvider
+        the embedding model
+    df : pd.DataFrame
+        your dataset
+    column_name : str
+        name of the column you want to generate embeddings
+    cache : src.cache.helpers.EmbeddingCache
+        optional embedding cache, read before and updated after embedding
+
+    Returns:
+    -------
+    dense_vectors : np.ndarray
+        a contiguous float32 matrix with one row per record
+
+    """
+
+    import time
+    import numpy as np
+    from tqdm import tqdm
+
+    try:
+        texts = df[column_name].tolist()
+        if cache is not None:
+            embeddings_list = cache.get_many(provider.name, texts)
+        else:
+            embeddings_list = [None] * len(texts)
+
+        # embed each distinct text that is not cached yet, only once
+        missing = {}
+        for i, embedding in enumerate(embeddings_list):
+            if embedding is None:
+                missing.setdefault(texts[i], []).append(i)
+        missing_texts = list(missing)
+
+        # embedding generation time over whole dataset,
+        # nothing to embed when every text is cached
+        if missing_texts:
+            start_time = time.time()
+            with tqdm(total=len(missing_texts)) as progress:
+                new_embeddings = provider.embed(missing_texts, progress=progress)
+            end_time = time.time()
+            total = end_time - start_time
+            print(f"Successfully generated embeddings in {total} seconds\n")
+
+        if cache is not None and missing_texts:
+            cache.put_many(provider.name, missing_texts, new_embeddings)
+
+        # one contiguous matrix, rather than an array object per record
+        if missing_texts:
+            dim = new_embeddings.shape[1]
+        elif texts:
+            dim = len(embeddings_list[0])
+        else:
+            dim = provider.dim
+        dense_vectors = np.empty((len(texts), dim), dtype=np.float32)
+        for i, embedding in enumerate(embeddings_list):
+            if embedding is not None:
+                dense_vectors[i] = embedding
+        for row, text in enumerate(missing_texts):
+            dense_vectors[missing[text]] = new_embeddings[row]
+        return dense_vectors
+
+    except Exception as e:
+        print("Embedding generation failed")
+        print(e)
+
 
 def generate_openai_embeddings(
     openai_api_key,
     df,
     model_name="text-embedding-ada-002",
     column_name="embedding_text",
+    batch_size=256,
+    max_batch_tokens=100000,
+    max_workers=8,
+    base_url=None,
+    cache=None,
 ):
     """
     Given an OpenAI model, this function uses their embeddings.create()
-    function to generate embeddings for texts.
+    function to generate embeddings for texts. Texts are sent in batches
+    and several batches are embedded concurrently. If a cache is given,
+    only texts that are not cached yet are sent to OpenAI.
 
     Arguments:
     -------
@@ -26,52 +247,203 @@ def generate_openai_embeddings(
         OpenAI model name
     column_name : str
         name of the column you want to generate embeddings
+    batch_size : int
+        maximum number of texts per embeddings request
+    max_batch_tokens : int
+        approximate maximum number of tokens per embeddings request
+    max_workers : int
+        maximum number of embeddings requests in flight
+    base_url : str
+        optional OpenAI-compatible endpoint (eg: a local fake server)
+    cache : src.cache.helpers.EmbeddingCache
+        optional embedding cache, read before and updated after embedding
 
     Returns:
     -------
-    dense_vectors : list(np.array)
-        a list of dense vectors one for each record
+    dense_vectors : np.ndarray
+        a contiguous float32 matrix with one row per record
 
     """
+    from src.model.providers import OpenAIEmbeddingProvider
+
+    provider = OpenAIEmbeddingProvider(
+        model_name=model_name,
+        openai_api_key=openai_api_key,
+        base_url=base_url,
+        batch_size=batch_size,
+        max_batch_tokens=max_batch_tokens,
+        max_workers=max_workers,
+    )
+    return generate_embeddings(
+        provider=provider, df=df, column_name=column_name, cache=cache
+    )
+
+
+def embed_query(openai_api_key, query, model_name, embedding_cache=None):
+    """
+    This function returns the embedding of a search query,
+    from the embedding cache if it is there, else from the
+    embedding model (see src/model/providers.py)
 
-    import time
-    import numpy as np
-    from openai import OpenAI
-    from tqdm import tqdm
+    Arguments:
+    -------
+    openai_api_key : str
+        OpenAI api key, only used by OpenAI models
+    query : str
+        user's query in natural language
+    model_name : str
+        the same model name that was used to create embeddings
+    embedding_cache : src.cache.helpers.EmbeddingCache
+        optional embedding cache shared with the build
+
+    Returns:
+    -------
+    query_embedding : list(float)
+
+    """
+    return embed_queries(openai_api_key, [query], model_name, embedding_cache)[0]
+
+
+def embed_queries(openai_api_key, queries, model_name, embedding_cache=None):
+    """
+    This function returns the embeddings of many search queries:
+    those in the embedding cache are read from it, the others are
+    embedded in batched requests (see src/model/providers.py)
+
+    Arguments:
+    -------
+    openai_api_key : str
+        OpenAI api key, only used by OpenAI models
+    queries : list(str)
+        queries in natural language
+    model_name : str
+        the same model name that was used to create embeddings
+    embedding_cache : src.cache.helpers.EmbeddingCache
+        optional embedding cache shared with the build
+
+    Returns:
+    -------
+    query_embeddings : list(list(float))
+
+    """
+    from src.model.providers import get_embedding_provider
+
+    provider = get_embedding_provider(model_name, openai_api_key)
+
+    # obtain query embeddings from the cache or from the model
+    texts = [query.replace("\n", " ") for query in queries]
+    query_embeddings = [None] * len(texts)
+    if embedding_cache is not None:
+        query_embeddings = embedding_cache.get_many(provider.name, texts)
+
+    missing = [i for i, embedding in enumerate(query_embeddings) if embedding is None]
+    if missing:
+        # each distinct text is embedded once
+        missing_texts = list(dict.fromkeys(texts[i] for i in missing))
+        embeddings = dict(zip(missing_texts, provider.embed(missing_texts)))
+        for i in missing:
+            query_embeddings[i] = embeddings[texts[i]]
+        if embedding_cache is not None:
+            embedding_cache.put_many(
+                provider.name, missing_texts, [embeddings[text] for text in missing_texts]
+            )
 
+    return [embedding.tolist() for embedding in query_embeddings]
+
+
+@functools.lru_cache(maxsize=None)
+def _token_encoder():
+    """
+    The tokenizer of the chat model, None if tiktoken is not installed
+    """
     try:
-        client = OpenAI(api_key=openai_api_key)
+        import tiktoken
+    except ImportError:
+        return None
+    return tiktoken.get_encoding("cl100k_base")
 
-        embeddings_list = []  # list of all embeddings
 
-        def get_embeddings(text, model=model_name):
-            text = text.replace("\n", " ")
-            return client.embeddings.create(input=[text], model=model).data[0].embedding
+def count_tokens(text):
+    """
+    This function counts the tokens of a text for the chat model,
+    with tiktoken if it is installed (pip install tiktoken) and
+    estimated at ~4 characters per token otherwise
 
-        # embedding generation time over whole dataset
-        start_time = time.time()
-        for index, row in tqdm(df.iterrows(), total=df.shape[0]):
-            embedding = get_embeddings(text=row["embedding_text"])
-            embeddings_list.append(np.asarray(embedding))
-        end_time = time.time()
-        total = end_time - start_time
-        print(f"Successfully generated embeddings in {total} seconds\n")
+    Arguments:
+    -------
+    text : str
 
-        dense_vectors = embeddings_list  # list of np.array vectors
-        return dense_vectors
+    Returns:
+    -------
+    tokens : int
 
-    except Exception as e:
-        print("Embedding generation failed")
-        print(e)
+    """
+    encoder = _token_encoder()
+    if encoder is None:
+        return len(text) // 4 + 1
+    return len(encoder.encode(text, disallowed_special=()))
 
 
-def generate_prompt_with_context(top_k_context, query):
+def truncate_to_tokens(text, max_tokens):
+    """
+    This function cuts a text to at most max_tokens tokens, at
+    the end of a sentence if that keeps at least half of it
+
+    Arguments:
+    -------
+    text : str
+    max_tokens : int
+
+    Returns:
+    -------
+    text : str
+        the text, or its beginning followed by " ..."
+
+    """
+    encoder = _token_encoder()
+    if encoder is None:
+        if len(text) // 4 + 1 <= max_tokens:
+            return text
+        cut = text[: max(max_tokens - 2, 0) * 4]
+    else:
+        tokens = encoder.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        cut = encoder.decode(tokens[: max(max_tokens - 2, 0)])
+
+    sentence_end = cut.rfind(". ")
+    if sentence_end >= len(cut) // 2:
+        return cut[: sentence_end + 1] + " ..."
+    return cut.rstrip() + " ..."
+
+
+def _dedup_key(text):
+    """
+    Normalized text: lowercase words only, so copies of an article
+    that differ in case, punctuation or spacing get the same key
+    """
+    import re
+
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+
+def generate_prompt_with_context(
+    top_k_context,
+    query,
+    max_context_tokens=CONTEXT_TOKENS,
+    max_article_tokens=ARTICLE_TOKENS,
+):
     """
     Given the top k content obtained from the IR part
     of this system, we now use this content as additional
     context to the chat generation system.
 
-    This function concatenates top k content with user query.
+    This function fills a token budget with the top k content,
+    in rank order, and appends the user query. Articles whose
+    title or abstract is a copy of a better ranked one are skipped,
+    long abstracts are cut to max_article_tokens, and the last
+    article that fits is cut to what is left of the budget. So the
+    prompt size does not grow with k.
 
     Arguments:
     -------
@@ -89,6 +461,10 @@ def generate_prompt_with_context(top_k_context, query):
         }
     query : str
         user's query in natural language
+    max_context_tokens : int
+        token budget of the context
+    max_article_tokens : int
+        token budget of a single article's abstract
 
     Returns:
     -------
@@ -99,18 +475,43 @@ def generate_prompt_with_context(top_k_context, query):
     """
 
     try:
-        context = ""
-        users_query = query
-
-        # concatenate the "abstracts" of top k articles
-        for id, value in top_k_context.items():
-            if value["title"] is not None:
-                context = context + "\n" + "title: " + value["title"]
-            if value["abstract"] is not None:
-                context = context + "\n" + "abstract: " + value["abstract"]
-            if value["url"] is not None:
-                context = context + "\n" + "url: " + value["url"]
-            context += "\n\n"
+        articles = []
+        seen = set()
+        budget = max_context_tokens
+
+        # add the "abstracts" of the top k articles, best first,
+        # until the budget is spent
+        for rank in sorted(top_k_context, key=int):
+            value = top_k_context[rank]
+            title, abstract, url = value["title"], value["abstract"], value["url"]
+
+            # the same article is often listed more than once (eg: PMC and Medline)
+            keys = {_dedup_key(text) for text in (title, abstract) if text}
+            keys.discard("")
+            if keys & seen:
+                continue
+            seen |= keys
+
+            lines = []
+            if title is not None:
+                lines.append("title: " + title)
+            if url is not None:
+                lines.append("url: " + url)
+            cost = count_tokens("\n".join(lines)) + 2
+            if abstract is not None:
+                abstract_budget = min(max_article_tokens, budget - cost - 8)
+                # not even a short abstract fits, the context is full
+                if abstract_budget < min(64, max_article_tokens):
+                    break
+                abstract = truncate_to_tokens(abstract, abstract_budget)
+                lines.insert(1 if title is not None else 0, "abstract: " + abstract)
+                cost += count_tokens(abstract) + 4
+            if cost > budget:
+                break
+            budget -= cost
+            articles.append("\n".join(lines))
+
+        context = "\n" + "\n\n\n".join(articles) + "\n\n" if articles else ""
 
         # using this context, ask it to generate an answer to user's query
         prompt = f"""Answer the following query using only the given context (articles). Give a response based on the information given to you. 
@@ -118,7 +519,7 @@ def generate_prompt_with_context(top_k_context, query):
         
         Context: {context}
         
-        Query: {users_query}
+        Query: {query}
         """
 
         return prompt
@@ -128,7 +529,32 @@ def generate_prompt_with_context(top_k_context, query):
         print(e)
 
 
-def prompt_model(prompt, openai_api_key):
+def chat_messages(prompt):
+    """
+    This function wraps a prompt into the list of
+    messages sent to the chat completion endpoint
+
+    Arguments:
+    -------
+    prompt : str
+        a prompt str with additional content (top-k results)
+        appended to user's query
+
+    Returns:
+    -------
+    messages : list(dict)
+
+    """
+    return [
+        {
+            "role": "system",
+            "content": "You answer questions based on the context given to you.",
+        },
+        {"role": "user", "content": prompt},
+    ]
+
+
+def prompt_model(prompt, openai_api_key, stream=False):
     """
     This function calls OpenAI's chat.completion() function
     to generate text, given a prompt.
@@ -140,28 +566,27 @@ def prompt_model(prompt, openai_api_key):
         appended to user's query
     openai_api_key : str
         OpenAI api key
+    stream : bool
+        return a generator of text chunks as soon
+        as the model produces them
 
     Returns:
     -------
-    chat_result : str
-        chat completion result
+    chat_result : str or generator(str)
+        chat completion result, or a generator of its
+        chunks if stream is True
 
     """
 
-    from openai import OpenAI
+    client = openai_client(openai_api_key)
 
-    client = OpenAI(api_key=openai_api_key)
+    if stream:
+        return _stream_chat_completion(client, prompt)
 
     try:
         response = client.chat.completions.create(
             model="gpt-3.5-turbo",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You answer questions based on the context given to you.",
-                },
-                {"role": "user", "content": prompt},
-            ],
+            messages=chat_messages(prompt),
         )
         chat_result = response.choices[0].message.content
 
@@ -170,3 +595,27 @@ def prompt_model(prompt, openai_api_key):
     except Exception as e:
         print("Failed to generate response from the model")
         print(e)
+
+
+def _stream_chat_completion(client, prompt):
+    """
+    Generator behind prompt_model(stream=True), yields
+    the text of every chunk of the chat completion. It
+    returns True if the completion finished, False if it
+    failed midway (the chunks so far are then incomplete)
+    """
+    try:
+        response = client.chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=chat_messages(prompt),
+            stream=True,
+        )
+        for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+        return True
+
+    except Exception as e:
+        print("Failed to generate response from the model")
+        print(e)
+        return False
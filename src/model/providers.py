@@ -0,0 +1,280 @@
+"""
+This module has embedding providers behind a common interface:
+1. OpenAIEmbeddingProvider, the OpenAI embeddings endpoint
+2. HashingEmbeddingProvider, a deterministic feature-hashing
+   embedder that runs offline on all CPU cores
+3. SentenceTransformerProvider, a local sentence-transformers model
+   (needs the optional sentence-transformers package)
+
+Use get_embedding_provider() to get a provider from a model name:
+- "hashing" or "hashing-<dim>" for the hashing embedder
+- "local:<model>" for a sentence-transformers model, eg: "local:all-MiniLM-L6-v2"
+- anything else is treated as an OpenAI model name
+"""
+
+import functools
+
+# dimension of the OpenAI embedding models, others are probed
+OPENAI_EMBEDDING_DIMS = {
+    "text-embedding-ada-002": 1536,
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+}
+
+
+class EmbeddingProvider:
+    """
+    Interface of an embedding model
+
+    Attributes
+    ----------
+    name : string
+        model name, used as the embedding cache key
+    dim : int
+        dimension of the embeddings
+    """
+
+    name = None
+    dim = None
+
+    def embed(self, texts, progress=None):
+        """
+        Embed a list of texts
+
+        Arguments
+        ----------
+        texts : list(str)
+            texts to be embedded
+        progress : tqdm.tqdm
+            optional progress bar, updated as texts are embedded
+
+        Returns
+        -------
+        embeddings : np.ndarray
+            float32 matrix with one row per text
+        """
+        raise NotImplementedError
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    """
+    Embeddings from OpenAI's embeddings.create() endpoint,
+    requested in concurrent batches
+
+    Arguments
+    ----------
+    model_name : string
+        OpenAI model name
+    openai_api_key : string
+        OpenAI api key
+    base_url : string
+        optional OpenAI-compatible endpoint
+    batch_size : int
+        maximum number of texts per request
+    max_batch_tokens : int
+        approximate maximum number of tokens per request
+    max_workers : int
+        maximum number of concurrent requests
+    """
+
+    def __init__(
+        self,
+        model_name,
+        openai_api_key,
+        base_url=None,
+        batch_size=256,
+        max_batch_tokens=100000,
+        max_workers=8,
+    ):
+        self.name = model_name
+        self.openai_api_key = openai_api_key
+        self.base_url = base_url
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_workers = max_workers
+        self._dim = OPENAI_EMBEDDING_DIMS.get(model_name)
+
+    @property
+    def dim(self):
+        if self._dim is None:
+            self._dim = self.embed(["dimension probe"]).shape[1]
+        return self._dim
+
+    def embed(self, texts, progress=None):
+        import numpy as np
+        from src.model.helpers import openai_client, openai_embed_texts
+
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        embeddings = openai_embed_texts(
+            client=openai_client(self.openai_api_key, self.base_url),
+            texts=texts,
+            model_name=self.name,
+            batch_size=self.batch_size,
+            max_batch_tokens=self.max_batch_tokens,
+            max_workers=self.max_workers,
+            progress=progress,
+        )
+        return np.asarray(embeddings, dtype=np.float32).reshape(len(texts), -1)
+
+
+def _hashing_embed(texts, dim):
+    """
+    Feature-hashing embeddings of a batch of texts: every lowercased
+    word and word bigram adds +1 or -1 to one of dim buckets (both
+    chosen by a hash of the feature), rows are L2 normalized
+    """
+    import hashlib
+    import re
+    import numpy as np
+
+    embeddings = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        words = re.findall(r"\w+", text.lower())
+        for feature in words + [a + " " + b for a, b in zip(words, words[1:])]:
+            digest = int.from_bytes(
+                hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "big"
+            )
+            embeddings[row, digest % dim] += 1.0 if digest >> 63 else -1.0
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.where(norms == 0, 1, norms)
+
+
+class HashingEmbeddingProvider(EmbeddingProvider):
+    """
+    Deterministic, offline embeddings by feature hashing of word
+    unigrams and bigrams. Large inputs are split into batches that
+    are embedded in parallel on all CPU cores.
+
+    Arguments
+    ----------
+    dim : int
+        dimension of the embeddings
+    batch_size : int
+        number of texts per worker batch
+    max_workers : int
+        number of worker processes, defaults to the number of cores
+    """
+
+    def __init__(self, dim=384, batch_size=2048, max_workers=None):
+        self.name = f"hashing-{dim}"
+        self.dim = dim
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+
+    def embed(self, texts, progress=None):
+        import numpy as np
+        from concurrent.futures import ProcessPoolExecutor
+
+        if len(texts) <= self.batch_size:
+            embeddings = _hashing_embed(texts, self.dim)
+            if progress is not None:
+                progress.update(len(texts))
+            return embeddings
+
+        batches = [
+            texts[i : i + self.batch_size] for i in range(0, len(texts), self.batch_size)
+        ]
+        embeddings = []
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            for batch, batch_embeddings in zip(
+                batches, executor.map(_hashing_embed, batches, [self.dim] * len(batches))
+            ):
+                embeddings.append(batch_embeddings)
+                if progress is not None:
+                    progress.update(len(batch))
+        return np.concatenate(embeddings)
+
+
+class SentenceTransformerProvider(EmbeddingProvider):
+    """
+    Embeddings from a local sentence-transformers model on CPU,
+    encoded in batches (torch spreads each batch over all cores)
+
+    Arguments
+    ----------
+    model_name : string
+        sentence-transformers model name or path
+    batch_size : int
+        number of texts per forward pass
+    """
+
+    def __init__(self, model_name, batch_size=64):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise ImportError(
+                "local embedding models need sentence-transformers: "
+                "pip install sentence-transformers"
+            )
+
+        self.name = "local:" + model_name
+        self.batch_size = batch_size
+        self._model = SentenceTransformer(model_name, device="cpu")
+        self.dim = self._model.get_sentence_embedding_dimension()
+
+    def embed(self, texts, progress=None):
+        import numpy as np
+
+        embeddings = []
+        for i in range(0, len(texts), self.batch_size):
+            batch = texts[i : i + self.batch_size]
+            embeddings.append(
+                self._model.encode(
+                    batch, batch_size=self.batch_size, normalize_embeddings=True
+                )
+            )
+            if progress is not None:
+                progress.update(len(batch))
+        if not embeddings:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.concatenate(embeddings).astype(np.float32, copy=False)
+
+
+@functools.lru_cache(maxsize=None)
+def get_embedding_provider(
+    model_name,
+    openai_api_key=None,
+    base_url=None,
+    batch_size=256,
+    max_batch_tokens=100000,
+    max_workers=8,
+):
+    """
+    This function returns a long-lived embedding provider for a model name
+
+    Arguments
+    ----------
+    model_name : string
+        "hashing", "hashing-<dim>", "local:<sentence-transformers model>"
+        or an OpenAI model name
+    openai_api_key : string
+        OpenAI api key, only used by OpenAI models
+    base_url : string
+        optional OpenAI-compatible endpoint
+    batch_size : int
+        maximum number of texts per OpenAI request
+    max_batch_tokens : int
+        approximate maximum number of tokens per OpenAI request
+    max_workers : int
+        maximum number of concurrent OpenAI requests
+
+    Returns
+    -------
+    provider : EmbeddingProvider
+
+    """
+    if model_name == "hashing":
+        return HashingEmbeddingProvider()
+    if model_name.startswith("hashing-"):
+        return HashingEmbeddingProvider(dim=int(model_name[len("hashing-") :]))
+    if model_name.startswith("local:"):
+        return SentenceTransformerProvider(model_name[len("local:") :])
+    return OpenAIEmbeddingProvider(
+        model_name=model_name,
+        openai_api_key=openai_api_key,
+        base_url=base_url,
+        batch_size=batch_size,
+        max_batch_tokens=max_batch_tokens,
+        max_workers=max_workers,
+    )
@@ -3,62 +3,226 @@ This module has functions to:
 1. connect to postgres server, 
 2. create a postgres table, 
 3. insert into a postgres table, 
-4. execute sql queries to fetch 
+4. delete from a postgres table,
+5. read the content hashes of the indexed documents,
+6. record and read the version of the latest build,
+7. execute sql queries to fetch 
    metadata corresponding to milvus results
 """
 
+import threading
+from contextlib import contextmanager
 
-def postgres_connect():
+
+# pool shared by every function of this module, created on first use
+_POSTGRES_POOL = None
+_POSTGRES_POOL_LOCK = threading.Lock()
+
+
+def _postgres_pool():
     """
-    Connect to Postgres Server
+    Create (once) and return the postgres connection pool.
+    Host, port and pool size can be set with the POSTGRES_HOST,
+    POSTGRES_PORT and POSTGRES_POOL_SIZE environment variables
     """
-    import psycopg2
+    import os
+    from psycopg2.pool import ThreadedConnectionPool
 
-    connection = psycopg2.connect(
-        host="postgres", port="5432", user="postgres", password="postgres"
-    )
-    cursor = connection.cursor()
+    global _POSTGRES_POOL
+    with _POSTGRES_POOL_LOCK:
+        if _POSTGRES_POOL is None:
+            pool_size = int(os.environ.get("POSTGRES_POOL_SIZE", "10"))
+            pool = ThreadedConnectionPool(
+                minconn=1,
+                maxconn=pool_size,
+                host=os.environ.get("POSTGRES_HOST", "postgres"),
+                port=os.environ.get("POSTGRES_PORT", "5432"),
+                user="postgres",
+                password="postgres",
+            )
+            # psycopg2 raises when the pool is exhausted,
+            # this semaphore makes callers wait for a free connection instead
+            pool.slots = threading.BoundedSemaphore(pool_size)
+            _POSTGRES_POOL = pool
+        return _POSTGRES_POOL
 
-    return connection, cursor
 
+@contextmanager
+def postgres_connect():
+    """
+    Borrow a connection to the Postgres Server from the pool.
+    Use as a context manager, the connection goes back to
+    the pool (with any open transaction rolled back) on exit
 
-def postgres_table_creation(table_name):
+    with postgres_connect() as (connection, cursor):
+        ...
+    """
+    pool = _postgres_pool()
+    pool.slots.acquire()
+    connection = pool.getconn()
+    try:
+        with connection.cursor() as cursor:
+            yield connection, cursor
+    finally:
+        broken = connection.closed != 0
+        if not broken:
+            connection.rollback()
+        pool.putconn(connection, close=broken)
+        pool.slots.release()
+
+
+def postgres_table_creation(table_name, drop_existing=False, covering_columns=None):
     """
     This function creates a postgres table to
     store metadata corresponding to the
-    vectors in the milvus vector db
+    vectors in the milvus vector db, keyed
+    (primary key, so b-tree indexed) on the milvus ids,
+    with the filterable fields of src/filters/helpers.py.
+    A table created by an older version gets the
+    primary key and the filter columns added.
 
     Arguments
     ----------
     table_name : string
         name of the postgres table
+    drop_existing : bool
+        drop the table first if it already exists
+    covering_columns : list(str)
+        optional columns to include in a second index on ids,
+        eg: ["title", "url"], so that fetching only those
+        columns is an index-only scan
 
     """
-    connection, cursor = postgres_connect()
+    with postgres_connect() as (connection, cursor):
+        try:
+            if drop_existing:
+                delete_query = "drop table if exists " + table_name
+                cursor.execute(delete_query)
+                connection.commit()
+            create_query = (
+                "create table if not exists "
+                + table_name
+                + " (ids bigint primary key, title text, abstract text, authors text, url text, content_hash text,"
+                + " publish_time integer, journal text, source text, license text);"
+            )
+            cursor.execute(create_query)
 
-    try:
-        # delete_query = "drop table if exists " + table_name
-        # cursor.execute(delete_query)
-        # connection.commit()
-        create_query = (
-            "create table if not exists "
-            + table_name
-            + " (ids bigint, title text, abstract text, authors text, url text);"
+            # tables created before the filter columns
+            for column, column_type in [
+                ("publish_time", "integer"),
+                ("journal", "text"),
+                ("source", "text"),
+                ("license", "text"),
+            ]:
+                cursor.execute(
+                    "alter table "
+                    + table_name
+                    + " add column if not exists "
+                    + column
+                    + " "
+                    + column_type
+                    + ";"
+                )
+
+            # tables created before ids was the primary key
+            cursor.execute(
+                "select 1 from pg_index where indrelid = %s::regclass and indisprimary;",
+                (table_name,),
+            )
+            if cursor.fetchone() is None:
+                cursor.execute("alter table " + table_name + " add primary key (ids);")
+                print(f"Added a primary key on ids to Postgres table {table_name}\n")
+
+            if covering_columns:
+                cursor.execute(
+                    "create index if not exists "
+                    + table_name
+                    + "_ids_covering on "
+                    + table_name
+                    + " (ids) include ("
+                    + ", ".join(covering_columns)
+                    + ");"
+                )
+            connection.commit()
+            print(f"Postgres table {table_name} created successfully\n")
+        except Exception as e:
+            print(f"Postgres table {table_name} creation unsuccessful\n")
+            print(e)
+
+
+class _CopyStream:
+    """
+    Read-only file-like object over an iterator of byte chunks,
+    what cursor.copy_expert() reads the COPY data from. Rows are
+    encoded as they are read, so nothing goes through the disk and
+    only one chunk is held in memory.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            data, self._buffer = self._buffer, b""
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self.bytes_read += len(data)
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def _csv_chunks(rows, rows_per_chunk=1000):
+    """
+    Encode rows as csv, a chunk of rows at a time. Values that are
+    neither strings nor ints (None, NaN) become empty fields, which COPY
+    reads as NULL; NUL characters, which postgres text cannot hold,
+    are dropped.
+    """
+    import csv
+    import io
+    import itertools
+
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, rows_per_chunk))
+        if not batch:
+            return
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerows(
+            [
+                value.replace("\x00", "")
+                if isinstance(value, str)
+                else value if isinstance(value, int) else None
+                for value in row
+            ]
+            for row in batch
         )
-        cursor.execute(create_query)
-        connection.commit()
-        print(f"Postgres table {table_name} created successfully\n")
-    except Exception as e:
-        print(f"Postgres table {table_name} creation unsuccessful\n")
-        print(e)
+        yield buffer.getvalue().encode("utf-8")
 
 
-def postgres_insert_into_table(table_name, df, corresponding_milvus_ids):
+def postgres_insert_into_table(
+    table_name, df, corresponding_milvus_ids, batch_size=50000
+):
     """
     This function inserts into a postgres table, metadata
     corresponding to the milvus vectors in the milvus
     vector db along with its ids.
     Metadata includes milvus_id, title, abstract, authors, url
+    and the content hash of the document
+
+    Rows are streamed from the dataframe straight into COPY, in
+    batches of batch_size rows that are committed one at a time,
+    so memory use stays flat however many rows are loaded.
 
     Arguments
     ----------
@@ -68,46 +232,243 @@ def postgres_insert_into_table(table_name, df, corresponding_milvus_ids):
         your input dataset (pandas dataframe)
     corresponding_milvus_ids : list
         a list containing ids corresponding to milvus vectors
+    batch_size : int
+        number of rows per COPY and commit
 
     """
-    import csv
-    import os
+    import itertools
+    import time
+    from src.filters.helpers import FILTER_FIELD_COLUMNS, filter_columns
 
-    connection, cursor = postgres_connect()
-
-    titles = list(df["title"].values)
-    abstract = list(df["abstract"].values)
-    authors = list(df["authors"].values)
-    url = list(df["url"].values)
-
-    # create a temp file which we will use to copy data into postgres table
-    temp_data_path = "data/artifacts/postgres_table.csv"
-    with open(temp_data_path, "w") as f:
-        writer = csv.writer(f)
-        for i in range(0, len(corresponding_milvus_ids)):
-            writer.writerow(
-                [
-                    str(corresponding_milvus_ids[i]),
-                    titles[i],
-                    abstract[i],
-                    authors[i],
-                    url[i],
-                ]
-            )
+    def column(name):
+        if name in df:
+            return df[name].values
+        return [None] * len(corresponding_milvus_ids)
 
-    # insert rows from stdin
-    try:
-        sql = "COPY " + table_name + " FROM STDIN DELIMITER ',' CSV HEADER"
-        cursor.copy_expert(sql, open(temp_data_path, "r"))
+    # filterable fields, when the dataframe has their dataset columns
+    filters = (
+        filter_columns(df)
+        if all(name in df for name in FILTER_FIELD_COLUMNS.values())
+        else {}
+    )
+
+    columns = ["ids", "title", "abstract", "authors", "url", "content_hash"] + list(
+        filters
+    )
+    no_of_rows = len(corresponding_milvus_ids)
+    rows = iter(
+        zip(
+            [int(id) for id in corresponding_milvus_ids],
+            column("title"),
+            column("abstract"),
+            column("authors"),
+            column("url"),
+            column("content_hash"),
+            *filters.values(),
+        )
+    )
+    sql = f"COPY {table_name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+
+    start = time.perf_counter()
+    no_of_bytes = 0
+    with postgres_connect() as (connection, cursor):
+        for i in range(0, no_of_rows, batch_size):
+            stream = _CopyStream(_csv_chunks(itertools.islice(rows, batch_size)))
+            try:
+                cursor.copy_expert(sql, stream)
+                connection.commit()
+            except Exception as e:
+                connection.rollback()
+                print(
+                    f"Postgres Insertion Failed after {i} of {no_of_rows} rows "
+                    "(earlier batches are committed)\n"
+                )
+                print(e)
+                raise
+            no_of_bytes += stream.bytes_read
+
+    seconds = max(time.perf_counter() - start, 1e-9)
+    print(
+        f"Inserted {no_of_rows} rows of metadata into Postgress table {table_name} "
+        f"in {seconds:.2f}s ({no_of_rows / seconds:.0f} rows/s, "
+        f"{no_of_bytes / seconds / 1e6:.1f} MB/s)\n"
+    )
+
+
+def postgres_delete_ids(table_name, ids):
+    """
+    This function deletes the rows with the given
+    milvus ids from a postgres table
+
+    Arguments
+    ----------
+    table_name : string
+        name of the postgres table
+    ids : list
+        milvus ids of the rows to delete
+
+    """
+    with postgres_connect() as (connection, cursor):
+        try:
+            delete_query = "delete from " + table_name + " where ids = ANY (%s);"
+            cursor.execute(delete_query, ([int(id) for id in ids],))
+            connection.commit()
+        except Exception as e:
+            connection.rollback()
+            print("Postgres Deletion Failed\n")
+            print(e)
+            raise
+
+
+def postgres_table_exists(table_name):
+    """
+    This function checks whether a postgres table exists
+
+    Arguments
+    ----------
+    table_name : string
+        name of the postgres table
+
+    Returns
+    -------
+    exists : bool
+
+    """
+    with postgres_connect() as (connection, cursor):
+        cursor.execute("select to_regclass(%s) is not null;", (table_name,))
+        return cursor.fetchone()[0]
+
+
+def postgres_fetch_content_hashes(table_name):
+    """
+    This function fetches the id and content hash of
+    every document stored in a postgres table
+
+    Arguments
+    ----------
+    table_name : string
+        name of the postgres table
+
+    Returns
+    -------
+    content_hashes : dict
+        {milvus_id: content_hash}
+
+    """
+    with postgres_connect() as (connection, cursor):
+        # a named (server side) cursor streams the rows instead of
+        # materializing the whole result set in one go
+        with connection.cursor(name="content_hashes") as named_cursor:
+            named_cursor.itersize = 50000
+            named_cursor.execute("select ids, content_hash from " + table_name + ";")
+            content_hashes = {id: content_hash for id, content_hash in named_cursor}
+
+    return content_hashes
+
+
+def postgres_set_build_version(table_name, settings=None):
+    """
+    This function records a new, unique version for a
+    table. It is called at the end of every build so that
+    caches of query results can tell the index changed.
+
+    Arguments
+    ----------
+    table_name : string
+        name of the postgres table that was built
+    settings : dict
+        optional settings the index was built with (model, vector
+        dimension, layout), kept as they were if not given
+
+    Returns
+    -------
+    version : string
+
+    """
+    import json
+    import uuid
+
+    version = uuid.uuid4().hex
+    with postgres_connect() as (connection, cursor):
+        cursor.execute(
+            "create table if not exists build_versions "
+            "(table_name text primary key, version text);"
+        )
+        # tables from older builds get the settings column
+        cursor.execute("alter table build_versions add column if not exists settings text;")
+        cursor.execute(
+            "insert into build_versions values (%s, %s, %s) "
+            "on conflict (table_name) do update set version = excluded.version, "
+            "settings = coalesce(excluded.settings, build_versions.settings);",
+            (table_name, version, json.dumps(settings) if settings is not None else None),
+        )
         connection.commit()
-        print(f"Inserted metadata into Postgress table {table_name}\n")
-    except Exception as e:
-        connection.rollback()
-        print("Postgres Insertion Failed\n")
-        print(e)
 
-    # delete the temporary metadata file
-    os.remove(temp_data_path)
+    return version
+
+
+def postgres_get_build_settings(table_name):
+    """
+    This function reads the settings the index of a
+    table was built with (see postgres_set_build_version)
+
+    Arguments
+    ----------
+    table_name : string
+        name of the postgres table
+
+    Returns
+    -------
+    settings : dict or None
+        None if the table was never built, or built
+        before build settings were recorded
+
+    """
+    import json
+
+    with postgres_connect() as (connection, cursor):
+        cursor.execute("select to_regclass('build_versions') is not null;")
+        if not cursor.fetchone()[0]:
+            return None
+        cursor.execute(
+            "select column_name from information_schema.columns "
+            "where table_name = 'build_versions' and column_name = 'settings';"
+        )
+        if cursor.fetchone() is None:
+            return None
+        cursor.execute(
+            "select settings from build_versions where table_name = %s;", (table_name,)
+        )
+        row = cursor.fetchone()
+
+    return json.loads(row[0]) if row and row[0] else None
+
+
+def postgres_get_build_version(table_name):
+    """
+    This function reads the version of the latest build of a table
+
+    Arguments
+    ----------
+    table_name : string
+        name of the postgres table
+
+    Returns
+    -------
+    version : string or None
+        None if the table was never built
+
+    """
+    with postgres_connect() as (connection, cursor):
+        cursor.execute("select to_regclass('build_versions') is not null;")
+        if not cursor.fetchone()[0]:
+            return None
+        cursor.execute(
+            "select version from build_versions where table_name = %s;", (table_name,)
+        )
+        row = cursor.fetchone()
+
+    return row[0] if row else None
 
 
 def postgres_fetch_metadata(milvus_results, table_name):
@@ -117,6 +478,10 @@ def postgres_fetch_metadata(milvus_results, table_name):
     eg: to retrieve title, abstract, authors, and url
     corresponding to a milvus result
 
+    The ids are looked up through the primary key index in a single
+    query, and rows come back in the rank order of the milvus results,
+    with the milvus id and distance attached.
+
     Arguments
     ----------
     milvus_results : list(Tuple)
@@ -128,40 +493,95 @@ def postgres_fetch_metadata(milvus_results, table_name):
     -------
     postgres_result : dict(dict)
         a dict of dict containing title,
-        abstract, authors, url
-        {"0":
+        abstract, authors, url, id and distance,
+        keyed (and ordered) by rank
+        {0:
             {"title":"",
             "abstract":"",
             ...
             ...
+            "id": 0,
+            "distance": 0.0
             },
-        "1":
+        1:
             {...}
         }
 
     """
-    connection, cursor = postgres_connect()
+    with postgres_connect() as (connection, cursor):
+        # dict of dict containing title, abstract, authors, url for each result row
+        postgres_result = {}
+
+        # indexing and fetching by milvus id, "with ordinality"
+        # numbers the ids so the rows can be sorted by milvus rank
+        milvus_result_ids = [int(result.id) for result in milvus_results]
+        fetch_query = (
+            "select r.rank - 1, t.title, t.abstract, t.authors, t.url from "
+            + "unnest(%s::bigint[]) with ordinality as r(ids, rank) join "
+            + table_name
+            + " t on t.ids = r.ids order by r.rank;"
+        )
+        cursor.execute(fetch_query, (milvus_result_ids,))
+        all_rows = cursor.fetchall()
+
+        for rank, title, abstract, authors, url in all_rows:
+            postgres_result[rank] = {
+                "title": title,
+                "abstract": abstract,
+                "authors": authors,
+                "url": url,
+                "id": milvus_results[rank].id,
+                "distance": milvus_results[rank].distance,
+            }
+
+        return postgres_result
+
+
+def postgres_fetch_metadata_many(milvus_results_list, table_name):
+    """
+    This function fetches the metadata of the results of many
+    searches in a single query, each distinct id once
 
-    # dict of dict containing title, abstract, authors, url for each result row
-    postgres_result = {}
+    Arguments
+    ----------
+    milvus_results_list : list(list(Tuple))
+        the milvus results of every query
+    table_name : string
+        name of the postgres table
 
-    # indexing and fetching by milvus id
-    milvus_result_ids = [result.id for result in milvus_results]
-    fetch_query = (
-        "select title, abstract, authors, url from "
-        + table_name
-        + " where ids = ANY (%s);"
-    )
-    cursor.execute(fetch_query, (milvus_result_ids,))
-    all_rows = cursor.fetchall()
-
-    for id, rows in enumerate(all_rows):
-        id_result = {}
-        if len(rows):
-            id_result["title"] = rows[0]
-            id_result["abstract"] = rows[1]
-            id_result["authors"] = rows[2]
-            id_result["url"] = rows[3]
-            postgres_result[id] = id_result
-
-    return postgres_result
+    Returns
+    -------
+    postgres_results : list(dict(dict))
+        for every query, the dict returned by postgres_fetch_metadata
+
+    """
+    with postgres_connect() as (connection, cursor):
+        ids = list(
+            {int(result.id) for milvus_results in milvus_results_list for result in milvus_results}
+        )
+        fetch_query = (
+            "select t.ids, t.title, t.abstract, t.authors, t.url from "
+            + table_name
+            + " t where t.ids = any(%s::bigint[]);"
+        )
+        cursor.execute(fetch_query, (ids,))
+        rows = {row[0]: row[1:] for row in cursor.fetchall()}
+
+    postgres_results = []
+    for milvus_results in milvus_results_list:
+        postgres_result = {}
+        for rank, result in enumerate(milvus_results):
+            row = rows.get(int(result.id))
+            if row is None:
+                continue
+            title, abstract, authors, url = row
+            postgres_result[rank] = {
+                "title": title,
+                "abstract": abstract,
+                "authors": authors,
+                "url": url,
+                "id": result.id,
+                "distance": result.distance,
+            }
+        postgres_results.append(postgres_result)
+    return postgres_results
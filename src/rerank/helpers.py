@@ -0,0 +1,173 @@
+"""
+This module has a rerank stage between the ANN search and the prompt:
+more candidates than needed are fetched, rescored, and the best k kept.
+1. exact rerank: the inner product of the query with the stored full
+   precision vectors of the candidates, which corrects the approximate
+   distances of a quantized index (eg: IVF_SQ8). Passages of a document
+   are rescored together and the best one stands for it. In hybrid
+   search it rescores the vector ranking, before fusion.
+2. cross-encoder rerank: a local CPU model (sentence-transformers)
+   scores every (query, title + abstract) pair. Candidates are scored
+   in batches, best ranked first, until the latency budget is spent;
+   the rest keep their order behind the scored ones.
+"""
+
+import functools
+
+from src.vectorstore.helpers import SearchHit
+
+RERANK_METHODS = ["exact", "cross_encoder"]
+
+# candidates fetched for reranking
+RERANK_DEPTH = 50
+
+# milliseconds the cross-encoder may spend per query
+RERANK_BUDGET_MS = 200
+
+# a small MS MARCO cross-encoder, fast enough on CPU
+CROSS_ENCODER_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+
+def exact_rerank(vector_store, query_embedding, search_results, k, passages=False):
+    """
+    This function rescores search hits with the exact inner
+    product of the query and their stored vectors
+
+    Arguments
+    ----------
+    vector_store : src.vectorstore.helpers.VectorStore
+        the store that was searched
+    query_embedding : list(float)
+        the query vector
+    search_results : list(SearchHit)
+        the candidates, best first
+    k : int
+        number of results to keep
+    passages : bool
+        whether the collection holds passages (as at build time),
+        hits are then documents and all their passages are rescored
+
+    Returns
+    -------
+    results : list(SearchHit)
+        best first, with the exact inner product as distance. Hits
+        without a stored vector (eg: deleted since) come last.
+
+    """
+    import numpy as np
+    from src.dataset.helpers import PARENT_ID_MASK, passage_ids
+
+    if not search_results:
+        return []
+    doc_ids = [int(hit.id) for hit in search_results]
+    found_ids, vectors = vector_store.get_vectors(
+        passage_ids(doc_ids) if passages else doc_ids
+    )
+    scores = (
+        vectors @ np.asarray(query_embedding, dtype=np.float32)
+        if len(found_ids)
+        else np.zeros(0, dtype=np.float32)
+    )
+
+    # best score of every document, in one pass from the best down
+    order = np.argsort(-scores, kind="stable")
+    parents = found_ids[order] & PARENT_ID_MASK if passages else found_ids[order]
+    best = {}
+    for parent_id, score in zip(parents.tolist(), scores[order].tolist()):
+        best.setdefault(parent_id, score)
+
+    hits = {int(hit.id): hit for hit in search_results}
+    rescored = [
+        SearchHit(id, score, getattr(hits[id], "payload", None))
+        for id, score in best.items()
+        if id in hits
+    ]
+    rescored += [hit for hit in search_results if int(hit.id) not in best]
+    return rescored[:k]
+
+
+@functools.lru_cache(maxsize=None)
+def get_cross_encoder(model_name=CROSS_ENCODER_MODEL):
+    """
+    This function returns a long-lived cross-encoder on CPU
+
+    Arguments
+    ----------
+    model_name : string
+        sentence-transformers cross-encoder name or path
+
+    Returns
+    -------
+    model : sentence_transformers.CrossEncoder
+
+    """
+    try:
+        from sentence_transformers import CrossEncoder
+    except ImportError:
+        raise ImportError(
+            "cross-encoder reranking needs sentence-transformers: "
+            "pip install sentence-transformers"
+        )
+
+    return CrossEncoder(model_name, device="cpu")
+
+
+def cross_encoder_rerank(
+    query,
+    metadata,
+    k,
+    model_name=CROSS_ENCODER_MODEL,
+    batch_size=16,
+    budget_ms=RERANK_BUDGET_MS,
+):
+    """
+    This function reorders search results by the score of a
+    cross-encoder, within a latency budget
+
+    Arguments
+    ----------
+    query : string
+        the query text
+    metadata : dict(dict)
+        the candidates, as returned by
+        src.postgres.helpers.postgres_fetch_metadata
+    k : int
+        number of results to keep
+    model_name : string
+        sentence-transformers cross-encoder name or path
+    batch_size : int
+        pairs scored per forward pass
+    budget_ms : float
+        no new batch is started once this many milliseconds have
+        passed, unscored candidates keep their order after the others
+
+    Returns
+    -------
+    metadata : dict(dict)
+        the best k, re-numbered from 0, scored ones with a "rerank_score"
+
+    """
+    import time
+
+    model = get_cross_encoder(model_name)
+    start = time.perf_counter()
+    candidates = [value for _, value in sorted(metadata.items())]
+    scores = []
+    for i in range(0, len(candidates), batch_size):
+        if (time.perf_counter() - start) * 1000 >= budget_ms:
+            break
+        pairs = [
+            (query, ". ".join(filter(None, [value.get("title"), value.get("abstract")])))
+            for value in candidates[i : i + batch_size]
+        ]
+        scores.extend(float(score) for score in model.predict(pairs, batch_size=batch_size))
+
+    scored = sorted(
+        (
+            {**value, "rerank_score": score}
+            for value, score in zip(candidates, scores)
+        ),
+        key=lambda value: -value["rerank_score"],
+    )
+    reranked = scored + candidates[len(scores) :]
+    return dict(enumerate(reranked[:k]))
@@ -0,0 +1,321 @@
+"""
+This module has an asyncio version of the inference pipeline.
+Many queries can be served concurrently from one process: while
+one query waits on OpenAI, others can search milvus or fetch
+their metadata from postgres.
+
+OpenAI calls use the AsyncOpenAI client. pymilvus, the local vector
+store and psycopg2 have no asyncio api, so vector searches and postgres
+fetches run in worker threads on the shared, pooled connections.
+
+Every stage is a method of InferenceStages, pass a subclass with
+fake stages to async_inference() to benchmark the pipeline itself
+(see cli/benchmark_inference.py).
+"""
+
+import asyncio
+import functools
+
+from src.cache.helpers import EMBEDDING_CACHE_PATH, get_embedding_cache
+from src.lexical.helpers import (
+    FUSION_DEPTH,
+    get_lexical_index,
+    lexical_search_documents,
+    reciprocal_rank_fusion,
+)
+from src.model.helpers import (
+    CONTEXT_TOKENS,
+    chat_messages,
+    embed_query,
+    generate_prompt_with_context,
+)
+from src.model.providers import OpenAIEmbeddingProvider, get_embedding_provider
+from src.postgres.helpers import postgres_fetch_metadata
+from src.tracing.helpers import start_trace
+from src.vectorstore.helpers import (
+    MAX_SEARCH_LIMIT,
+    PAYLOAD_FIELDS,
+    get_vector_store,
+    search_documents,
+    search_results_metadata,
+)
+
+
+@functools.lru_cache(maxsize=None)
+def async_openai_client(openai_api_key, base_url=None):
+    """
+    This function returns an AsyncOpenAI client, created once per
+    (api key, base url). The client must be used from a single
+    event loop.
+
+    Arguments
+    ----------
+    openai_api_key : string
+        OpenAI api key
+    base_url : string
+        optional OpenAI-compatible endpoint
+
+    Returns
+    -------
+    client : openai.AsyncOpenAI
+
+    """
+    from openai import AsyncOpenAI
+
+    return AsyncOpenAI(api_key=openai_api_key, base_url=base_url)
+
+
+class InferenceStages:
+    """
+    The stages of the inference pipeline, as coroutines
+
+    Arguments
+    ----------
+    openai_api_key : string
+        OpenAI api key
+    model_name : string
+        embedding model name (the one used at build time)
+    collection_name : string
+        name of the milvus collection and postgres table
+    index_name : string
+        name of the milvus index
+    search_params : dict
+        milvus search parameters
+    embedding_cache : src.cache.helpers.EmbeddingCache
+        optional embedding cache shared with the build
+    vector_store : string
+        "milvus" or "local"
+    metadata_store : string
+        "postgres" or "vector_store" (as at build time)
+    passages : bool
+        whether the collection holds passages (as at build time)
+    hybrid : bool
+        also search the BM25 index and fuse the rankings
+    """
+
+    def __init__(
+        self,
+        openai_api_key,
+        model_name,
+        collection_name="rag_search",
+        index_name="Embedding",
+        search_params=None,
+        embedding_cache=None,
+        vector_store="milvus",
+        metadata_store="postgres",
+        passages=False,
+        hybrid=False,
+    ):
+        self.openai_api_key = openai_api_key
+        self.model_name = model_name
+        self.collection_name = collection_name
+        self.index_name = index_name
+        self.search_params = search_params or {
+            "metric_type": "IP",
+            "params": {"nprobe": 128},
+        }
+        self.embedding_cache = embedding_cache
+        self.metadata_store = metadata_store
+        self.passages = passages
+        self.hybrid = hybrid
+        self.vector_store = get_vector_store(
+            backend=vector_store, collection_name=collection_name, index_name=index_name
+        )
+
+    async def prepare(self):
+        """
+        Make sure the collection is loaded, runs alongside embed()
+        """
+        await asyncio.to_thread(self.vector_store.load)
+
+    async def embed(self, query):
+        """
+        Embed the query, local embedding models run in a worker thread
+        """
+        provider = get_embedding_provider(self.model_name, self.openai_api_key)
+        if not isinstance(provider, OpenAIEmbeddingProvider):
+            return await asyncio.to_thread(
+                embed_query,
+                openai_api_key=self.openai_api_key,
+                query=query,
+                model_name=self.model_name,
+                embedding_cache=self.embedding_cache,
+            )
+
+        text = query.replace("\n", " ")
+        if self.embedding_cache is not None:
+            cached = await asyncio.to_thread(
+                self.embedding_cache.get_many, provider.name, [text]
+            )
+            if cached[0] is not None:
+                return cached[0].tolist()
+
+        client = async_openai_client(self.openai_api_key)
+        response = await client.embeddings.create(input=[text], model=self.model_name)
+        query_embedding = response.data[0].embedding
+        if self.embedding_cache is not None:
+            await asyncio.to_thread(
+                self.embedding_cache.put_many, provider.name, [text], [query_embedding]
+            )
+        return query_embedding
+
+    async def search(self, query_embedding, k, filters=None):
+        """
+        ANN search for the query embedding, restricted to
+        the documents that match filters
+        """
+        return await asyncio.to_thread(
+            search_documents,
+            self.vector_store,
+            query_embedding=query_embedding,
+            search_params=self.search_params,
+            k=k,
+            output_fields=PAYLOAD_FIELDS if self.metadata_store == "vector_store" else None,
+            filters=filters,
+            passages=self.passages,
+        )
+
+    async def lexical_search(self, query, k, filters=None):
+        """
+        BM25 search for the query text, in a worker thread
+        """
+        return await asyncio.to_thread(
+            lexical_search_documents,
+            get_lexical_index(self.collection_name),
+            query,
+            k,
+            filters=filters,
+            passages=self.passages,
+        )
+
+    async def fetch(self, milvus_results):
+        """
+        Fetch the metadata of the search results
+        """
+        # lexical-only hits carry no payload
+        if self.metadata_store == "vector_store" and all(
+            getattr(hit, "payload", None) is not None for hit in milvus_results
+        ):
+            return search_results_metadata(milvus_results)
+        return await asyncio.to_thread(
+            postgres_fetch_metadata,
+            milvus_results=milvus_results,
+            table_name=self.collection_name,
+        )
+
+    async def complete(self, prompt):
+        """
+        Chat completion for the prompt
+        """
+        client = async_openai_client(self.openai_api_key)
+        response = await client.chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=chat_messages(prompt),
+        )
+        return response.choices[0].message.content
+
+
+async def async_inference(arguments, stages=None):
+    """
+    This function is the asyncio counterpart of
+    src.tasks.inference.inference. Given a query,
+    it returns the model's response.
+
+    Arguments
+    ----------
+    arguments : dict
+        a dict contaning search parameters
+        {"query":"","no_of_results":"","model_name":"", "openai_api_key":""}
+        optional: "embedding_cache", "no_embedding_cache", "vector_store",
+        "metadata_store", "filters", "passages", "hybrid", "context_tokens"
+    stages : InferenceStages
+        optional pipeline stages, defaults to the real
+        OpenAI, milvus and postgres ones
+
+    Returns
+    -------
+    model_response : str
+
+    """
+
+    # cli variables
+    _QUERY = arguments["query"]
+    _NO_OF_RESULTS = (
+        arguments["no_of_results"] if "no_of_results" in arguments else 10
+    )  # optional with default value 10
+
+    if stages is None:
+        _EMBEDDING_CACHE_PATH = arguments.get("embedding_cache") or EMBEDDING_CACHE_PATH
+        _USE_EMBEDDING_CACHE = not arguments.get("no_embedding_cache", False)
+        stages = InferenceStages(
+            openai_api_key=arguments["openai_api_key"],
+            model_name=arguments["model_name"],
+            embedding_cache=(
+                get_embedding_cache(_EMBEDDING_CACHE_PATH)
+                if _USE_EMBEDDING_CACHE
+                else None
+            ),
+            vector_store=arguments.get("vector_store") or "milvus",
+            metadata_store=arguments.get("metadata_store") or "postgres",
+            passages=arguments.get("passages", False),
+            hybrid=arguments.get("hybrid", False),
+        )
+
+    # timing spans, recorded with those of inference() (see src/tracing/helpers.py)
+    _FILTERS = arguments.get("filters") or None
+    # both rankings are fused from deeper result lists than k
+    depth = (
+        min(max(_NO_OF_RESULTS, FUSION_DEPTH), MAX_SEARCH_LIMIT)
+        if stages.hybrid
+        else _NO_OF_RESULTS
+    )
+
+    trace = start_trace(
+        "async_inference", no_of_results=_NO_OF_RESULTS, hybrid=stages.hybrid
+    )
+    lexical_search = None
+    try:
+        # BM25 search only needs the query text, it runs
+        # alongside query embedding and vector search
+        if stages.hybrid:
+            lexical_search = asyncio.ensure_future(
+                stages.lexical_search(_QUERY, depth, _FILTERS)
+            )
+
+        # query embedding and collection loading do not depend on each other
+        with trace.span("embed_query"):
+            query_embedding, _ = await asyncio.gather(
+                stages.embed(_QUERY), stages.prepare()
+            )
+
+        # ANN search
+        with trace.span("search"):
+            milvus_results = await stages.search(query_embedding, depth, _FILTERS)
+
+        # reciprocal rank fusion of the two rankings
+        if lexical_search is not None:
+            with trace.span("lexical_search_wait"):
+                lexical_hits = await lexical_search
+            milvus_results = reciprocal_rank_fusion(
+                [milvus_results, lexical_hits], _NO_OF_RESULTS
+            )
+
+        # metadata for top-k
+        with trace.span("fetch_metadata"):
+            postgres_results = await stages.fetch(milvus_results)
+
+        # curate prompt using content from top-k
+        with trace.span("generate_prompt"):
+            prompt = generate_prompt_with_context(
+                postgres_results,
+                _QUERY,
+                max_context_tokens=arguments.get("context_tokens") or CONTEXT_TOKENS,
+            )
+
+        # chat completion
+        with trace.span("complete"):
+            return await stages.complete(prompt)
+    finally:
+        if lexical_search is not None and not lexical_search.done():
+            lexical_search.cancel()
+        trace.finish()
@@ -0,0 +1,287 @@
+"""
+This module has a function that answers many queries in one call,
+for offline evaluation and bulk question sets. Queries go through the
+pipeline of src/tasks/inference.py a batch at a time: the batch is
+embedded in batched requests, searched with one multi-vector ANN search,
+and the metadata of all its results is fetched in one postgres query.
+Chat completions run in a bounded pool of worker threads, overlapping
+the retrieval of the next batches.
+
+Results are yielded one per query, in input order, as soon as they are
+ready. The query response cache is not used.
+"""
+
+from src.cache.helpers import EMBEDDING_CACHE_PATH, get_embedding_cache
+from src.lexical.helpers import (
+    FUSION_DEPTH,
+    get_lexical_index,
+    lexical_search_documents,
+    reciprocal_rank_fusion,
+)
+from src.model.helpers import (
+    CONTEXT_TOKENS,
+    embed_queries,
+    generate_prompt_with_context,
+    prompt_model,
+)
+from src.postgres.helpers import postgres_fetch_metadata_many
+from src.rerank.helpers import (
+    CROSS_ENCODER_MODEL,
+    RERANK_BUDGET_MS,
+    RERANK_DEPTH,
+    cross_encoder_rerank,
+    exact_rerank,
+)
+from src.tracing.helpers import configure_tracing, start_trace
+from src.vectorstore.helpers import (
+    MAX_SEARCH_LIMIT,
+    PAYLOAD_FIELDS,
+    get_vector_store,
+    search_documents_many,
+    search_results_metadata,
+)
+
+
+def read_queries(filepath):
+    """
+    This function reads a question set: one query per line, as
+    plain text or as a json object with a "query" and optional "id"
+
+    Arguments
+    ----------
+    filepath : string
+        path to the queries file
+
+    Returns
+    -------
+    queries : list(dict)
+        [{"id": "", "query": ""}, ...], ids default to the line number
+
+    """
+    import json
+
+    queries = []
+    with open(filepath, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            query = {"id": line_no, "query": line}
+            if line.startswith("{"):
+                query.update(json.loads(line))
+            queries.append(query)
+    return queries
+
+
+def batch_inference(arguments):
+    """
+    This function answers every query of a question set
+
+    Arguments
+    ----------
+    arguments : dict
+        a dict contaning search parameters
+        {"queries":[{"id":"", "query":""}],"no_of_results":"","model_name":"", "openai_api_key":""}
+        optional: "batch_size" (queries per embedding and search
+        request), "generation_workers" (chat completions in flight),
+        and those of src.tasks.inference.inference: "embedding_cache",
+        "no_embedding_cache", "vector_store", "metadata_store", "filters"
+        (for every query), "passages", "hybrid", "context_tokens",
+        "rerank", "rerank_depth", "rerank_budget_ms", "rerank_model",
+        "trace_sinks"
+
+    Returns
+    -------
+    results : generator(dict)
+        for every query, in input order:
+        {"id": "", "query": "", "results": [{"id": 0, "distance": 0.0,
+         "title": "", "url": ""}], "response": ""}
+
+    """
+    import collections
+    from concurrent.futures import ThreadPoolExecutor
+
+    # db variables
+    _MILVUS_COLLECTION_NAME = _POSTGRES_TABLE_NAME = "rag_search"
+    _MILVUS_INDEX_NAME = "Embedding"
+    _MILVUS_SEARCH_PARAM = {"metric_type": "IP", "params": {"nprobe": 128}}
+
+    # cli variables
+    _QUERIES = arguments["queries"]
+    _NLP_MODEL_NAME = arguments["model_name"]
+    _NO_OF_RESULTS = (
+        arguments["no_of_results"] if "no_of_results" in arguments else 10
+    )  # optional with default value 10
+    _OPENAI_KEY = arguments["openai_api_key"]
+    _BATCH_SIZE = arguments.get("batch_size") or 64
+    _GENERATION_WORKERS = arguments.get("generation_workers") or 8
+    _EMBEDDING_CACHE_PATH = arguments.get("embedding_cache") or EMBEDDING_CACHE_PATH
+    _USE_EMBEDDING_CACHE = not arguments.get("no_embedding_cache", False)
+    _VECTOR_STORE = arguments.get("vector_store") or "milvus"
+    _METADATA_STORE = arguments.get("metadata_store") or "postgres"
+    _FILTERS = arguments.get("filters") or None
+    _PASSAGES = arguments.get("passages", False)
+    _HYBRID = arguments.get("hybrid", False)
+    _CONTEXT_TOKENS = arguments.get("context_tokens") or CONTEXT_TOKENS
+    _RERANK = arguments.get("rerank") or []
+    # candidates per query, the cross-encoder needs the metadata of all of them
+    _CANDIDATES = (
+        min(max(_NO_OF_RESULTS, arguments.get("rerank_depth") or RERANK_DEPTH), MAX_SEARCH_LIMIT)
+        if _RERANK
+        else _NO_OF_RESULTS
+    )
+
+    embedding_cache = (
+        get_embedding_cache(_EMBEDDING_CACHE_PATH) if _USE_EMBEDDING_CACHE else None
+    )
+    vector_store = get_vector_store(
+        backend=_VECTOR_STORE,
+        collection_name=_MILVUS_COLLECTION_NAME,
+        index_name=_MILVUS_INDEX_NAME,
+    )
+    vector_store.load()
+    lexical_index = get_lexical_index(_MILVUS_COLLECTION_NAME) if _HYBRID else None
+    depth = (
+        min(max(_CANDIDATES, FUSION_DEPTH), MAX_SEARCH_LIMIT)
+        if _HYBRID
+        else _CANDIDATES
+    )
+    if arguments.get("trace_sinks") is not None:
+        configure_tracing(arguments["trace_sinks"])
+
+    def retrieve(batch):
+        # one trace per batch, the completions run after it ends
+        trace = start_trace(
+            "batch_inference", queries=len(batch), no_of_results=_NO_OF_RESULTS
+        )
+        try:
+            texts = [query["query"] for query in batch]
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                # BM25 searches run while the batch is embedded and searched
+                lexical_searches = [
+                    executor.submit(
+                        lexical_search_documents,
+                        lexical_index,
+                        text,
+                        depth,
+                        filters=_FILTERS,
+                        passages=_PASSAGES,
+                    )
+                    for text in (texts if _HYBRID else [])
+                ]
+
+                # query embeddings, in batched requests
+                with trace.span("embed_query"):
+                    query_embeddings = embed_queries(
+                        openai_api_key=_OPENAI_KEY,
+                        queries=texts,
+                        model_name=_NLP_MODEL_NAME,
+                        embedding_cache=embedding_cache,
+                    )
+
+                # one multi-vector ANN search
+                with trace.span("search"):
+                    results = search_documents_many(
+                        vector_store,
+                        query_embeddings=query_embeddings,
+                        search_params=_MILVUS_SEARCH_PARAM,
+                        k=depth,
+                        output_fields=PAYLOAD_FIELDS
+                        if _METADATA_STORE == "vector_store"
+                        else None,
+                        filters=_FILTERS,
+                        passages=_PASSAGES,
+                    )
+
+                # rescore the vector hits on the stored vectors, before
+                # fusion (see src/rerank/helpers.py)
+                if "exact" in _RERANK:
+                    with trace.span("exact_rerank"):
+                        results = [
+                            exact_rerank(
+                                vector_store,
+                                query_embedding,
+                                hits,
+                                len(hits),
+                                passages=_PASSAGES,
+                            )
+                            for query_embedding, hits in zip(query_embeddings, results)
+                        ]
+
+                if _HYBRID:
+                    with trace.span("lexical_search_wait"):
+                        lexical_results = [search.result() for search in lexical_searches]
+                    results = [
+                        reciprocal_rank_fusion([hits, lexical_hits], _CANDIDATES)
+                        for hits, lexical_hits in zip(results, lexical_results)
+                    ]
+            if "cross_encoder" not in _RERANK:
+                results = [hits[:_NO_OF_RESULTS] for hits in results]
+
+            # metadata of the whole batch, in one round-trip
+            with trace.span("fetch_metadata"):
+                if _METADATA_STORE == "vector_store" and all(
+                    hit.payload is not None for hits in results for hit in hits
+                ):
+                    metadata = [search_results_metadata(hits) for hits in results]
+                else:
+                    metadata = postgres_fetch_metadata_many(
+                        results, table_name=_POSTGRES_TABLE_NAME
+                    )
+
+            if "cross_encoder" in _RERANK:
+                with trace.span("cross_encoder_rerank"):
+                    metadata = [
+                        cross_encoder_rerank(
+                            text,
+                            candidates,
+                            _NO_OF_RESULTS,
+                            model_name=arguments.get("rerank_model") or CROSS_ENCODER_MODEL,
+                            budget_ms=arguments.get("rerank_budget_ms") or RERANK_BUDGET_MS,
+                        )
+                        for text, candidates in zip(texts, metadata)
+                    ]
+            return metadata
+        finally:
+            trace.finish()
+
+    def answer(query, metadata):
+        prompt = generate_prompt_with_context(
+            metadata, query["query"], max_context_tokens=_CONTEXT_TOKENS
+        )
+        try:
+            response = prompt_model(prompt, _OPENAI_KEY)
+        except Exception as e:
+            print(f"Failed to answer query {query['id']}")
+            print(e)
+            response = None
+        return {
+            "id": query["id"],
+            "query": query["query"],
+            "results": [
+                {
+                    "id": int(value["id"]),
+                    "distance": float(value["distance"]),
+                    "title": value["title"],
+                    "url": value["url"],
+                }
+                for _, value in sorted(metadata.items())
+            ],
+            "response": response,
+        }
+
+    # at most this many answers are pending, retrieval
+    # waits for generation to catch up beyond it
+    max_pending = max(_BATCH_SIZE, 2 * _GENERATION_WORKERS)
+    pending = collections.deque()
+    with ThreadPoolExecutor(
+        max_workers=_GENERATION_WORKERS, thread_name_prefix="generation"
+    ) as executor:
+        for start in range(0, len(_QUERIES), _BATCH_SIZE):
+            batch = _QUERIES[start : start + _BATCH_SIZE]
+            for query, metadata in zip(batch, retrieve(batch)):
+                pending.append(executor.submit(answer, query, metadata))
+            while len(pending) > max_pending or (pending and pending[0].done()):
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -1,15 +1,62 @@
 """
-This module has a function that will load your dataset, 
-preprocess it, create vector embeddings, create a milvus collection and an index, 
-push the vectors into the milvus collection, create a postgres table, 
-and store metadata into postgres.
+This module has a function that will load your dataset,
+preprocess it, create vector embeddings, create a milvus collection and an index,
+push the vectors into the milvus collection, create a postgres table,
+and store metadata into postgres. The vectors can go to the in-process
+local vector store instead of milvus (see src/vectorstore/helpers.py).
 
+The csv file is streamed in chunks (shards) that go through load ->
+preprocess -> embed -> milvus insert -> postgres copy one at a time, so
+memory use is bounded by the shard size. The embeddings of every shard are
+written under data/artifacts/ (as float32, float16 or int8 matrices, read
+back memory-mapped), and a manifest records which stages have finished,
+so an interrupted build can be resumed.
+
+In incremental mode the dataset is instead diffed against what is already
+indexed (by document id and content hash): only new or changed documents
+are embedded and upserted, and documents that disappeared are deleted from
+both milvus and postgres.
+
+In passage mode the abstracts are chunked into overlapping passages that
+are embedded and indexed one by one (see src/dataset/helpers.py), while
+postgres keeps one row per document.
+
+The same texts are also indexed in a BM25 inverted index (see
+src/lexical/helpers.py), for hybrid lexical + vector retrieval.
 """
 
-from src.dataset.helpers import load_dataset, preprocess_dataset
-from src.model.helpers import generate_openai_embeddings
-from src.milvus.helpers import milvus_collection_creation, milvus_insert_into_db
-from src.postgres.helpers import postgres_table_creation, postgres_insert_into_table
+from src.cache.helpers import EMBEDDING_CACHE_PATH, EmbeddingCache
+from src.checkpoint.helpers import (
+    EMBEDDING_DTYPES,
+    clear_checkpoints,
+    load_manifest,
+    load_shard_embeddings,
+    new_manifest,
+    save_manifest,
+    save_shard_embeddings,
+    shard_status,
+)
+from src.dataset.helpers import (
+    PARENT_ID_MASK,
+    chunk_passages,
+    load_dataset_in_chunks,
+    passage_ids,
+)
+from src.filters.helpers import FILTER_FIELDS, filter_columns
+from src.lexical.helpers import get_lexical_index
+from src.model.helpers import generate_embeddings
+from src.model.providers import get_embedding_provider
+from src.postgres.helpers import (
+    postgres_delete_ids,
+    postgres_fetch_content_hashes,
+    postgres_get_build_settings,
+    postgres_insert_into_table,
+    postgres_set_build_version,
+    postgres_table_creation,
+    postgres_table_exists,
+)
+from src.tracing.helpers import configure_tracing, start_trace
+from src.vectorstore.helpers import PAYLOAD_FIELDS, get_vector_store, payload_columns
 
 
 def build(arguments):
@@ -23,13 +70,42 @@ def build(arguments):
     arguments : dict
         a dict contaning build arguments
         {"data_path":"","model_name":"","openai_api_key":""}
+        optional: "embedding_batch_size", "embedding_max_batch_tokens",
+        "embedding_workers", "openai_base_url", "resume", "shard_size",
+        "artifacts_dir", "embedding_cache", "no_embedding_cache",
+        "incremental", "vector_store" ("milvus" or "local"), "trace_sinks",
+        "metadata_store" ("postgres", or "vector_store" to also keep
+        title, abstract, authors and url next to the vectors), "passages",
+        "passage_tokens", "passage_overlap", "no_lexical_index",
+        "embedding_dtype" (storage type of the shard embeddings:
+        "float32", "float16" or "int8")
 
     """
 
     # cli variables
     _PATH_TO_DATA = arguments["data_path"]
     _NLP_MODEL_NAME = arguments["model_name"]
-    _OPENAI_KEY = arguments["openai_api_key"]
+    _OPENAI_KEY = arguments.get("openai_api_key")
+    _OPENAI_BASE_URL = arguments.get("openai_base_url")
+    _EMBEDDING_BATCH_SIZE = arguments.get("embedding_batch_size") or 256
+    _EMBEDDING_MAX_BATCH_TOKENS = arguments.get("embedding_max_batch_tokens") or 100000
+    _EMBEDDING_WORKERS = arguments.get("embedding_workers") or 8
+    _RESUME = arguments.get("resume", False)
+    _INCREMENTAL = arguments.get("incremental", False)
+    _VECTOR_STORE = arguments.get("vector_store") or "milvus"
+    _METADATA_STORE = arguments.get("metadata_store") or "postgres"
+    _SHARD_SIZE = arguments.get("shard_size") or 10000
+    _EMBEDDING_CACHE_PATH = arguments.get("embedding_cache") or EMBEDDING_CACHE_PATH
+    _USE_EMBEDDING_CACHE = not arguments.get("no_embedding_cache", False)
+    _PASSAGES = arguments.get("passages", False)
+    _PASSAGE_TOKENS = arguments.get("passage_tokens") or 256
+    _PASSAGE_OVERLAP = arguments.get("passage_overlap") or 64
+    _LEXICAL_INDEX = not arguments.get("no_lexical_index", False)
+    _EMBEDDING_DTYPE = arguments.get("embedding_dtype") or "float32"
+    if _EMBEDDING_DTYPE not in EMBEDDING_DTYPES:
+        raise ValueError(
+            f"Unknown embedding dtype {_EMBEDDING_DTYPE}, choose one of {list(EMBEDDING_DTYPES)}"
+        )
 
     # db variables
     _MILVUS_COLLECTION_NAME = _POSTGRES_TABLE_NAME = "rag_search"
@@ -40,39 +116,351 @@ def build(arguments):
         "params": {"nlist": 4096},  # 4 × sqrt(n), n = entities in a segment
     }
 
-    try:
-        # load and pre-process dataset
-        df = load_dataset(filepath=_PATH_TO_DATA)
-        df = preprocess_dataset(df=df)
+    # single-store mode: search hits carry their metadata, postgres
+    # keeps the full records (content hashes, incremental builds)
+    _PAYLOAD_FIELDS = PAYLOAD_FIELDS if _METADATA_STORE == "vector_store" else None
+
+    # checkpoint variables
+    _ARTIFACTS_DIR = arguments.get("artifacts_dir") or "data/artifacts/" + _MILVUS_COLLECTION_NAME
+
+    embedding_cache = (
+        EmbeddingCache(_EMBEDDING_CACHE_PATH) if _USE_EMBEDDING_CACHE else None
+    )
+    provider = get_embedding_provider(
+        _NLP_MODEL_NAME,
+        openai_api_key=_OPENAI_KEY,
+        base_url=_OPENAI_BASE_URL,
+        batch_size=_EMBEDDING_BATCH_SIZE,
+        max_batch_tokens=_EMBEDDING_MAX_BATCH_TOKENS,
+        max_workers=_EMBEDDING_WORKERS,
+    )
+    vector_store = get_vector_store(
+        backend=_VECTOR_STORE,
+        collection_name=_MILVUS_COLLECTION_NAME,
+        index_name=_MILVUS_INDEX_NAME,
+    )
+    lexical_index = get_lexical_index(_MILVUS_COLLECTION_NAME) if _LEXICAL_INDEX else None
+
+    # a timing span around every stage, see src/tracing/helpers.py
+    if arguments.get("trace_sinks") is not None:
+        configure_tracing(arguments["trace_sinks"])
+    trace = start_trace(
+        "build",
+        model_name=_NLP_MODEL_NAME,
+        vector_store=_VECTOR_STORE,
+        incremental=_INCREMENTAL,
+        shard_size=_SHARD_SIZE,
+        passages=_PASSAGES,
+    )
+
+    # a document key may appear more than once in the dataset,
+    # only its first occurrence is indexed
+    seen_ids = set()
+
+    def unique_shards():
+        shards = load_dataset_in_chunks(filepath=_PATH_TO_DATA, chunksize=_SHARD_SIZE)
+        for shard_df in trace.iterate("load_shard", shards):
+            if _PASSAGES:
+                # leave the low bits of the ids to the passage numbers
+                shard_df = shard_df.assign(doc_id=shard_df["doc_id"] & PARENT_ID_MASK)
+            shard_df = shard_df.drop_duplicates(subset="doc_id")
+            shard_df = shard_df[~shard_df["doc_id"].isin(seen_ids)]
+            seen_ids.update(shard_df["doc_id"].tolist())
+            yield shard_df
 
+    def vector_rows(shard_df):
+        # the rows that get a vector: documents, or their passages
+        if not _PASSAGES:
+            return shard_df, shard_df["doc_id"].tolist()
+        with trace.span("chunk", records=shard_df.shape[0]):
+            passages_df = chunk_passages(
+                shard_df, passage_tokens=_PASSAGE_TOKENS, overlap_tokens=_PASSAGE_OVERLAP
+            )
+        return passages_df, passages_df["passage_id"].tolist()
+
+    def vector_ids(ids):
+        # every vector id that documents can have
+        return passage_ids(ids) if _PASSAGES else ids
+
+    def embed(vector_df):
         # embedding generation
-        dense_vectors = generate_openai_embeddings(
-            openai_api_key=_OPENAI_KEY, df=df, model_name=_NLP_MODEL_NAME
-        )
+        with trace.span("embed", records=vector_df.shape[0]):
+            dense_vectors = generate_embeddings(
+                provider=provider, df=vector_df, cache=embedding_cache
+            )
+        if dense_vectors is None:
+            raise RuntimeError("Embedding generation failed")
+        return dense_vectors
 
-        # dump embeddings to vector db
-        milvus_collection_creation(
-            collection_name=_MILVUS_COLLECTION_NAME,
-            index_name=_MILVUS_INDEX_NAME,
-            index_param=_MILVUS_INDEX_PARAM,
-        )
+    def push_to_vector_store(ids, row_ids, dense_vectors, vector_df):
+        # dump embeddings to vector db, clearing any older version of
+        # these documents (or a crashed attempt at inserting them) first
+        with trace.span("vector_store_insert", records=len(row_ids)):
+            vector_store.delete(vector_ids(ids))
+            vector_store.insert(
+                row_ids,
+                dense_vectors,
+                payloads=payload_columns(vector_df, _PAYLOAD_FIELDS)
+                if _PAYLOAD_FIELDS
+                else None,
+                filter_values=filter_columns(vector_df),
+            )
 
-        # dump embedding id to vector db
-        milvus_ids = milvus_insert_into_db(
-            collection_name=_MILVUS_COLLECTION_NAME, dense_vectors=dense_vectors
-        )
+    def push_to_lexical_index(ids, row_ids, vector_df):
+        # BM25 postings of the same texts, under the same ids
+        with trace.span("lexical_insert", records=len(row_ids)):
+            lexical_index.delete(vector_ids(ids))
+            lexical_index.insert(
+                row_ids,
+                vector_df["embedding_text"].tolist(),
+                filter_values=filter_columns(vector_df),
+            )
 
+    def push_to_postgres(ids, shard_df):
         # store metadata associated with embeddings in postgres
+        with trace.span("postgres_insert", records=len(ids)):
+            postgres_delete_ids(table_name=_POSTGRES_TABLE_NAME, ids=ids)
+            postgres_insert_into_table(
+                table_name=_POSTGRES_TABLE_NAME,
+                df=shard_df,
+                corresponding_milvus_ids=ids,
+            )
+
+    def build_settings():
+        # what an incremental build must share with the index it updates
+        return {
+            "model_name": provider.name,
+            "dim": provider.dim,
+            "vector_store": _VECTOR_STORE,
+            "metadata_store": _METADATA_STORE,
+            "passages": [_PASSAGE_TOKENS, _PASSAGE_OVERLAP] if _PASSAGES else None,
+            "filter_fields": list(FILTER_FIELDS),
+        }
+
+    def check_build_settings():
+        # before anything is deleted: vectors of another model, layout
+        # or schema cannot be mixed into the index
+        indexed_settings = postgres_get_build_settings(_POSTGRES_TABLE_NAME)
+        if indexed_settings is None:
+            raise ValueError(
+                "Cannot update the index incrementally: it has no recorded build "
+                "settings (it was built by an older version), run a full build\n"
+            )
+        settings = build_settings()
+        different = [
+            name for name in settings if indexed_settings.get(name) != settings[name]
+        ]
+        if different:
+            raise ValueError(
+                "Cannot update the index incrementally: it was built with different "
+                + ", ".join(
+                    f"{name} ({indexed_settings.get(name)}, not {settings[name]})"
+                    for name in different
+                )
+                + ", run a full build\n"
+            )
+
+    def full_build():
+        passage_settings = [_PASSAGE_TOKENS, _PASSAGE_OVERLAP] if _PASSAGES else None
+        manifest = load_manifest(_ARTIFACTS_DIR) if _RESUME else None
+        if manifest is not None and (
+            manifest["data_path"],
+            manifest["model_name"],
+            manifest["shard_size"],
+            manifest.get("vector_store", "milvus"),
+            manifest.get("metadata_store", "postgres"),
+            manifest.get("passages"),
+            manifest.get("lexical_index", False),
+            manifest.get("embedding_dtype", "float32"),
+        ) != (
+            _PATH_TO_DATA,
+            _NLP_MODEL_NAME,
+            _SHARD_SIZE,
+            _VECTOR_STORE,
+            _METADATA_STORE,
+            passage_settings,
+            _LEXICAL_INDEX,
+            _EMBEDDING_DTYPE,
+        ):
+            raise ValueError(
+                "Cannot resume: the checkpointed build used a different data_path, "
+                "model_name, shard_size, vector_store, metadata_store, passages, "
+                "lexical index or embedding dtype setting\n"
+            )
+        if manifest is None:
+            if _RESUME:
+                print("No checkpointed build found, starting from scratch\n")
+            clear_checkpoints(_ARTIFACTS_DIR)
+            manifest = new_manifest(_PATH_TO_DATA, _NLP_MODEL_NAME, _SHARD_SIZE)
+            manifest["vector_store"] = _VECTOR_STORE
+            manifest["metadata_store"] = _METADATA_STORE
+            manifest["passages"] = passage_settings
+            manifest["lexical_index"] = _LEXICAL_INDEX
+            manifest["embedding_dtype"] = _EMBEDDING_DTYPE
+        stages = manifest["stages"]
+
+        # create the vector collection and the postgres table once per build
+        if not stages.get("create"):
+            with trace.span("create"):
+                # the vector dimension comes from the embedding model
+                vector_store.create(
+                    dim=provider.dim,
+                    index_param=_MILVUS_INDEX_PARAM,
+                    payload_fields=_PAYLOAD_FIELDS,
+                    filter_fields=list(FILTER_FIELDS),
+                )
+                postgres_table_creation(
+                    table_name=_POSTGRES_TABLE_NAME, drop_existing=True
+                )
+                if lexical_index is not None:
+                    lexical_index.create(filter_fields=list(FILTER_FIELDS))
+                # the old index is gone, even if this build does not finish
+                postgres_set_build_version(
+                    table_name=_POSTGRES_TABLE_NAME, settings=build_settings()
+                )
+            stages["create"] = True
+            save_manifest(manifest, _ARTIFACTS_DIR)
+
+        # load and pre-process the dataset one shard at a time.
+        # ids are derived from the document key, so re-running a
+        # half-finished shard is idempotent
+        no_of_records = 0
+        for shard_no, shard_df in enumerate(unique_shards()):
+            start = no_of_records
+            end = no_of_records = start + shard_df.shape[0]
+            status = shard_status(manifest, shard_no, start, end)
+            if status["postgres"] or start == end:
+                continue
+
+            ids = shard_df["doc_id"].tolist()
+            print(f"Shard {shard_no}: records {start} to {end}\n")
+
+            # chunking is deterministic, so a resumed shard gets the
+            # same passages as the checkpointed embeddings
+            vector_df, row_ids = vector_rows(shard_df)
+            if not status["embed"]:
+                save_shard_embeddings(
+                    _ARTIFACTS_DIR, shard_no, embed(vector_df), dtype=_EMBEDDING_DTYPE
+                )
+                status["embed"] = True
+                save_manifest(manifest, _ARTIFACTS_DIR)
+
+            if not status["milvus"]:
+                # memory-mapped, inserted a batch at a time
+                push_to_vector_store(
+                    ids,
+                    row_ids,
+                    load_shard_embeddings(_ARTIFACTS_DIR, shard_no),
+                    vector_df,
+                )
+                status["milvus"] = True
+                save_manifest(manifest, _ARTIFACTS_DIR)
+
+            # redone with postgres, both are idempotent
+            if lexical_index is not None:
+                push_to_lexical_index(ids, row_ids, vector_df)
+            push_to_postgres(ids, shard_df)
+            status["postgres"] = True
+            save_manifest(manifest, _ARTIFACTS_DIR)
+
+        # eg: train the index of the local vector store
+        if not stages.get("finalize"):
+            with trace.span("finalize"):
+                vector_store.finalize()
+            stages["finalize"] = True
+            save_manifest(manifest, _ARTIFACTS_DIR)
+
+        print(f"Pushed Data to Milvus and Postgres ({no_of_records} records)\n")
+
+    def incremental_build():
+        # every step below is idempotent: milvus is always written before
+        # postgres, so after a crash the postgres content hashes still
+        # mark the interrupted documents as out of date and a re-run
+        # redoes them
+        check_build_settings()
+
+        # tables from older builds get their primary key on ids
         postgres_table_creation(table_name=_POSTGRES_TABLE_NAME)
 
-        postgres_insert_into_table(
-            table_name=_POSTGRES_TABLE_NAME,
-            df=df,
-            corresponding_milvus_ids=milvus_ids,
+        with trace.span("fetch_content_hashes"):
+            indexed = postgres_fetch_content_hashes(table_name=_POSTGRES_TABLE_NAME)
+        print(f"Found {len(indexed)} indexed documents\n")
+
+        update_lexical_index = lexical_index is not None and lexical_index.exists()
+        if lexical_index is not None and not update_lexical_index:
+            print("No lexical index found, run a full build to create it\n")
+
+        no_of_records = added = updated = 0
+        for shard_df in unique_shards():
+            no_of_records += shard_df.shape[0]
+            changed = [
+                indexed.get(doc_id) != content_hash
+                for doc_id, content_hash in zip(
+                    shard_df["doc_id"].values, shard_df["content_hash"].values
+                )
+            ]
+            shard_df = shard_df[changed]
+            if shard_df.shape[0] == 0:
+                continue
+
+            ids = shard_df["doc_id"].tolist()
+            is_update = [id in indexed for id in ids]
+            updated += sum(is_update)
+            added += len(ids) - sum(is_update)
+
+            vector_df, row_ids = vector_rows(shard_df)
+            push_to_vector_store(ids, row_ids, embed(vector_df), vector_df)
+            if update_lexical_index:
+                push_to_lexical_index(ids, row_ids, vector_df)
+            push_to_postgres(ids, shard_df)
+
+        # documents that are indexed but no longer in the dataset
+        removed = list(set(indexed) - seen_ids)
+        if removed:
+            with trace.span("delete_removed", records=len(removed)):
+                vector_store.delete(vector_ids(removed))
+                if update_lexical_index:
+                    lexical_index.delete(vector_ids(removed))
+                postgres_delete_ids(table_name=_POSTGRES_TABLE_NAME, ids=removed)
+
+        print(
+            f"Incremental build done: {no_of_records} records, {added} added, "
+            f"{updated} updated, {len(removed)} removed, "
+            f"{no_of_records - added - updated} unchanged\n"
+        )
+
+    try:
+        if _INCREMENTAL and (
+            vector_store.exists()
+            and postgres_table_exists(_POSTGRES_TABLE_NAME)
+        ):
+            incremental_build()
+        else:
+            if _INCREMENTAL:
+                print("Nothing indexed yet, running a full build\n")
+            full_build()
+
+        # lets inference processes drop their cached query results,
+        # and incremental builds check they match the index
+        postgres_set_build_version(
+            table_name=_POSTGRES_TABLE_NAME, settings=build_settings()
         )
 
-        print("Pushed Data to Milvus and Postgres\n")
+        if embedding_cache is not None:
+            print(embedding_cache.summary() + "\n")
 
     except Exception as e:
         print("Failed to Push Data into Milvus and Postgres\n")
+        if not _INCREMENTAL:
+            print("Re-run with --resume to continue from the last checkpoint\n")
         print(e)
+
+    finally:
+        if embedding_cache is not None:
+            embedding_cache.close()
+        trace.finish()
+        print(
+            "Time per stage: "
+            + ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in trace.totals().items())
+            + f" (total {trace.duration():.1f}s)\n"
+        )
@@ -4,11 +4,72 @@ the milvus vector database and also fetch metadata corresponding to
 the mulvus search results from postgres.
 
 Use this function for inference purposes.  
+Clients, connections and the loaded milvus collection are
+long-lived and shared across calls, warm_up() opens them
+ahead of the first query.
+
+Responses are cached in memory, by normalized query text and by
+query embedding similarity. The cache is dropped whenever the
+collection is rebuilt, query_cache_metrics() reports its hit rates.
+
+Every stage is timed (see src/tracing/helpers.py), stage_metrics()
+reports the per-stage latency histograms.
+
+In hybrid mode a BM25 search (see src/lexical/helpers.py) runs in a
+worker thread while the query is embedded and the vectors searched,
+and the two rankings are fused with reciprocal rank fusion.
+
+With reranking, more candidates are fetched and rescored exactly and/or
+by a cross-encoder (see src/rerank/helpers.py) before the top-k is kept.
 """
 
-from src.postgres.helpers import postgres_fetch_metadata
-from src.milvus.helpers import milvus_query_results_openai
-from src.model.helpers import generate_prompt_with_context, prompt_model
+import functools
+import json
+
+from src.cache.helpers import (
+    EMBEDDING_CACHE_PATH,
+    get_embedding_cache,
+    get_query_cache,
+    get_retrieval_cache,
+)
+from src.postgres.helpers import (
+    postgres_connect,
+    postgres_fetch_metadata,
+    postgres_get_build_version,
+)
+from src.lexical.helpers import (
+    FUSION_DEPTH,
+    get_lexical_index,
+    lexical_search_documents,
+    reciprocal_rank_fusion,
+)
+from src.model.helpers import (
+    CONTEXT_TOKENS,
+    embed_query,
+    generate_prompt_with_context,
+    prompt_model,
+)
+from src.rerank.helpers import (
+    CROSS_ENCODER_MODEL,
+    RERANK_BUDGET_MS,
+    RERANK_DEPTH,
+    cross_encoder_rerank,
+    exact_rerank,
+    get_cross_encoder,
+)
+from src.tracing.helpers import configure_tracing, stage_histograms, start_trace
+from src.vectorstore.helpers import (
+    MAX_SEARCH_LIMIT,
+    PAYLOAD_FIELDS,
+    get_vector_store,
+    search_documents,
+    search_results_metadata,
+)
+
+# db variables: milvus collection (and postgres table), index and search parameters
+_COLLECTION_NAME = "rag_search"
+_INDEX_NAME = "Embedding"
+_SEARCH_PARAM = {"metric_type": "IP", "params": {"nprobe": 128}}
 
 
 def inference(arguments):
@@ -21,17 +82,31 @@ def inference(arguments):
     arguments : dict
         a dict contaning search parameters
         {"query":"","no_of_results":"","model_name":"", "openai_api_key":""}
+        optional: "embedding_cache", "no_embedding_cache", "stream",
+        "no_query_cache", "query_cache_similarity", "query_cache_ttl",
+        "vector_store" ("milvus" or "local"), "trace_sinks",
+        "metadata_store" ("postgres" or "vector_store", as at build time),
+        "filters" (eg: {"publish_time": {">=": "2021-01-01"}, "journal": "Lancet"},
+        see src/filters/helpers.py), "passages" (as at build time),
+        "hybrid" (fuse BM25 and vector search results),
+        "context_tokens" (token budget of the search results in the prompt),
+        "retrieval_only" (return the ranked articles, see search()),
+        "rerank" (["exact"] and/or ["cross_encoder"], see src/rerank/helpers.py),
+        "rerank_depth" (candidates fetched for reranking), "rerank_budget_ms",
+        "rerank_model" (cross-encoder name)
+        (trace_sinks eg: ["logging", "prometheus:/path/to/metrics.prom"])
 
     Returns
     -------
-    model_response : str
+    model_response : str or generator(str)
+        the model's response, or a generator of its chunks
+        if "stream" is set (the ranked articles with
+        "retrieval_only", see search())
 
     """
-
-    # db variables
-    _MILVUS_COLLECTION_NAME = _POSTGRES_TABLE_NAME = "rag_search"
-    _MILVUS_INDEX_NAME = "Embedding"
-    _MILVUS_SEARCH_PARAM = {"metric_type": "IP", "params": {"nprobe": 128}}
+    # no generation: latency is bounded by retrieval
+    if arguments.get("retrieval_only", False):
+        return search(arguments)
 
     # cli variables
     _NLP_MODEL_NAME = arguments["model_name"]
@@ -40,27 +115,521 @@ def inference(arguments):
     )  # optional with default value 10
     _QUERY = arguments["query"]
     _OPENAI_KEY = arguments['openai_api_key']
-    
-    # ANN search
-    milvus_results = milvus_query_results_openai(
-        openai_api_key=_OPENAI_KEY,
-        collection_name=_MILVUS_COLLECTION_NAME,
-        index_name=_MILVUS_INDEX_NAME,
-        query=_QUERY,
-        model_name=_NLP_MODEL_NAME,
-        search_params=_MILVUS_SEARCH_PARAM,
-        k=_NO_OF_RESULTS,
+    _EMBEDDING_CACHE_PATH = arguments.get("embedding_cache") or EMBEDDING_CACHE_PATH
+    _USE_EMBEDDING_CACHE = not arguments.get("no_embedding_cache", False)
+    _STREAM = arguments.get("stream", False)
+    _VECTOR_STORE = arguments.get("vector_store") or "milvus"
+    _METADATA_STORE = arguments.get("metadata_store") or "postgres"
+    _FILTERS = arguments.get("filters") or None
+    _HYBRID = arguments.get("hybrid", False)
+    _CONTEXT_TOKENS = arguments.get("context_tokens") or CONTEXT_TOKENS
+
+    embedding_cache = (
+        get_embedding_cache(_EMBEDDING_CACHE_PATH) if _USE_EMBEDDING_CACHE else None
     )
 
-    # metadata for top-k
-    postgres_results = postgres_fetch_metadata(
-        milvus_results=milvus_results, table_name=_POSTGRES_TABLE_NAME
+    # a timing span around every stage, see src/tracing/helpers.py
+    if arguments.get("trace_sinks") is not None:
+        configure_tracing(arguments["trace_sinks"])
+    trace = start_trace(
+        "inference",
+        filtered=_FILTERS is not None,
+        model_name=_NLP_MODEL_NAME,
+        no_of_results=_NO_OF_RESULTS,
+        vector_store=_VECTOR_STORE,
+        metadata_store=_METADATA_STORE,
+        stream=_STREAM,
+        hybrid=_HYBRID,
     )
-    
-    # curate prompt using content from top-k
-    prompt = generate_prompt_with_context(postgres_results, _QUERY)
 
-    # chat completion
-    model_response = prompt_model(prompt, _OPENAI_KEY)
+    try:
+        # responses only match queries with the same model,
+        # number of results, filters, retrieval mode and context budget
+        query_cache = _query_cache(arguments)
+        # the retrieval settings, and the prompt budget
+        cache_scope = _retrieval_scope(arguments) + (_CONTEXT_TOKENS,)
+
+        # exact tier: same normalized query text
+        if query_cache is not None:
+            with trace.span("query_cache_exact"):
+                query_cache.check_version(
+                    lambda: postgres_get_build_version(table_name=_COLLECTION_NAME)
+                )
+                model_response = query_cache.get_exact(cache_scope, _QUERY)
+            if model_response is not None:
+                trace.set(query_cache="exact")
+                trace.finish()
+                return iter([model_response]) if _STREAM else model_response
+
+        # the articles of a previous search() for this query,
+        # the response is generated from them
+        retrieval_cache = _retrieval_cache(arguments)
+        retrieved = None
+        if retrieval_cache is not None:
+            with trace.span("retrieval_cache"):
+                retrieved = retrieval_cache.get_exact(_retrieval_scope(arguments), _QUERY)
+        lexical_results = None
+        if retrieved is not None:
+            trace.set(retrieval_cache="hit")
+            postgres_results, query_embedding = retrieved
+        else:
+            # BM25 search, only needs the query text: runs in the
+            # background during query embedding and vector search
+            lexical_results = _start_lexical_search(arguments)
+
+            # query embedding
+            with trace.span("embed_query"):
+                query_embedding = embed_query(
+                    openai_api_key=_OPENAI_KEY,
+                    query=_QUERY,
+                    model_name=_NLP_MODEL_NAME,
+                    embedding_cache=embedding_cache,
+                )
+
+        # semantic tier: a previous query with a near-identical embedding
+        if query_cache is not None:
+            with trace.span("query_cache_semantic"):
+                model_response = query_cache.get_semantic(cache_scope, query_embedding)
+            if model_response is not None:
+                if lexical_results is not None:
+                    lexical_results.cancel()
+                trace.set(query_cache="semantic")
+                trace.finish()
+                return iter([model_response]) if _STREAM else model_response
+
+        # ANN search (fused with BM25) and metadata for top-k
+        if retrieved is None:
+            postgres_results = _retrieve(arguments, query_embedding, lexical_results, trace)
+            if retrieval_cache is not None:
+                retrieval_cache.put(
+                    _retrieval_scope(arguments),
+                    _QUERY,
+                    query_embedding,
+                    (postgres_results, query_embedding),
+                )
+
+        # curate prompt using content from top-k
+        with trace.span("generate_prompt"):
+            prompt = generate_prompt_with_context(
+                postgres_results, _QUERY, max_context_tokens=_CONTEXT_TOKENS
+            )
+
+        # chat completion
+        if _STREAM:
+            # the stream is only consumed by the caller, the span
+            # and the trace end when it is exhausted
+            model_response = _trace_stream(
+                prompt_model(prompt, _OPENAI_KEY, stream=True), trace
+            )
+        else:
+            with trace.span("complete"):
+                model_response = prompt_model(prompt, _OPENAI_KEY)
+            trace.finish()
+    except BaseException:
+        trace.finish()
+        raise
+
+    if query_cache is not None:
+        if _STREAM:
+            model_response = _cache_when_complete(
+                model_response, query_cache, cache_scope, _QUERY, query_embedding
+            )
+        elif model_response is not None:
+            query_cache.put(cache_scope, _QUERY, query_embedding, model_response)
 
     return model_response
+
+
+def search(arguments):
+    """
+    This function is the retrieval part of inference(): given a
+    query, it returns the top-k articles without generating a response.
+    Results are cached in memory (unless "no_query_cache" is set), so
+    that inference() can generate a response from them later without
+    searching again.
+
+    Arguments
+    ----------
+    arguments : dict
+        the arguments of inference(), the generation
+        ones ("stream", "context_tokens") are ignored
+
+    Returns
+    -------
+    postgres_results : dict(dict)
+        title, abstract, authors, url, id and distance of
+        every article, keyed (and ordered) by rank
+
+    """
+    _EMBEDDING_CACHE_PATH = arguments.get("embedding_cache") or EMBEDDING_CACHE_PATH
+    _USE_EMBEDDING_CACHE = not arguments.get("no_embedding_cache", False)
+
+    if arguments.get("trace_sinks") is not None:
+        configure_tracing(arguments["trace_sinks"])
+    trace = start_trace(
+        "search",
+        filtered=bool(arguments.get("filters")),
+        model_name=arguments["model_name"],
+        no_of_results=arguments.get("no_of_results", 10),
+        hybrid=arguments.get("hybrid", False),
+    )
+    try:
+        retrieval_cache = _retrieval_cache(arguments)
+        if retrieval_cache is not None:
+            with trace.span("retrieval_cache"):
+                retrieved = retrieval_cache.get_exact(
+                    _retrieval_scope(arguments), arguments["query"]
+                )
+            if retrieved is not None:
+                trace.set(retrieval_cache="hit")
+                return retrieved[0]
+
+        lexical_results = _start_lexical_search(arguments)
+        with trace.span("embed_query"):
+            query_embedding = embed_query(
+                openai_api_key=arguments.get("openai_api_key"),
+                query=arguments["query"],
+                model_name=arguments["model_name"],
+                embedding_cache=get_embedding_cache(_EMBEDDING_CACHE_PATH)
+                if _USE_EMBEDDING_CACHE
+                else None,
+            )
+        postgres_results = _retrieve(arguments, query_embedding, lexical_results, trace)
+        if retrieval_cache is not None:
+            retrieval_cache.put(
+                _retrieval_scope(arguments),
+                arguments["query"],
+                query_embedding,
+                (postgres_results, query_embedding),
+            )
+        return postgres_results
+    finally:
+        trace.finish()
+
+
+def _retrieval_cache(arguments):
+    """
+    The cache of retrieval results, or None if
+    the query cache is disabled
+    """
+    if arguments.get("no_query_cache", False):
+        return None
+    retrieval_cache = get_retrieval_cache()
+    retrieval_cache.check_version(
+        lambda: postgres_get_build_version(table_name=_COLLECTION_NAME)
+    )
+    return retrieval_cache
+
+
+def _retrieval_scope(arguments):
+    """
+    Retrieval results (and responses, see inference()) only match
+    queries with the same model, number of results, filters and
+    search settings
+    """
+    return (
+        arguments["model_name"],
+        arguments.get("no_of_results", 10),
+        json.dumps(arguments.get("filters") or None, sort_keys=True, default=str),
+        arguments.get("hybrid", False),
+        arguments.get("passages", False),
+        arguments.get("vector_store") or "milvus",
+        arguments.get("metadata_store") or "postgres",
+        _rerank_scope(arguments),
+    )
+
+
+def _rerank_scope(arguments):
+    """
+    The rerank settings that change the results
+    """
+    rerank = sorted(arguments.get("rerank") or [])
+    if not rerank:
+        return None
+    return json.dumps(
+        [
+            rerank,
+            arguments.get("rerank_depth") or RERANK_DEPTH,
+            (arguments.get("rerank_model") or CROSS_ENCODER_MODEL)
+            if "cross_encoder" in rerank
+            else None,
+        ]
+    )
+
+
+def _search_depth(arguments):
+    """
+    Number of results fetched from each retriever: both rankings
+    of hybrid search are fused from deeper result lists than k,
+    and reranking rescores more candidates than k
+    """
+    depth = arguments.get("no_of_results", 10)
+    if arguments.get("rerank"):
+        depth = max(depth, _rerank_depth(arguments))
+    if arguments.get("hybrid", False):
+        depth = max(depth, FUSION_DEPTH)
+    return min(depth, MAX_SEARCH_LIMIT)
+
+
+def _rerank_depth(arguments):
+    """
+    Number of candidates that get reranked
+    """
+    k = arguments.get("no_of_results", 10)
+    return min(max(k, arguments.get("rerank_depth") or RERANK_DEPTH), MAX_SEARCH_LIMIT)
+
+
+def _start_lexical_search(arguments):
+    """
+    Start the BM25 search of hybrid inference in a worker
+    thread, returns its future (None if not hybrid)
+    """
+    if not arguments.get("hybrid", False):
+        return None
+    return _lexical_executor().submit(
+        _timed,
+        lexical_search_documents,
+        get_lexical_index(_COLLECTION_NAME),
+        arguments["query"],
+        _search_depth(arguments),
+        filters=arguments.get("filters") or None,
+        passages=arguments.get("passages", False),
+    )
+
+
+def _retrieve(arguments, query_embedding, lexical_results, trace):
+    """
+    ANN search for the query embedding, fused with the BM25
+    results if any, reranked if asked, and the metadata of the top-k
+    """
+    _NO_OF_RESULTS = arguments.get("no_of_results", 10)
+    _VECTOR_STORE = arguments.get("vector_store") or "milvus"
+    _METADATA_STORE = arguments.get("metadata_store") or "postgres"
+    _RERANK = arguments.get("rerank") or []
+    _PASSAGES = arguments.get("passages", False)
+    # the cross-encoder needs the metadata of every candidate
+    _CANDIDATES = _rerank_depth(arguments) if _RERANK else _NO_OF_RESULTS
+
+    vector_store = get_vector_store(
+        backend=_VECTOR_STORE,
+        collection_name=_COLLECTION_NAME,
+        index_name=_INDEX_NAME,
+    )
+    with trace.span("load_collection"):
+        vector_store.load()
+    with trace.span("search"):
+        # passage hits are collapsed to their documents
+        milvus_results = search_documents(
+            vector_store,
+            query_embedding=query_embedding,
+            search_params=_SEARCH_PARAM,
+            k=_search_depth(arguments),
+            # single-store mode: the hits carry their metadata
+            output_fields=PAYLOAD_FIELDS if _METADATA_STORE == "vector_store" else None,
+            # pushed down into the ANN search
+            filters=arguments.get("filters") or None,
+            passages=_PASSAGES,
+        )
+
+    # rescore the vector hits on the stored vectors, rather than the
+    # approximate distances of the quantized index. This is done before
+    # fusion, so that hybrid search still surfaces the BM25-only hits
+    if "exact" in _RERANK:
+        with trace.span("exact_rerank", candidates=len(milvus_results)):
+            milvus_results = exact_rerank(
+                vector_store,
+                query_embedding,
+                milvus_results,
+                len(milvus_results),
+                passages=_PASSAGES,
+            )
+
+    # reciprocal rank fusion of the two rankings
+    if lexical_results is not None:
+        with trace.span("lexical_search_wait"):
+            lexical_hits, lexical_seconds = lexical_results.result()
+        trace.set(lexical_search_ms=round(lexical_seconds * 1000, 3))
+        with trace.span("fuse"):
+            milvus_results = reciprocal_rank_fusion(
+                [milvus_results, lexical_hits], _CANDIDATES
+            )
+
+    if "cross_encoder" not in _RERANK:
+        milvus_results = milvus_results[:_NO_OF_RESULTS]
+
+    # metadata for top-k. Lexical-only hits carry no
+    # payload, postgres has the metadata of every hit
+    with trace.span("fetch_metadata"):
+        if _METADATA_STORE == "vector_store" and all(
+            hit.payload is not None for hit in milvus_results
+        ):
+            metadata = search_results_metadata(milvus_results)
+        else:
+            metadata = postgres_fetch_metadata(
+                milvus_results=milvus_results, table_name=_COLLECTION_NAME
+            )
+
+    if "cross_encoder" in _RERANK:
+        with trace.span("cross_encoder_rerank", candidates=len(metadata)):
+            metadata = cross_encoder_rerank(
+                arguments["query"],
+                metadata,
+                _NO_OF_RESULTS,
+                model_name=arguments.get("rerank_model") or CROSS_ENCODER_MODEL,
+                budget_ms=arguments.get("rerank_budget_ms") or RERANK_BUDGET_MS,
+            )
+    return metadata
+
+
+@functools.lru_cache(maxsize=None)
+def _lexical_executor():
+    """
+    Worker threads for the BM25 searches of hybrid inference
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="lexical_search")
+
+
+def _timed(function, *args, **kwargs):
+    """
+    Call function, returns its result and the seconds it took
+    """
+    import time
+
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def _trace_stream(chunks, trace):
+    """
+    Pass the chunks of a streamed response through, timing the
+    whole completion (and the first chunk) as the trace's last stage.
+    Returns what the stream returns (whether it finished)
+    """
+    import time
+
+    try:
+        with trace.span("complete") as span:
+            start = time.perf_counter()
+            chunks = iter(chunks)
+            first = True
+            while True:
+                try:
+                    chunk = next(chunks)
+                except StopIteration as stop:
+                    return stop.value
+                if first:
+                    first = False
+                    span["attributes"]["time_to_first_chunk_ms"] = round(
+                        (time.perf_counter() - start) * 1000, 3
+                    )
+                yield chunk
+    finally:
+        trace.finish()
+
+
+def _query_cache(arguments):
+    """
+    The query response cache configured by the inference
+    arguments, or None if it is disabled
+    """
+    if arguments.get("no_query_cache", False):
+        return None
+    return get_query_cache(
+        ttl=arguments.get("query_cache_ttl") or 3600,
+        similarity_threshold=arguments.get("query_cache_similarity", 0.97),
+    )
+
+
+def _cache_when_complete(chunks, query_cache, scope, query, query_embedding):
+    """
+    Pass the chunks of a streamed response through and cache
+    the full response once the stream has finished. A stream
+    that failed midway is not cached
+    """
+    response = []
+    chunks = iter(chunks)
+    while True:
+        try:
+            chunk = next(chunks)
+        except StopIteration as stop:
+            complete = stop.value
+            break
+        response.append(chunk)
+        yield chunk
+    if complete and response:
+        query_cache.put(scope, query, query_embedding, "".join(response))
+    return complete
+
+
+def query_cache_metrics(arguments=None):
+    """
+    This function reports the hit rates of the query response cache
+
+    Arguments
+    ----------
+    arguments : dict
+        the cache settings passed to inference(), if any
+
+    Returns
+    -------
+    metrics : dict
+        {"exact": {"hits": 0, "lookups": 0, "hit_rate": 0.0},
+         "semantic": {...}, "entries": 0, "evictions": 0,
+         "invalidations": 0}
+        or None if the cache is disabled
+
+    """
+    query_cache = _query_cache(arguments or {})
+    return query_cache.metrics() if query_cache is not None else None
+
+
+def warm_up(collection_name="rag_search", vector_store="milvus", hybrid=False, rerank_model=None):
+    """
+    This function opens the long-lived resources used by
+    inference() so that the first query does not pay for
+    connecting to milvus and postgres and loading the collection
+
+    Arguments
+    ----------
+    collection_name : string
+        name of the milvus collection (and postgres table)
+    vector_store : string
+        "milvus" or "local"
+    hybrid : bool
+        also memory-map the lexical index
+    rerank_model : string
+        also load this cross-encoder (see src/rerank/helpers.py)
+
+    """
+    get_vector_store(backend=vector_store, collection_name=collection_name).load()
+    if hybrid:
+        get_lexical_index(collection_name).load()
+    if rerank_model is not None:
+        get_cross_encoder(rerank_model)
+    with postgres_connect():
+        pass
+
+
+def stage_metrics(exposition=False):
+    """
+    This function reports the latency of every stage of
+    the inference() and build() calls made by this process
+
+    Arguments
+    ----------
+    exposition : bool
+        return the Prometheus text exposition of the
+        histograms instead of a summary
+
+    Returns
+    -------
+    metrics : dict or str
+        {"inference": {"embed_query": {"count": 0, "mean_ms": 0.0,
+         "p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0}, ...}}
+
+    """
+    histograms = stage_histograms()
+    return histograms.exposition() if exposition else histograms.summary()
@@ -0,0 +1,473 @@
+"""
+This module has lightweight timing spans for the stages of
+inference() and build():
+1. Trace, the spans of one request (or one build), a span
+   per stage, nested spans keep their parent
+2. StageHistograms, per-stage latency histograms of every trace,
+   with a Prometheus text exposition
+3. pluggable sinks that receive every finished trace:
+   LoggingSink, JsonLinesSink (OpenTelemetry-style json spans),
+   OpenTelemetrySink (needs the optional opentelemetry-api package)
+   and PrometheusTextfileSink
+
+Use start_trace() to open a trace, trace.span("stage") around each
+stage and trace.finish() once done. Histograms are always kept, sinks
+are configured with configure_tracing() or get_trace_sink().
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds of the histogram buckets, in seconds
+HISTOGRAM_BUCKETS = [
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+]
+
+
+class Trace:
+    """
+    The timed spans of one request
+
+    Arguments
+    ----------
+    name : string
+        name of the traced operation, eg: "inference"
+    tracer : Tracer
+        the tracer that receives the trace once finished
+    attributes : dict
+        attributes of the whole trace, eg: the number of results
+    """
+
+    def __init__(self, name, tracer, attributes=None):
+        import uuid
+
+        self.name = name
+        self.trace_id = uuid.uuid4().hex
+        self.attributes = dict(attributes or {})
+        self.spans = []
+        self._tracer = tracer
+        self._stack = []
+        self.start_time_unix_nano = time.time_ns()
+        self.end_time_unix_nano = None
+        self._start = time.perf_counter_ns()
+        self._finished = False
+
+    def _now_ns(self):
+        # wall clock start + monotonic elapsed, so spans never go backwards
+        return self.start_time_unix_nano + time.perf_counter_ns() - self._start
+
+    @contextmanager
+    def span(self, stage, **attributes):
+        """
+        Time the body of the with statement as a stage of the trace,
+        the span is recorded even if the body raises
+        """
+        span = {
+            "name": stage,
+            "span_id": f"{len(self.spans) + 1:016x}",
+            "parent_span_id": self._stack[-1]["span_id"] if self._stack else None,
+            "start_time_unix_nano": self._now_ns(),
+            "end_time_unix_nano": None,
+            "attributes": attributes,
+            "status": "OK",
+        }
+        self.spans.append(span)
+        self._stack.append(span)
+        try:
+            yield span
+        except GeneratorExit:
+            # eg: a streamed response closed before its end
+            span["attributes"]["cancelled"] = True
+            raise
+        except BaseException as e:
+            span["status"] = "ERROR"
+            span["attributes"]["error"] = repr(e)
+            raise
+        finally:
+            self._stack.pop()
+            span["end_time_unix_nano"] = self._now_ns()
+
+    def iterate(self, stage, iterable):
+        """
+        Yield the items of an iterable, timing the production
+        of each item as a span (eg: reading the next shard)
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.span(stage):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def totals(self):
+        """
+        Total seconds spent in each stage, in order of first appearance
+        """
+        totals = {}
+        for span in self.spans:
+            totals[span["name"]] = totals.get(span["name"], 0.0) + self.duration(span)
+        return totals
+
+    def set(self, **attributes):
+        """
+        Add attributes to the trace
+        """
+        self.attributes.update(attributes)
+
+    def finish(self):
+        """
+        Record the spans in the stage histograms and export
+        the trace to the sinks. Only the first call counts.
+        """
+        if self._finished:
+            return
+        self._finished = True
+        self.end_time_unix_nano = self._now_ns()
+        self._tracer.export(self)
+
+    def duration(self, span=None):
+        """
+        Duration of a span, or of the whole trace, in seconds
+        """
+        if span is None:
+            return (self.end_time_unix_nano - self.start_time_unix_nano) / 1e9
+        return (span["end_time_unix_nano"] - span["start_time_unix_nano"]) / 1e9
+
+    def to_dict(self):
+        """
+        The trace as a json-serializable dict
+        """
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "start_time_unix_nano": self.start_time_unix_nano,
+            "end_time_unix_nano": self.end_time_unix_nano,
+            "duration_ms": round(self.duration() * 1000, 3),
+            "attributes": self.attributes,
+            "spans": [
+                {**span, "duration_ms": round(self.duration(span) * 1000, 3)}
+                for span in self.spans
+            ],
+        }
+
+
+class StageHistograms:
+    """
+    Cumulative latency histograms, one per (trace name, stage),
+    plus one for the total duration of each trace name
+    """
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets or HISTOGRAM_BUCKETS
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def observe(self, trace_name, stage, seconds):
+        import bisect
+
+        with self._lock:
+            histogram = self._histograms.setdefault(
+                (trace_name, stage),
+                {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0},
+            )
+            histogram["counts"][bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    def record(self, trace):
+        """
+        Observe every span of a finished trace
+        """
+        for span in trace.spans:
+            self.observe(trace.name, span["name"], trace.duration(span))
+        self.observe(trace.name, "total", trace.duration())
+
+    def summary(self):
+        """
+        Count, mean and approximate p50 / p95 / p99 (bucket upper
+        bounds) of every stage, in milliseconds
+        """
+        summary = {}
+        with self._lock:
+            for (trace_name, stage), histogram in sorted(self._histograms.items()):
+                quantiles = {}
+                for quantile in (0.5, 0.95, 0.99):
+                    target, seen = quantile * histogram["count"], 0
+                    for bound, count in zip(self.buckets + [float("inf")], histogram["counts"]):
+                        seen += count
+                        if seen >= target:
+                            quantiles[f"p{int(quantile * 100)}_ms"] = bound * 1000
+                            break
+                summary.setdefault(trace_name, {})[stage] = {
+                    "count": histogram["count"],
+                    "mean_ms": round(1000 * histogram["sum"] / histogram["count"], 3),
+                    **quantiles,
+                }
+        return summary
+
+    def exposition(self):
+        """
+        The histograms in the Prometheus text exposition format
+        """
+        lines = [
+            "# HELP rag_stage_duration_seconds Duration of the stages of inference and build",
+            "# TYPE rag_stage_duration_seconds histogram",
+        ]
+        with self._lock:
+            for (trace_name, stage), histogram in sorted(self._histograms.items()):
+                labels = f'trace="{trace_name}",stage="{stage}"'
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram["counts"]):
+                    cumulative += count
+                    lines.append(
+                        f'rag_stage_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}'
+                    )
+                lines.append(
+                    f'rag_stage_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram["count"]}'
+                )
+                lines.append(f"rag_stage_duration_seconds_sum{{{labels}}} {histogram['sum']}")
+                lines.append(f"rag_stage_duration_seconds_count{{{labels}}} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+class TraceSink:
+    """
+    Interface of a trace sink, export() is called with every finished trace
+    """
+
+    def export(self, trace, histograms):
+        raise NotImplementedError
+
+
+class LoggingSink(TraceSink):
+    """
+    Logs a one-line summary of every trace, and the
+    full trace as json at debug level
+    """
+
+    def __init__(self, logger_name="rag_search.tracing", level="INFO"):
+        import logging
+
+        self.logger = logging.getLogger(logger_name)
+        self.level = logging.getLevelName(level) if isinstance(level, str) else level
+
+    def export(self, trace, histograms):
+        import json
+
+        stages = " ".join(
+            f"{span['name']}={trace.duration(span) * 1000:.1f}ms" for span in trace.spans
+        )
+        self.logger.log(
+            self.level,
+            f"{trace.name} {trace.trace_id} {trace.duration() * 1000:.1f}ms {stages}",
+        )
+        self.logger.debug(json.dumps(trace.to_dict()))
+
+
+class JsonLinesSink(TraceSink):
+    """
+    Appends every trace, as one json line, to a file. Spans carry
+    OpenTelemetry-style ids and unix-nano timestamps, so they can be
+    shipped to a collector as they are.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._lock = threading.Lock()
+
+    def export(self, trace, histograms):
+        import json
+
+        line = json.dumps(trace.to_dict())
+        with self._lock, open(self.filepath, "a") as f:
+            f.write(line + "\n")
+
+
+class OpenTelemetrySink(TraceSink):
+    """
+    Re-emits every span through the OpenTelemetry api, with its
+    recorded start and end times, so they reach whatever exporter
+    the process configured (needs the optional opentelemetry-api package)
+    """
+
+    def __init__(self, instrumentation_name="rag_search"):
+        try:
+            from opentelemetry import trace as otel_trace
+        except ImportError:
+            raise ImportError(
+                "the otel trace sink needs opentelemetry-api: "
+                "pip install opentelemetry-api opentelemetry-sdk"
+            )
+        self._otel_trace = otel_trace
+        self.tracer = otel_trace.get_tracer(instrumentation_name)
+
+    def export(self, trace, histograms):
+        root = self.tracer.start_span(
+            trace.name,
+            start_time=trace.start_time_unix_nano,
+            attributes=_otel_attributes(trace.attributes),
+        )
+        spans = {None: root}
+        for span in trace.spans:
+            context = self._otel_trace.set_span_in_context(spans[span["parent_span_id"]])
+            otel_span = self.tracer.start_span(
+                span["name"],
+                context=context,
+                start_time=span["start_time_unix_nano"],
+                attributes=_otel_attributes(span["attributes"]),
+            )
+            if span["status"] == "ERROR":
+                otel_span.set_status(self._otel_trace.Status(self._otel_trace.StatusCode.ERROR))
+            spans[span["span_id"]] = otel_span
+        # children end before their parents
+        for span in reversed(trace.spans):
+            spans[span["span_id"]].end(end_time=span["end_time_unix_nano"])
+        root.end(end_time=trace.end_time_unix_nano)
+
+
+def _otel_attributes(attributes):
+    """
+    OpenTelemetry attribute values must be str, bool, int or float
+    """
+    return {
+        key: value if isinstance(value, (str, bool, int, float)) else str(value)
+        for key, value in attributes.items()
+        if value is not None
+    }
+
+
+class PrometheusTextfileSink(TraceSink):
+    """
+    Rewrites a file with the Prometheus exposition of the stage
+    histograms after every trace (eg: for node_exporter's textfile
+    collector), at most once per interval seconds
+    """
+
+    def __init__(self, filepath, interval=5.0):
+        self.filepath = filepath
+        self.interval = interval
+        self._last_write = 0.0
+        self._lock = threading.Lock()
+
+    def export(self, trace, histograms):
+        import os
+
+        with self._lock:
+            now = time.monotonic()
+            # a build finishes once, always write its histograms
+            if trace.name != "build" and now - self._last_write < self.interval:
+                return
+            self._last_write = now
+            temp_path = self.filepath + ".tmp"
+            with open(temp_path, "w") as f:
+                f.write(histograms.exposition())
+            os.replace(temp_path, self.filepath)
+
+
+class Tracer:
+    """
+    Holds the stage histograms and the sinks of the process
+    """
+
+    def __init__(self):
+        self.histograms = StageHistograms()
+        self.sinks = []
+
+    def export(self, trace):
+        self.histograms.record(trace)
+        for sink in self.sinks:
+            try:
+                sink.export(trace, self.histograms)
+            except Exception as e:
+                # tracing must never fail a request
+                print(f"Trace sink {type(sink).__name__} failed: {e}\n")
+
+
+_TRACER = Tracer()
+
+
+def get_trace_sink(spec):
+    """
+    This function returns a trace sink from its cli spec
+
+    Arguments
+    ----------
+    spec : string
+        "logging", "otel", "jsonl:<path>" or "prometheus:<path>"
+
+    Returns
+    -------
+    sink : TraceSink
+
+    """
+    kind, _, path = spec.partition(":")
+    if kind == "logging":
+        return LoggingSink()
+    if kind == "otel":
+        return OpenTelemetrySink()
+    if kind == "jsonl" and path:
+        return JsonLinesSink(path)
+    if kind == "prometheus" and path:
+        return PrometheusTextfileSink(path)
+    raise ValueError(
+        f"Unknown trace sink {spec}, use logging, otel, jsonl:<path> or prometheus:<path>"
+    )
+
+
+def configure_tracing(sinks):
+    """
+    This function sets the sinks that receive every finished trace,
+    sinks already configured with the same spec are kept
+
+    Arguments
+    ----------
+    sinks : list(str or TraceSink)
+        sinks, or their cli specs (see get_trace_sink)
+
+    """
+    configured = []
+    for sink in sinks:
+        if isinstance(sink, str):
+            existing = [s for s in _TRACER.sinks if getattr(s, "spec", None) == sink]
+            if existing:
+                sink = existing[0]
+            else:
+                spec, sink = sink, get_trace_sink(sink)
+                sink.spec = spec
+        configured.append(sink)
+    _TRACER.sinks = configured
+
+
+def start_trace(name, **attributes):
+    """
+    This function opens a trace, finish() it once the
+    traced operation is done
+
+    Arguments
+    ----------
+    name : string
+        name of the traced operation, eg: "inference"
+    attributes : dict
+        attributes of the whole trace
+
+    Returns
+    -------
+    trace : Trace
+
+    """
+    return Trace(name, _TRACER, attributes)
+
+
+def stage_histograms():
+    """
+    This function returns the stage histograms of the process
+
+    Returns
+    -------
+    histograms : StageHistograms
+
+    """
+    return _TRACER.histograms
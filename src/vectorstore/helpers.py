@@ -0,0 +1,925 @@
+"""
+This module has a common interface to the vector store
+(create / insert / delete / search) with two implementations:
+1. MilvusVectorStore, backed by a milvus server
+2. LocalVectorStore, in-process search over memory-mapped
+   float32 matrices stored under data/artifacts/, with exact
+   (FLAT) or IVF search
+
+Either store can keep payload fields (eg: title, abstract, authors,
+url) next to the vectors and return them with the search hits, so that
+inference does not need a second round-trip to postgres
+(see search_results_metadata()).
+
+Use get_vector_store() to get a long-lived store by backend name.
+"""
+
+import functools
+import threading
+from collections import namedtuple
+
+# a search result, like a pymilvus hit it has an id and a distance,
+# and the requested payload fields
+SearchHit = namedtuple("SearchHit", ["id", "distance", "payload"], defaults=[None])
+
+VECTOR_STORE_BACKENDS = ["milvus", "local"]
+
+# metadata kept in the vector store in single-store mode
+PAYLOAD_FIELDS = ["title", "abstract", "authors", "url"]
+
+
+class VectorStore:
+    """
+    Interface of a vector store holding one collection of vectors
+
+    Arguments
+    ----------
+    collection_name : string
+        name of the collection
+    index_name : string
+        name of the vector field / index
+    """
+
+    def __init__(self, collection_name, index_name="Embedding"):
+        self.collection_name = collection_name
+        self.index_name = index_name
+
+    def exists(self):
+        """
+        Whether the collection exists
+        """
+        raise NotImplementedError
+
+    def create(self, dim, index_param, payload_fields=None, filter_fields=None):
+        """
+        (Re)create an empty collection of dim dimensional vectors
+        indexed with index_param, dropping any existing one.
+        payload_fields are string fields stored with every vector,
+        filter_fields (see src/filters/helpers.py) can be filtered on.
+        """
+        raise NotImplementedError
+
+    def insert(self, ids, dense_vectors, payloads=None, filter_values=None):
+        """
+        Insert vectors with the given int64 ids, the values of
+        the payload fields ({field: list(str)}) and those of
+        the filter fields ({field: list})
+        """
+        raise NotImplementedError
+
+    def delete(self, ids):
+        """
+        Delete the vectors with the given ids
+        """
+        raise NotImplementedError
+
+    def finalize(self):
+        """
+        Called once a build has inserted everything, eg: to train the index
+        """
+
+    def load(self):
+        """
+        Get the collection ready for searching
+        """
+
+    def search(self, query_embedding, search_params, k, output_fields=None, filters=None):
+        """
+        Return the k nearest vectors to query_embedding that match
+        filters (see src/filters/helpers.py), best first, as SearchHits
+        with an id, a distance and (if output_fields are given) a payload dict
+        """
+        raise NotImplementedError
+
+    def get_vectors(self, ids):
+        """
+        Return the ids found (an int64 array) and their stored
+        vectors (a float32 matrix, one row each), eg: for rescoring
+        approximate search hits exactly
+        """
+        raise NotImplementedError
+
+    def search_many(self, query_embeddings, search_params, k, output_fields=None, filters=None):
+        """
+        search() for many query embeddings, one list of hits per query.
+        Stores that can search a batch of vectors at once override it
+        """
+        return [
+            self.search(
+                query_embedding,
+                search_params,
+                k,
+                output_fields=output_fields,
+                filters=filters,
+            )
+            for query_embedding in query_embeddings
+        ]
+
+
+class MilvusVectorStore(VectorStore):
+    """
+    Vector store backed by a milvus collection
+    (see src/milvus/helpers.py)
+    """
+
+    def exists(self):
+        from src.milvus.helpers import milvus_has_collection
+
+        return milvus_has_collection(self.collection_name)
+
+    def create(self, dim, index_param, payload_fields=None, filter_fields=None):
+        from src.milvus.helpers import milvus_collection_creation
+
+        milvus_collection_creation(
+            collection_name=self.collection_name,
+            index_name=self.index_name,
+            index_param=index_param,
+            auto_id=False,
+            dim=dim,
+            payload_fields=payload_fields,
+            filter_fields=filter_fields,
+        )
+
+    def insert(self, ids, dense_vectors, payloads=None, filter_values=None):
+        from src.milvus.helpers import (
+            MILVUS_FILTER_MAX_LENGTH,
+            MILVUS_VARCHAR_MAX_LENGTH,
+            milvus_insert_into_db,
+        )
+
+        # scalar columns, in the order of the collection schema
+        scalars = {}
+        for field, values in (payloads or {}).items():
+            scalars[field] = [
+                _truncate_utf8(value, MILVUS_VARCHAR_MAX_LENGTH) for value in values
+            ]
+        for field, values in (filter_values or {}).items():
+            scalars[field] = [
+                _truncate_utf8(value, MILVUS_FILTER_MAX_LENGTH)
+                if isinstance(value, str)
+                else value
+                for value in values
+            ]
+        milvus_insert_into_db(
+            collection_name=self.collection_name,
+            dense_vectors=dense_vectors,
+            ids=ids,
+            scalars=scalars,
+        )
+
+    def delete(self, ids):
+        from src.milvus.helpers import milvus_delete_ids
+
+        milvus_delete_ids(collection_name=self.collection_name, ids=ids)
+
+    def load(self):
+        from src.milvus.helpers import milvus_loaded_collection
+
+        milvus_loaded_collection(self.collection_name)
+
+    def get_vectors(self, ids):
+        import numpy as np
+        from src.milvus.helpers import milvus_fetch_vectors
+
+        vectors = milvus_fetch_vectors(self.collection_name, self.index_name, list(ids))
+        if not vectors:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, 0), dtype=np.float32)
+        return (
+            np.fromiter(vectors, dtype=np.int64, count=len(vectors)),
+            np.asarray(list(vectors.values()), dtype=np.float32),
+        )
+
+    def search(self, query_embedding, search_params, k, output_fields=None, filters=None):
+        return self.search_many(
+            [query_embedding], search_params, k, output_fields=output_fields, filters=filters
+        )[0]
+
+    def search_many(self, query_embeddings, search_params, k, output_fields=None, filters=None):
+        from src.filters.helpers import filter_expression
+        from src.milvus.helpers import milvus_search_many
+
+        # one multi-vector search request
+        results = milvus_search_many(
+            collection_name=self.collection_name,
+            index_name=self.index_name,
+            query_embeddings=query_embeddings,
+            search_params=search_params,
+            k=k,
+            output_fields=output_fields,
+            expr=filter_expression(filters),
+        )
+        if not output_fields:
+            return results
+        return [
+            [
+                SearchHit(
+                    hit.id,
+                    hit.distance,
+                    {field: hit.entity.get(field) for field in output_fields},
+                )
+                for hit in hits
+            ]
+            for hits in results
+        ]
+
+
+class LocalVectorStore(VectorStore):
+    """
+    In-process vector store. Every insert is written as a segment of
+    two .npy files (float32 vectors and int64 ids) that are memory-mapped
+    for search, deletes are recorded as a per-segment mask. With an IVF
+    index_type, finalize() trains nlist centroids with k-means and every
+    vector is assigned to its nearest centroid, searches then only scan
+    the nprobe closest lists. Otherwise search is exact. Payloads are
+    stored per segment as utf-8 json rows in one blob file plus an
+    offsets array, both memory-mapped, so only the hits get decoded.
+
+    Arguments
+    ----------
+    collection_name : string
+        name of the collection
+    index_name : string
+        name of the vector field / index
+    artifacts_dir : string
+        folder holding the collections, one sub-folder each
+    """
+
+    def __init__(self, collection_name, index_name="Embedding", artifacts_dir="data/artifacts"):
+        import os
+
+        super().__init__(collection_name, index_name)
+        self.path = os.path.join(artifacts_dir, "vectors", collection_name)
+        self._lock = threading.Lock()
+        self._loaded = None
+        self._loaded_version = None
+
+    # ---- files
+
+    def _file(self, name):
+        import os
+
+        return os.path.join(self.path, name)
+
+    def _read_meta(self):
+        import json
+
+        with open(self._file("meta.json"), "r") as f:
+            return json.load(f)
+
+    def _write_meta(self, meta):
+        import json
+        import os
+
+        meta["version"] = meta.get("version", 0) + 1
+        temp_path = self._file("meta.json.tmp")
+        with open(temp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(temp_path, self._file("meta.json"))
+
+    def _save(self, name, array):
+        import os
+        import numpy as np
+
+        temp_path = self._file(name + ".tmp")
+        with open(temp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(temp_path, self._file(name))
+
+    # ---- writes
+
+    def exists(self):
+        import os
+
+        return os.path.exists(self._file("meta.json"))
+
+    def create(self, dim, index_param, payload_fields=None, filter_fields=None):
+        import os
+        import shutil
+
+        # the version keeps counting, a recreated collection must not
+        # look like one a reader already loaded
+        version = self._read_meta().get("version", 0) if self.exists() else 0
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path)
+        self._write_meta(
+            {
+                "version": version,
+                "dim": dim,
+                "metric_type": index_param.get("metric_type", "IP"),
+                "index_type": index_param.get("index_type", "FLAT"),
+                "nlist": index_param.get("params", {}).get("nlist", 1024),
+                "payload_fields": list(payload_fields or []),
+                "filter_fields": list(filter_fields or []),
+                # the strings of every string filter field, stored
+                # in the segments as int32 codes into these lists
+                "vocabularies": {},
+                "trained": False,
+                "segments": [],
+                "next_segment": 0,
+            }
+        )
+        print(f"Local collection {self.collection_name} created successfully\n")
+
+    def _assign_lists(self, vectors, centroids, metric_type):
+        """
+        Index of the nearest centroid of every vector
+        """
+        import numpy as np
+
+        lists = np.empty(len(vectors), dtype=np.int32)
+        for i in range(0, len(vectors), 65536):
+            batch = np.asarray(vectors[i : i + 65536], dtype=np.float32)
+            scores = batch @ centroids.T
+            if metric_type == "L2":
+                scores = 2 * scores - (centroids**2).sum(axis=1)
+            lists[i : i + 65536] = scores.argmax(axis=1)
+        return lists
+
+    def insert(self, ids, dense_vectors, payloads=None, filter_values=None):
+        import json
+        import os
+        import numpy as np
+        from src.filters.helpers import FILTER_FIELDS
+
+        vectors = np.ascontiguousarray(dense_vectors, dtype=np.float32)
+        ids = np.asarray(ids, dtype=np.int64)
+        with self._lock:
+            meta = self._read_meta()
+            name = f"segment_{meta['next_segment']:06d}"
+            self._save(name + ".vectors.npy", vectors)
+            self._save(name + ".ids.npy", ids)
+            if payloads:
+                rows = [
+                    json.dumps(dict(zip(payloads, values))).encode("utf-8")
+                    for values in zip(*payloads.values())
+                ]
+                temp_path = self._file(name + ".payload.bin.tmp")
+                with open(temp_path, "wb") as f:
+                    f.write(b"".join(rows))
+                os.replace(temp_path, self._file(name + ".payload.bin"))
+                self._save(
+                    name + ".payload_offsets.npy",
+                    np.cumsum([0] + [len(row) for row in rows], dtype=np.int64),
+                )
+            for field, values in (filter_values or {}).items():
+                if FILTER_FIELDS[field] == "int":
+                    column = np.asarray(values, dtype=np.int64)
+                else:
+                    vocabulary = meta.setdefault("vocabularies", {}).setdefault(field, [])
+                    codes = {value: code for code, value in enumerate(vocabulary)}
+                    for value in values:
+                        if value not in codes:
+                            codes[value] = len(vocabulary)
+                            vocabulary.append(value)
+                    column = np.asarray([codes[value] for value in values], dtype=np.int32)
+                self._save(f"{name}.filter.{field}.npy", column)
+            if meta["trained"]:
+                centroids = np.load(self._file("centroids.npy"))
+                self._save(
+                    name + ".lists.npy",
+                    self._assign_lists(vectors, centroids, meta["metric_type"]),
+                )
+            meta["segments"].append(name)
+            meta["next_segment"] += 1
+            self._write_meta(meta)
+        print(f"Inserted all {len(ids)} vectors into local collection\n")
+
+    def delete(self, ids):
+        import os
+        import numpy as np
+
+        ids = np.asarray(ids, dtype=np.int64)
+        with self._lock:
+            meta = self._read_meta()
+            for name in meta["segments"]:
+                segment_ids = np.load(self._file(name + ".ids.npy"), mmap_mode="r")
+                hit = np.isin(segment_ids, ids)
+                if not hit.any():
+                    continue
+                deleted_path = self._file(name + ".deleted.npy")
+                if os.path.exists(deleted_path):
+                    hit |= np.load(deleted_path)
+                self._save(name + ".deleted.npy", hit)
+            self._write_meta(meta)
+
+    def finalize(self):
+        """
+        Train the IVF centroids (k-means over a sample of the
+        vectors) and assign every vector to a list
+        """
+        import numpy as np
+
+        with self._lock:
+            meta = self._read_meta()
+            if not meta["index_type"].startswith("IVF") or not meta["segments"]:
+                return
+            segments = [
+                np.load(self._file(name + ".vectors.npy"), mmap_mode="r")
+                for name in meta["segments"]
+            ]
+            total = sum(len(vectors) for vectors in segments)
+            # at least ~39 training points per centroid, as faiss recommends
+            nlist = max(1, min(meta["nlist"], total // 39))
+
+            rng = np.random.default_rng(0)
+            sample_size = min(total, max(nlist * 64, 10000), 200000)
+            picks = np.sort(rng.choice(total, size=sample_size, replace=False))
+            offsets = np.cumsum([0] + [len(vectors) for vectors in segments])
+            sample = np.concatenate(
+                [
+                    np.asarray(vectors[picks[(picks >= lo) & (picks < hi)] - lo])
+                    for vectors, lo, hi in zip(segments, offsets[:-1], offsets[1:])
+                ]
+            )
+
+            centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+            for _ in range(10):
+                assignment = self._assign_lists(sample, centroids, meta["metric_type"])
+                # mean of the members of every list, empty lists stay put
+                sums = np.zeros(centroids.shape)
+                np.add.at(sums, assignment, sample)
+                counts = np.bincount(assignment, minlength=nlist)
+                filled = counts > 0
+                centroids[filled] = sums[filled] / counts[filled, None]
+                if meta["metric_type"] == "IP":
+                    norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+                    centroids /= np.where(norms == 0, 1, norms)
+
+            self._save("centroids.npy", centroids)
+            for name, vectors in zip(meta["segments"], segments):
+                self._save(
+                    name + ".lists.npy",
+                    self._assign_lists(vectors, centroids, meta["metric_type"]),
+                )
+            meta["trained"] = True
+            meta["nlist"] = nlist
+            self._write_meta(meta)
+        print(f"Trained IVF index with {nlist} lists over {total} vectors\n")
+
+    # ---- reads
+
+    def load(self):
+        """
+        Memory-map the segments, again only if the collection changed
+        """
+        import os
+        import numpy as np
+
+        # every write bumps the version in meta.json, which tells us
+        # whether the mapped segments are still current (an mtime can
+        # miss two writes within its resolution)
+        meta = self._read_meta()
+        version = meta.get("version")
+        if self._loaded is not None and version == self._loaded_version:
+            return self._loaded
+
+        segments = []
+        for name in meta["segments"]:
+            segment = {
+                "vectors": np.load(self._file(name + ".vectors.npy"), mmap_mode="r"),
+                "ids": np.load(self._file(name + ".ids.npy"), mmap_mode="r"),
+                "deleted": None,
+                "order": None,
+            }
+            if os.path.exists(self._file(name + ".deleted.npy")):
+                segment["deleted"] = np.load(self._file(name + ".deleted.npy"))
+            if os.path.exists(self._file(name + ".payload_offsets.npy")):
+                offsets = np.load(self._file(name + ".payload_offsets.npy"), mmap_mode="r")
+                segment["payload_offsets"] = offsets
+                # np.memmap cannot map an empty file
+                segment["payload"] = (
+                    np.memmap(self._file(name + ".payload.bin"), dtype=np.uint8, mode="r")
+                    if offsets[-1]
+                    else np.zeros(0, dtype=np.uint8)
+                )
+            segment["filters"] = {
+                field: np.load(self._file(f"{name}.filter.{field}.npy"), mmap_mode="r")
+                for field in meta.get("filter_fields", [])
+                if os.path.exists(self._file(f"{name}.filter.{field}.npy"))
+            }
+            if meta["trained"]:
+                lists = np.load(self._file(name + ".lists.npy"))
+                # rows sorted by list, and where each list starts in that order
+                segment["order"] = np.argsort(lists, kind="stable")
+                segment["bounds"] = np.searchsorted(
+                    lists[segment["order"]], np.arange(meta["nlist"] + 1)
+                )
+            segments.append(segment)
+
+        loaded = {
+            "meta": meta,
+            "segments": segments,
+            "centroids": None,
+            # code of every string of the string filter fields
+            "vocabularies": {
+                field: {value: code for code, value in enumerate(vocabulary)}
+                for field, vocabulary in meta.get("vocabularies", {}).items()
+            },
+        }
+        if meta["trained"]:
+            loaded["centroids"] = np.load(self._file("centroids.npy"))
+        self._loaded, self._loaded_version = loaded, version
+        return loaded
+
+    def _candidates(self, loaded, query, probe, filters):
+        """
+        Score the live rows of every segment that are in the probed
+        IVF lists (all rows if probe is None) and match the filters.
+        Filters are applied before scoring, so selective filters
+        make the search cheaper.
+        """
+        import numpy as np
+        from src.filters.helpers import filter_mask
+
+        meta = loaded["meta"]
+        all_scores, all_ids, all_segments, all_rows = [], [], [], []
+        for segment_no, segment in enumerate(loaded["segments"]):
+            mask = None
+            if filters:
+                if set(filters) - set(segment["filters"]):
+                    raise ValueError(
+                        f"Collection {self.collection_name} has no filter fields "
+                        f"{sorted(set(filters) - set(segment['filters']))}, rebuild it"
+                    )
+                mask = filter_mask(filters, segment["filters"], loaded["vocabularies"])
+
+            if probe is None:
+                rows = None if mask is None else np.flatnonzero(mask)
+            else:
+                rows = np.concatenate(
+                    [
+                        segment["order"][segment["bounds"][c] : segment["bounds"][c + 1]]
+                        for c in probe
+                    ]
+                )
+                rows.sort()
+                if mask is not None:
+                    rows = rows[mask[rows]]
+            vectors = segment["vectors"] if rows is None else segment["vectors"][rows]
+            scores = self._score(vectors, query, meta["metric_type"])
+            if rows is None:
+                rows = np.arange(len(scores))
+            ids = segment["ids"][rows]
+            if segment["deleted"] is not None:
+                alive = ~segment["deleted"][rows]
+                scores, ids, rows = scores[alive], ids[alive], rows[alive]
+            all_scores.append(scores)
+            all_ids.append(np.asarray(ids))
+            all_segments.append(np.full(len(rows), segment_no, dtype=np.int32))
+            all_rows.append(rows)
+
+        if not all_scores:
+            return None
+        return (
+            np.concatenate(all_scores),
+            np.concatenate(all_ids),
+            np.concatenate(all_segments),
+            np.concatenate(all_rows),
+        )
+
+    def search(self, query_embedding, search_params, k, output_fields=None, filters=None):
+        import json
+        import numpy as np
+
+        loaded = self.load()
+        meta = loaded["meta"]
+        query = np.asarray(query_embedding, dtype=np.float32)
+        metric_type = meta["metric_type"]
+
+        probe = None
+        if loaded["centroids"] is not None:
+            # at least one list, at most all of them
+            nprobe = min(
+                max(int(search_params.get("params", {}).get("nprobe", 16)), 1),
+                len(loaded["centroids"]),
+            )
+            centroid_scores = self._score(loaded["centroids"], query, metric_type)
+            probe = np.argsort(-centroid_scores)[:nprobe]
+
+        candidates = self._candidates(loaded, query, probe, filters)
+        if candidates is None:
+            return []
+        if filters and probe is not None and len(candidates[0]) < k:
+            # a selective filter left fewer than k matches in the
+            # probed lists, search every matching row instead
+            candidates = self._candidates(loaded, query, None, filters)
+        scores, ids, segment_nos, rows = candidates
+
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k] if k else np.array([], dtype=int)
+        top = top[np.argsort(-scores[top])]
+
+        # report milvus-style distances: inner product, or squared L2
+        distances = scores[top] if metric_type == "IP" else -scores[top]
+        if not output_fields:
+            return [SearchHit(int(id), float(d)) for id, d in zip(ids[top], distances)]
+
+        # decode the payloads of the hits only
+        hits = []
+        for id, distance, segment_no, row in zip(
+            ids[top], distances, segment_nos[top], rows[top]
+        ):
+            segment = loaded["segments"][segment_no]
+            payload = {}
+            if "payload" in segment:
+                start, end = segment["payload_offsets"][row : row + 2]
+                payload = json.loads(bytes(segment["payload"][start:end]))
+            hits.append(
+                SearchHit(
+                    int(id),
+                    float(distance),
+                    {field: payload.get(field) for field in output_fields},
+                )
+            )
+        return hits
+
+    def get_vectors(self, ids):
+        import numpy as np
+
+        loaded = self.load()
+        ids = np.asarray(ids, dtype=np.int64)
+        found_ids, vectors = [], []
+        for segment in loaded["segments"]:
+            hit = np.isin(segment["ids"], ids)
+            if segment["deleted"] is not None:
+                hit &= ~segment["deleted"]
+            rows = np.flatnonzero(hit)
+            found_ids.append(np.asarray(segment["ids"][rows]))
+            vectors.append(np.asarray(segment["vectors"][rows]))
+        if not found_ids:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, 0), dtype=np.float32)
+        return np.concatenate(found_ids), np.concatenate(vectors)
+
+    @staticmethod
+    def _score(vectors, query, metric_type):
+        """
+        Similarity of every vector to the query, higher is better
+        """
+        import numpy as np
+
+        vectors = np.asarray(vectors)
+        scores = vectors @ query
+        if metric_type == "L2":
+            # negative squared euclidean distance
+            scores = 2 * scores - np.einsum("ij,ij->i", vectors, vectors) - query @ query
+        return scores
+
+
+def _truncate_utf8(value, max_bytes):
+    """
+    Cut a string to at most max_bytes of utf-8, without splitting a character
+    """
+    encoded = value.encode("utf-8")
+    if len(encoded) <= max_bytes:
+        return value
+    return encoded[:max_bytes].decode("utf-8", errors="ignore")
+
+
+def payload_columns(df, payload_fields=None):
+    """
+    This function gets the payload fields of a dataframe
+    in the format VectorStore.insert() takes them
+
+    Arguments
+    ----------
+    df : pd.DataFrame
+        preprocessed dataframe
+    payload_fields : list(str)
+        fields to keep, defaults to PAYLOAD_FIELDS
+
+    Returns
+    -------
+    payloads : dict(list(str))
+        one list per field, missing values are empty strings
+
+    """
+    return {
+        field: [value if isinstance(value, str) else "" for value in df[field].values]
+        for field in payload_fields or PAYLOAD_FIELDS
+    }
+
+
+def search_results_metadata(search_results):
+    """
+    This function turns search hits that carry their payload
+    into the metadata dict of src.postgres.helpers.postgres_fetch_metadata,
+    for when the metadata is kept in the vector store
+
+    Arguments
+    ----------
+    search_results : list(SearchHit)
+        hits returned with output_fields=PAYLOAD_FIELDS
+
+    Returns
+    -------
+    metadata : dict(dict)
+        {0: {"title": "", "abstract": "", "authors": "", "url": "",
+             "id": 0, "distance": 0.0}, 1: {...}}
+
+    """
+    metadata = {}
+    for rank, hit in enumerate(search_results):
+        payload = hit.payload or {}
+        metadata[rank] = {
+            # empty strings were stored for missing values
+            **{field: payload.get(field) or None for field in PAYLOAD_FIELDS},
+            "id": hit.id,
+            "distance": hit.distance,
+        }
+    return metadata
+
+
+# most results a milvus search can return
+MAX_SEARCH_LIMIT = 16384
+
+
+def collapse_passages(search_results, k):
+    """
+    This function turns passage hits into document hits: the
+    best passage of every document stands for it, ranks are kept
+
+    Arguments
+    ----------
+    search_results : list(SearchHit)
+        passage hits, best first
+    k : int
+        number of documents to keep
+
+    Returns
+    -------
+    documents : list(SearchHit)
+        at most k hits, with the ids of the documents
+
+    """
+    from src.dataset.helpers import PARENT_ID_MASK
+
+    documents, seen = [], set()
+    for hit in search_results:
+        parent_id = int(hit.id) & PARENT_ID_MASK
+        if parent_id in seen:
+            continue
+        seen.add(parent_id)
+        documents.append(SearchHit(parent_id, hit.distance, getattr(hit, "payload", None)))
+        if len(documents) == k:
+            break
+    return documents
+
+
+def search_documents(
+    vector_store,
+    query_embedding,
+    search_params,
+    k,
+    output_fields=None,
+    filters=None,
+    passages=False,
+    oversample=4,
+):
+    """
+    This function searches the k documents nearest to a query. For
+    collections of passages (see src.dataset.helpers.chunk_passages)
+    it fetches oversample * k passages and collapses them to their
+    documents, fetching more if that left fewer than k documents.
+
+    Arguments
+    ----------
+    vector_store : VectorStore
+        the store to search
+    query_embedding : list(float)
+        the query vector
+    search_params : dict
+        search parameters
+    k : int
+        number of documents
+    output_fields : list(str)
+        payload fields to return with every hit
+    filters : dict
+        optional metadata filter (see src/filters/helpers.py)
+    passages : bool
+        whether the collection holds passages (as at build time)
+    oversample : int
+        passages fetched per document wanted
+
+    Returns
+    -------
+    results : list(SearchHit)
+        document hits, best first
+
+    """
+
+    def search(limit):
+        return vector_store.search(
+            query_embedding=query_embedding,
+            search_params=search_params,
+            k=limit,
+            output_fields=output_fields,
+            filters=filters,
+        )
+
+    if not passages:
+        return search(k)
+
+    limit = min(k * oversample, MAX_SEARCH_LIMIT)
+    while True:
+        hits = search(limit)
+        documents = collapse_passages(hits, k)
+        if len(documents) == k or len(hits) < limit or limit == MAX_SEARCH_LIMIT:
+            return documents
+        limit = min(limit * oversample, MAX_SEARCH_LIMIT)
+
+
+def search_documents_many(
+    vector_store,
+    query_embeddings,
+    search_params,
+    k,
+    output_fields=None,
+    filters=None,
+    passages=False,
+    oversample=4,
+):
+    """
+    This function is search_documents() for many query embeddings,
+    in one search_many() call. Queries whose passages collapse to
+    fewer than k documents are searched again one by one.
+
+    Arguments
+    ----------
+    vector_store : VectorStore
+        the store to search
+    query_embeddings : list(list(float))
+        the query vectors
+    search_params : dict
+        search parameters
+    k : int
+        number of documents per query
+    output_fields : list(str)
+        payload fields to return with every hit
+    filters : dict
+        optional metadata filter, for every query
+    passages : bool
+        whether the collection holds passages (as at build time)
+    oversample : int
+        passages fetched per document wanted
+
+    Returns
+    -------
+    results : list(list(SearchHit))
+        document hits of every query, best first
+
+    """
+    limit = min(k * oversample, MAX_SEARCH_LIMIT) if passages else k
+    results = vector_store.search_many(
+        query_embeddings,
+        search_params,
+        limit,
+        output_fields=output_fields,
+        filters=filters,
+    )
+    if not passages:
+        return results
+
+    documents = []
+    for query_embedding, hits in zip(query_embeddings, results):
+        collapsed = collapse_passages(hits, k)
+        if len(collapsed) < k and len(hits) == limit and limit < MAX_SEARCH_LIMIT:
+            collapsed = search_documents(
+                vector_store,
+                query_embedding,
+                search_params,
+                k,
+                output_fields=output_fields,
+                filters=filters,
+                passages=True,
+                oversample=oversample * oversample,
+            )
+        documents.append(collapsed)
+    return documents
+
+
+@functools.lru_cache(maxsize=None)
+def get_vector_store(backend="milvus", collection_name="rag_search", index_name="Embedding"):
+    """
+    This function returns a long-lived vector store
+
+    Arguments
+    ----------
+    backend : string
+        "milvus" or "local"
+    collection_name : string
+        name of the collection
+    index_name : string
+        name of the vector field / index
+
+    Returns
+    -------
+    vector_store : VectorStore
+
+    """
+    if backend == "milvus":
+        return MilvusVectorStore(collection_name, index_name)
+    if backend == "local":
+        return LocalVectorStore(collection_name, index_name)
+    raise ValueError(
+        f"Unknown vector store {backend}, choose one of {VECTOR_STORE_BACKENDS}"
+    )
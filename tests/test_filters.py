@@ -0,0 +1,142 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.filters.helpers import (
+    filter_columns,
+    filter_expression,
+    filter_mask,
+    normalize_filters,
+    parse_filter_arguments,
+    publish_date,
+)
+
+
+@pytest.mark.parametrize(
+    "value, date",
+    [
+        ("2020-03-12", 20200312),
+        ("2020-03", 20200301),
+        ("2020", 20200101),
+        (" 2020-3-5 ", 20200305),
+        (20210315, 20210315),
+        (202103, 20210301),
+        (2021, 20210101),
+        (np.int64(2020), 20200101),
+    ],
+)
+def test_publish_date(value, date):
+    assert publish_date(value) == date
+    assert publish_date(value, strict=True) == date
+
+
+@pytest.mark.parametrize(
+    "value", ["01/01/2021", "soon", "2021-13-45", "2021-02-00", "", 123, 20211332]
+)
+def test_publish_date_rejects_bad_dates_in_filters(value):
+    with pytest.raises(ValueError):
+        publish_date(value, strict=True)
+    # unknown in the dataset
+    assert publish_date(value) == 0
+
+
+def test_publish_date_of_dataset_values():
+    assert publish_date(float("nan")) == 0
+    assert publish_date(None) == 0
+    assert publish_date("2020-03-12 00:00:00") == 20200312
+
+
+def test_normalize_filters():
+    assert normalize_filters(
+        {
+            "publish_time": {">=": "2021", "<": 2022},
+            "journal": "Lancet",
+            "source": ["PMC", "Medline"],
+        }
+    ) == {
+        "publish_time": [(">=", 20210101), ("<", 20220101)],
+        "journal": [("==", "Lancet")],
+        "source": [("in", ["PMC", "Medline"])],
+    }
+    assert normalize_filters(None) == {}
+
+
+@pytest.mark.parametrize(
+    "filters",
+    [
+        {"publish_time": {">=": "01/01/2021"}},
+        {"publish_time": {">=": "soon"}},
+        {"publish_time": "2021-13-45"},
+        {"publish_time": ["2021", "later"]},
+        {"title": "covid"},
+        {"journal": {"~": "Lancet"}},
+    ],
+)
+def test_normalize_filters_rejects(filters):
+    with pytest.raises(ValueError):
+        normalize_filters(filters)
+
+
+def test_parse_filter_arguments_rejects_bad_dates():
+    filters = parse_filter_arguments(["publish_time>=01/01/2021"])
+    with pytest.raises(ValueError):
+        normalize_filters(filters)
+
+
+def test_parse_filter_arguments():
+    assert parse_filter_arguments(
+        ["publish_time>=2021-01-01", "publish_time<2022", "source=PMC,Medline", "journal=Lancet"]
+    ) == {
+        "publish_time": {">=": "2021-01-01", "<": "2022"},
+        "source": ["PMC", "Medline"],
+        "journal": {"==": "Lancet"},
+    }
+
+
+def test_filter_expression_quotes_strings():
+    assert filter_expression(None) is None
+    assert (
+        filter_expression(
+            {"publish_time": {">=": "2021-01-01"}, "journal": 'The "BMJ"', "source": ["PMC"]}
+        )
+        == 'publish_time >= 20210101 and journal == "The \\"BMJ\\"" and source in ["PMC"]'
+    )
+
+
+def test_filter_mask():
+    df = pd.DataFrame(
+        {
+            "publish_time": ["2020-03-12", "2021-06", None, "2022"],
+            "journal": ["Lancet", "BMJ", "Lancet", np.nan],
+            "source_x": ["PMC", "Medline", "PMC", "WHO"],
+            "license": ["cc-by", "cc-by", "els-covid", "cc0"],
+        }
+    )
+    columns = filter_columns(df)
+    assert columns["publish_time"] == [20200312, 20210601, 0, 20220101]
+    assert columns["journal"] == ["Lancet", "BMJ", "Lancet", ""]
+
+    # string fields are stored as codes into a vocabulary
+    vocabularies, arrays = {}, {}
+    for field, values in columns.items():
+        if field == "publish_time":
+            arrays[field] = np.asarray(values, dtype=np.int64)
+            continue
+        vocabularies[field] = {value: code for code, value in enumerate(dict.fromkeys(values))}
+        arrays[field] = np.asarray([vocabularies[field][value] for value in values])
+
+    def mask(filters):
+        return filter_mask(filters, arrays, vocabularies).tolist()
+
+    assert filter_mask({}, arrays, vocabularies) is None
+    assert mask({"publish_time": {">=": 2021}}) == [False, True, False, True]
+    assert mask({"publish_time": {">=": "2020", "<": "2021"}, "journal": "Lancet"}) == [
+        True, False, False, False,
+    ]
+    assert mask({"source": ["PMC", "WHO"]}) == [True, False, True, True]
+    assert mask({"journal": {"!=": "Lancet"}}) == [False, True, False, True]
+    # strings missing from the vocabulary match nothing
+    assert mask({"journal": "Nature"}) == [False, False, False, False]
+    assert mask({"license": ["unknown"]}) == [False, False, False, False]
+    with pytest.raises(ValueError):
+        mask({"journal": {">": "A"}})
@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+
+import src.model.helpers as model_helpers
+from src.cache.helpers import EmbeddingCache
+from src.model.helpers import generate_embeddings
+from src.model.providers import OpenAIEmbeddingProvider
+
+
+def fake_openai(monkeypatch, calls):
+    def openai_embed_texts(client, texts, **kwargs):
+        calls.append(list(texts))
+        return [[float(len(text))] * 1536 for text in texts]
+
+    monkeypatch.setattr(model_helpers, "openai_client", lambda *args: None)
+    monkeypatch.setattr(model_helpers, "openai_embed_texts", openai_embed_texts)
+
+
+def test_fully_cached_shard_is_not_embedded_again(tmp_path, monkeypatch):
+    calls = []
+    fake_openai(monkeypatch, calls)
+    provider = OpenAIEmbeddingProvider("text-embedding-ada-002", "key")
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"))
+    df = pd.DataFrame({"embedding_text": ["a", "bb", "a"]})
+    try:
+        first = generate_embeddings(provider=provider, df=df, cache=cache)
+        second = generate_embeddings(provider=provider, df=df, cache=cache)
+    finally:
+        cache.close()
+
+    assert calls == [["a", "bb"]]
+    assert second is not None
+    assert second.shape == (3, 1536) and second.dtype == np.float32
+    np.testing.assert_array_equal(first, second)
+
+
+def test_openai_provider_embeds_no_texts(monkeypatch):
+    calls = []
+    fake_openai(monkeypatch, calls)
+    provider = OpenAIEmbeddingProvider("text-embedding-ada-002", "key")
+
+    embeddings = provider.embed([])
+
+    assert calls == []
+    assert embeddings.shape == (0, 1536) and embeddings.dtype == np.float32
@@ -0,0 +1,162 @@
+import collections
+import math
+
+import pytest
+
+from src.dataset.helpers import PARENT_ID_MASK, PASSAGE_BITS
+from src.lexical.helpers import (
+    BM25_B,
+    BM25_K1,
+    LexicalIndex,
+    lexical_search_documents,
+    reciprocal_rank_fusion,
+    tokenize,
+)
+from src.vectorstore.helpers import SearchHit
+
+TEXTS = {
+    1: "IL-6 levels in severe COVID-19 patients",
+    2: "Tocilizumab blocks the IL-6 receptor in COVID-19 pneumonia",
+    3: "Masks reduce transmission of SARS-CoV-2 in households",
+    4: "Remdesivir trial in hospitalized patients",
+    5: "Vaccine efficacy against SARS-CoV-2 variants, and vaccine safety",
+}
+
+
+def bm25(texts, query):
+    """
+    BM25 score of every text that has a query term, as in the textbook
+    """
+    counts = {id: collections.Counter(tokenize(text)) for id, text in texts.items()}
+    average_length = sum(sum(c.values()) for c in counts.values()) / len(counts)
+    scores = {}
+    for term in set(tokenize(query)):
+        df = sum(term in c for c in counts.values())
+        idf = math.log(1 + (len(counts) - df + 0.5) / (df + 0.5))
+        for id, c in counts.items():
+            if c[term]:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * sum(c.values()) / average_length)
+                scores[id] = scores.get(id, 0.0) + idf * c[term] * (BM25_K1 + 1) / (
+                    c[term] + norm
+                )
+    return scores
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = LexicalIndex("test", artifacts_dir=str(tmp_path))
+    index.create(filter_fields=["journal"])
+    # two segments
+    for part in [[1, 2, 3], [4, 5]]:
+        index.insert(
+            part,
+            [TEXTS[id] for id in part],
+            filter_values={"journal": ["Lancet" if id % 2 else "BMJ" for id in part]},
+        )
+    return index
+
+
+def test_tokenize_keeps_hyphenated_terms_and_their_parts():
+    assert tokenize("IL-6 and SARS-CoV-2 in the 2019-nCoV outbreak") == [
+        "il-6",
+        "il",
+        "6",
+        "sars-cov-2",
+        "sars",
+        "cov",
+        "2",
+        "2019-ncov",
+        "2019",
+        "ncov",
+        "outbreak",
+    ]
+    assert tokenize("p.o. dosing, 5/325 mg") == [
+        "p.o", "p", "o", "dosing", "5/325", "5", "325", "mg",
+    ]
+    assert tokenize(None) == []
+
+
+@pytest.mark.parametrize(
+    "query", ["IL-6", "covid-19 patients", "SARS-CoV-2 vaccine", "remdesivir"]
+)
+def test_bm25_matches_the_textbook_scores(index, query):
+    expected = bm25(TEXTS, query)
+    hits = index.search(query, 10)
+    assert [hit.id for hit in hits] == sorted(expected, key=lambda id: -expected[id])
+    for hit in hits:
+        assert hit.distance == pytest.approx(expected[hit.id], rel=1e-5)
+
+
+def test_bm25_order(index):
+    # the only text naming tocilizumab, then the texts with il-6
+    assert [hit.id for hit in index.search("tocilizumab IL-6", 10)] == [2, 1]
+    # "vaccine" twice beats a single match
+    assert index.search("vaccine masks", 10)[0].id == 5
+    assert index.search("the and of", 10) == []
+    assert index.search("ebola", 10) == []
+
+
+def test_bm25_filters_and_deletes(index):
+    assert [hit.id for hit in index.search("IL-6", 10, filters={"journal": "BMJ"})] == [2]
+    index.delete([2])
+    assert [hit.id for hit in index.search("IL-6", 10)] == [1]
+    assert index.search("tocilizumab", 10) == []
+
+
+def test_reciprocal_rank_fusion_order():
+    vector = [SearchHit(1, 0.9, {"title": "a"}), SearchHit(2, 0.8), SearchHit(3, 0.7)]
+    lexical = [SearchHit(3, 12.0), SearchHit(2, 9.0, {"title": "b"}), SearchHit(4, 1.0)]
+
+    fused = reciprocal_rank_fusion([vector, lexical], 10, rrf_k=60)
+
+    # 2 and 3 are in both rankings with the same mean rank,
+    # a first place outweighs two second places
+    assert [hit.id for hit in fused] == [3, 2, 1, 4]
+    assert fused[0].distance == pytest.approx(1 / 63 + 1 / 61)
+    assert fused[1].distance == pytest.approx(1 / 62 + 1 / 62)
+    assert [hit.payload for hit in fused] == [None, {"title": "b"}, {"title": "a"}, None]
+    assert [hit.id for hit in reciprocal_rank_fusion([vector, lexical], 2)] == [3, 2]
+
+
+def test_reciprocal_rank_fusion_ties_keep_the_first_ranking_first():
+    vector = [SearchHit(1, 0.9), SearchHit(2, 0.8)]
+    lexical = [SearchHit(3, 5.0), SearchHit(4, 4.0)]
+
+    fused = reciprocal_rank_fusion([vector, lexical], 10)
+
+    assert [hit.id for hit in fused] == [1, 3, 2, 4]
+    assert fused[0].distance == fused[1].distance
+    assert reciprocal_rank_fusion([], 10) == []
+
+
+def test_passages_collapse_to_their_documents(tmp_path):
+    passages = {
+        10 << PASSAGE_BITS: [
+            "Remdesivir and IL-6 in severe COVID-19",
+            "IL-6 IL-6 receptor blockade",
+        ],
+        20 << PASSAGE_BITS: [
+            "Masks and distancing",
+            "no IL-6 here, but IL-6 elsewhere",
+            "IL-6",
+        ],
+        30 << PASSAGE_BITS: ["Vaccines"],
+    }
+    index = LexicalIndex("test", artifacts_dir=str(tmp_path))
+    index.create()
+    for doc_id, texts in passages.items():
+        index.insert([doc_id + no for no in range(len(texts))], texts)
+
+    passage_hits = index.search("IL-6", 10)
+    documents = lexical_search_documents(index, "IL-6", 10, passages=True)
+
+    # the best passage of every document stands for it
+    best = {}
+    for hit in passage_hits:
+        best.setdefault(hit.id & PARENT_ID_MASK, hit.distance)
+    assert len(passage_hits) == 4
+    assert [(hit.id, hit.distance) for hit in documents] == list(best.items())
+    assert sorted(best) == [10 << PASSAGE_BITS, 20 << PASSAGE_BITS]
+    assert [hit.id for hit in lexical_search_documents(index, "IL-6", 1, passages=True)] == [
+        documents[0].id
+    ]
@@ -0,0 +1,165 @@
+import numpy as np
+import pytest
+
+from src.vectorstore.helpers import LocalVectorStore
+
+DIM = 16
+NLIST = 8
+K = 10
+
+
+def unit_vectors(rng, n):
+    vectors = rng.standard_normal((n, DIM)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.fixture
+def collection(tmp_path):
+    """
+    Two segments, some rows deleted, an IVF index trained on the rest
+    and a third segment inserted after training
+    """
+    rng = np.random.default_rng(0)
+    vectors = unit_vectors(rng, 900)
+    ids = np.arange(1000, 1900)
+    years = np.where(np.arange(900) % 100 == 0, 20200101, 20210101)
+    journals = np.array(["Lancet", "BMJ", "Nature"])[np.arange(900) % 3]
+
+    store = LocalVectorStore("test", artifacts_dir=str(tmp_path))
+    store.create(
+        DIM,
+        {"metric_type": "IP", "index_type": "IVF_FLAT", "params": {"nlist": NLIST}},
+        payload_fields=["title"],
+        filter_fields=["publish_time", "journal"],
+    )
+    for part in [slice(0, 400), slice(400, 800)]:
+        store.insert(
+            ids[part],
+            vectors[part],
+            payloads={"title": [f"paper {id}" for id in ids[part]]},
+            filter_values={
+                "publish_time": years[part].tolist(),
+                "journal": journals[part].tolist(),
+            },
+        )
+    deleted = ids[:800:7]
+    store.delete(deleted)
+    store.finalize()
+    store.insert(
+        ids[800:],
+        vectors[800:],
+        payloads={"title": [f"paper {id}" for id in ids[800:]]},
+        filter_values={
+            "publish_time": years[800:].tolist(),
+            "journal": journals[800:].tolist(),
+        },
+    )
+
+    alive = ~np.isin(ids, deleted)
+    return store, {
+        "vectors": vectors[alive],
+        "ids": ids[alive],
+        "years": years[alive],
+        "journals": journals[alive],
+        "queries": unit_vectors(rng, 5),
+    }
+
+
+def brute_force(data, query, k, mask=None):
+    scores = data["vectors"] @ query
+    ids = data["ids"]
+    if mask is not None:
+        scores, ids = scores[mask], ids[mask]
+    top = np.argsort(-scores, kind="stable")[:k]
+    return ids[top].tolist(), scores[top]
+
+
+def search(store, query, nprobe, k=K, **kwargs):
+    return store.search(query.tolist(), {"params": {"nprobe": nprobe}}, k, **kwargs)
+
+
+def test_trained_index(collection):
+    store, _ = collection
+    loaded = store.load()
+    assert loaded["meta"]["trained"]
+    assert loaded["centroids"].shape == (NLIST, DIM)
+    # every row of every segment is in exactly one list
+    for segment in loaded["segments"]:
+        assert segment["bounds"][-1] == len(segment["ids"])
+
+
+@pytest.mark.parametrize("nprobe", [NLIST, NLIST + 1, 1000])
+def test_probing_every_list_is_exact(collection, nprobe):
+    store, data = collection
+    for query in data["queries"]:
+        ids, scores = brute_force(data, query, K)
+        hits = search(store, query, nprobe)
+        assert [hit.id for hit in hits] == ids
+        np.testing.assert_allclose([hit.distance for hit in hits], scores, rtol=1e-5)
+
+
+@pytest.mark.parametrize("nprobe", [0, -3])
+def test_nprobe_below_one_probes_one_list(collection, nprobe):
+    store, data = collection
+    for query in data["queries"]:
+        hits = search(store, query, nprobe)
+        assert hits == search(store, query, 1)
+        assert hits
+
+
+def test_ivf_results_are_live_rows_with_exact_distances(collection):
+    store, data = collection
+    for query in data["queries"]:
+        scores_by_id = dict(zip(data["ids"].tolist(), (data["vectors"] @ query).tolist()))
+        for nprobe in [1, 2, 4]:
+            hits = search(store, query, nprobe)
+            assert len(hits) == K
+            assert all(hit.id in scores_by_id for hit in hits)
+            np.testing.assert_allclose(
+                [hit.distance for hit in hits],
+                [scores_by_id[hit.id] for hit in hits],
+                rtol=1e-5,
+            )
+            assert [hit.distance for hit in hits] == sorted(
+                (hit.distance for hit in hits), reverse=True
+            )
+
+
+def test_deleted_rows_are_not_found(collection):
+    store, data = collection
+    deleted_id = 1000
+    assert deleted_id not in data["ids"]
+    query = unit_vectors(np.random.default_rng(0), 900)[0]
+    assert deleted_id not in [hit.id for hit in search(store, query, NLIST, k=900)]
+    found_ids, vectors = store.get_vectors([deleted_id, 1001])
+    assert found_ids.tolist() == [1001]
+    assert vectors.shape == (1, DIM)
+
+
+def test_selective_filter_falls_back_to_a_full_scan(collection):
+    store, data = collection
+    # only a handful of rows are from 2020, fewer than K
+    mask = data["years"] == 20200101
+    assert 0 < mask.sum() < K
+    for query in data["queries"]:
+        ids, scores = brute_force(data, query, K, mask)
+        hits = search(store, query, 1, filters={"publish_time": {"<": 2021}})
+        assert [hit.id for hit in hits] == ids
+        np.testing.assert_allclose([hit.distance for hit in hits], scores, rtol=1e-5)
+
+
+def test_filters_with_payloads(collection):
+    store, data = collection
+    mask = (data["journals"] == "BMJ") & (data["years"] == 20210101)
+    for query in data["queries"]:
+        ids, _ = brute_force(data, query, K, mask)
+        hits = search(
+            store,
+            query,
+            NLIST,
+            output_fields=["title"],
+            filters={"journal": "BMJ", "publish_time": "2021"},
+        )
+        assert [hit.id for hit in hits] == ids
+        assert [hit.payload for hit in hits] == [{"title": f"paper {id}"} for id in ids]
+    assert search(store, data["queries"][0], NLIST, filters={"journal": "Cell"}) == []
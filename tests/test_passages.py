@@ -0,0 +1,118 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.dataset.helpers import (
+    MAX_PASSAGES,
+    PARENT_ID_MASK,
+    PASSAGE_BITS,
+    chunk_passages,
+    passage_ids,
+)
+from src.vectorstore.helpers import SearchHit, collapse_passages
+
+DOC_IDS = [0, 1 << PASSAGE_BITS, 0x7FFFFFFFFFFFFFFF & PARENT_ID_MASK, 12345 & PARENT_ID_MASK]
+
+
+def documents(abstracts, title="Title"):
+    return pd.DataFrame(
+        {
+            "doc_id": DOC_IDS[: len(abstracts)],
+            "title": [title] * len(abstracts),
+            "abstract": abstracts,
+            "embedding_text": [f"{title} {abstract}" for abstract in abstracts],
+        }
+    )
+
+
+def words(n, prefix="w"):
+    return " ".join(f"{prefix}{i}" for i in range(n))
+
+
+def test_passage_ids_give_back_their_parents():
+    ids = passage_ids(DOC_IDS)
+
+    assert len(ids) == len(DOC_IDS) * MAX_PASSAGES
+    assert len(set(ids)) == len(ids)
+    assert all(0 <= id <= 0x7FFFFFFFFFFFFFFF for id in ids)
+    np.testing.assert_array_equal(
+        np.asarray(ids, dtype=np.int64) & PARENT_ID_MASK,
+        np.repeat(DOC_IDS, MAX_PASSAGES),
+    )
+    assert [id & ~PARENT_ID_MASK for id in ids[:MAX_PASSAGES]] == list(range(MAX_PASSAGES))
+
+
+@pytest.mark.parametrize(
+    "overlap_tokens, overlap",
+    # at most half of a window, longer overlaps would not cover the abstract
+    [(0, 0), (10, 10), (20, 20), (25, 20), (64, 20)],
+)
+def test_passages_overlap_by_passage_overlap_tokens(overlap_tokens, overlap):
+    # one title token, so the abstract gets 40 tokens per passage
+    passages_df = chunk_passages(
+        documents([words(100)]), passage_tokens=41, overlap_tokens=overlap_tokens
+    )
+
+    passages = [text.split()[1:] for text in passages_df["embedding_text"]]
+    assert all(text.split()[0] == "Title" for text in passages_df["embedding_text"])
+    assert all(len(passage) <= 40 for passage in passages)
+    for previous, passage in zip(passages, passages[1:]):
+        assert previous[len(previous) - overlap :] == passage[:overlap]
+        assert previous[-1] != passage[-1]
+    # together they cover the whole abstract, in order
+    covered = passages[0] + [
+        token for previous, passage in zip(passages, passages[1:]) for token in passage[overlap:]
+    ]
+    assert covered == words(100).split()
+
+
+def test_long_titles_do_not_drop_the_abstract():
+    # with the defaults, a title this long leaves the abstract 32
+    # tokens per passage, fewer than the 64 tokens of overlap
+    passages_df = chunk_passages(documents([words(200)], title=words(240, prefix="t")))
+
+    abstract = [
+        [token for token in text.split() if token.startswith("w")]
+        for text in passages_df["embedding_text"]
+    ]
+    assert abstract[0][0] == "w0" and abstract[-1][-1] == "w199"
+    assert all(len(tokens) == 32 for tokens in abstract[:-1])
+
+
+def test_passage_ids_and_columns():
+    df = documents([words(100), "", words(10)])
+    passages_df = chunk_passages(df, passage_tokens=41, overlap_tokens=10)
+
+    assert passages_df["passage_id"].tolist() == [
+        DOC_IDS[0], DOC_IDS[0] + 1, DOC_IDS[0] + 2, DOC_IDS[1], DOC_IDS[2],
+    ]
+    assert set(passages_df["passage_id"]) <= set(passage_ids(DOC_IDS[:3]))
+    assert (passages_df["passage_id"] & PARENT_ID_MASK).tolist() == passages_df["doc_id"].tolist()
+    # documents without an abstract still get a passage, the title
+    assert passages_df["embedding_text"].tolist()[3].strip() == "Title"
+    assert passages_df["title"].tolist() == ["Title"] * 5
+
+
+def test_long_abstracts_are_capped_at_max_passages():
+    passages_df = chunk_passages(documents([words(5000), words(50)]), passage_tokens=41)
+
+    ids = passages_df["passage_id"].tolist()
+    assert ids[:MAX_PASSAGES] == [DOC_IDS[0] + no for no in range(MAX_PASSAGES)]
+    assert ids[MAX_PASSAGES:] == [DOC_IDS[1], DOC_IDS[1] + 1]
+    assert all(id & PARENT_ID_MASK == DOC_IDS[0] for id in ids[:MAX_PASSAGES])
+
+
+def test_passage_hits_collapse_to_documents():
+    hits = [
+        SearchHit(DOC_IDS[1] + 3, 0.9),
+        SearchHit(DOC_IDS[0] + 1, 0.8),
+        SearchHit(DOC_IDS[1], 0.7),
+        SearchHit(DOC_IDS[2] + MAX_PASSAGES - 1, 0.6),
+    ]
+
+    assert [(hit.id, hit.distance) for hit in collapse_passages(hits, 10)] == [
+        (DOC_IDS[1], 0.9),
+        (DOC_IDS[0], 0.8),
+        (DOC_IDS[2], 0.6),
+    ]
+    assert [hit.id for hit in collapse_passages(hits, 2)] == DOC_IDS[1::-1]